@@ -0,0 +1,81 @@
+import argparse
+import random
+import timeit
+import engine
+
+# Micro-benchmarks of the bitboard engine against the list based board code it replaced.
+# Run from the repository root: python -m benchmarks.engine
+
+def list_check_win(board, player):
+    # Previous concurrent_server.check_win
+    win_conditions = [(0, 1, 2), (3, 4, 5), (6, 7, 8), (0, 3, 6), (1, 4, 7), (2, 5, 8), (0, 4, 8), (2, 4, 6)]
+    return any(board[a] == board[b] == board[c] == player for a, b, c in win_conditions)
+
+def list_check_winner(board):
+    # Previous TicTacToeServer.check_winner without its sleep
+    winning_combinations = [
+        [0, 1, 2], [3, 4, 5], [6, 7, 8],
+        [0, 3, 6], [1, 4, 7], [2, 5, 8],
+        [0, 4, 8], [2, 4, 6]
+    ]
+    for combo in winning_combinations:
+        if board[combo[0]] == board[combo[1]] == board[combo[2]] != ' ':
+            return True
+    return False
+
+def list_legal_moves(board):
+    # Previous TicTacToeServer.random_move without the random choice
+    return [i for i, v in enumerate(board) if v == ' ']
+
+def random_positions(count, seed=0):
+    # Positions reached by random play, as lists of cells and as engine boards
+    rng = random.Random(seed)
+    lists, boards = [], []
+    while len(lists) < count:
+        board = engine.Board()
+        for _ in range(rng.randrange(engine.CELLS + 1)):
+            if board.winner() or board.is_full():
+                break
+            board.play(rng.choice(board.legal_moves()), board.next_mark())
+        lists.append(list(board))
+        boards.append(board)
+    return lists, boards
+
+def per_call_ns(statement, number):
+    # Best of five runs, in nanoseconds per call
+    return min(timeit.repeat(statement, number=number, repeat=5)) / number * 1e9
+
+def run(positions, batch_size):
+    lists, boards = random_positions(positions)
+    results = {}
+
+    def each(function, items):
+        return lambda: [function(item) for item in items]
+
+    results['check_win list'] = per_call_ns(each(lambda b: list_check_win(b, 'X'), lists), 1) / positions
+    results['check_win bitboard'] = per_call_ns(each(lambda b: b.wins('X'), boards), 1) / positions
+    results['check_winner list'] = per_call_ns(each(list_check_winner, lists), 1) / positions
+    results['check_winner bitboard'] = per_call_ns(each(lambda b: b.winner() is not None, boards), 1) / positions
+    results['legal_moves list'] = per_call_ns(each(list_legal_moves, lists), 1) / positions
+    results['legal_moves bitboard'] = per_call_ns(each(engine.Board.legal_moves, boards), 1) / positions
+
+    batch = [boards[i % positions].key() for i in range(batch_size)]
+    batch_lists = [lists[i % positions] for i in range(batch_size)]
+    np = engine.load_numpy()
+    if np is not None:
+        batch = np.array(batch, dtype=np.int32)
+    results['batch winners list loop'] = per_call_ns(lambda: [list_check_win(b, 'X') or list_check_win(b, 'O') for b in batch_lists], 1) / batch_size
+    results['batch winners engine'] = per_call_ns(lambda: engine.batch_winners(batch), 1) / batch_size
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmarks of the game engine")
+    parser.add_argument('--positions', type=int, default=10000, help="random positions evaluated per run")
+    parser.add_argument('--batch', type=int, default=1000000, help="boards evaluated by the batch API at once")
+    args = parser.parse_args()
+
+    print(f"{'benchmark':<28} {'ns/board':>10}")
+    for name, ns in run(args.positions, args.batch).items():
+        print(f"{name:<28} {ns:>10.1f}")
+    if engine.load_numpy() is None:
+        print("NumPy is not installed, batch API ran as a Python loop.")
@@ -0,0 +1,226 @@
+import argparse
+import asyncio
+import os
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from engine import parse_board
+import protocol
+
+# Compare threaded and asyncio modes of concurrent_server on games per second, time from connect to game start,
+# bytes and write syscalls per game and memory per connection. --protocol picks the protocol players speak:
+# text, binary with full boards (snapshot) or binary with delta updates (delta).
+# Run from the repository root: python -m benchmarks.servers
+
+HOST = '127.0.0.1' # Servers are benchmarked on loopback
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) # Modules of the benchmarked server
+
+SERVER_MODES = {
+    'threaded': "import concurrent_server; concurrent_server.start_server('{host}', {port})",
+    'asyncio': "import asyncio, concurrent_server; asyncio.run(concurrent_server.start_async_server('{host}', {port}))",
+}
+
+def free_port():
+    # Ask the OS for a free TCP port
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((HOST, 0))
+        return s.getsockname()[1]
+
+def rss_kib(pid):
+    # Resident memory of a process in KiB, read from /proc
+    with open(f'/proc/{pid}/status') as file:
+        for line in file:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+def write_syscalls(pid):
+    # Number of write syscalls made by a process so far. Threaded server writes TLS records with write(),
+    # asyncio sends them with send() which /proc does not count, so the number is only reported for threaded mode.
+    with open(f'/proc/{pid}/io') as file:
+        for line in file:
+            if line.startswith('syscw:'):
+                return int(line.split()[1])
+    return 0
+
+def spawn_server(mode, port, directory):
+    # Start server in a separate process so its memory can be measured on its own. It runs in directory, so the
+    # store, history and game log of the benchmark games are kept out of the repository's.
+    # Readiness is taken from the startup line, a bare probe connection would be taken for a player.
+    code = SERVER_MODES[mode].format(host=HOST, port=port)
+    env = dict(os.environ, PYTHONPATH=REPO_DIR)
+    process = subprocess.Popen([sys.executable, '-u', '-c', code], cwd=directory, env=env, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    for line in process.stdout:
+        if 'waiting for connections' in line:
+            # Keep draining output so a full pipe never blocks the server
+            threading.Thread(target=process.stdout.read, daemon=True).start()
+            return process
+    process.kill()
+    raise RuntimeError(f"{mode} server did not start on port {port}")
+
+def client_context():
+    # Same TLS settings as the game clients, the server uses a self-signed cert
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+async def play_game(port, context, nickname):
+    # Play one game over the text protocol, always taking the first free cell.
+    # Returns whether the game finished, seconds from connect to the first board (game start) and bytes received.
+    start = time.perf_counter()
+    started = None
+    received = 0
+    reader, writer = await asyncio.open_connection(HOST, port, ssl=context)
+    writer.write(nickname.encode())
+    await writer.drain()
+    buffer = ""
+    try:
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                return False, started, received
+            received += len(data)
+            buffer += data.decode()
+            if started is None and ' | ' in buffer:
+                started = time.perf_counter() - start
+            if "wins!" in buffer or "draw!" in buffer:
+                return True, started, received
+            if "has left the game" in buffer:
+                return False, started, received
+            if "Your move" in buffer:
+                board = parse_board(buffer)
+                buffer = ""
+                writer.write(str(board.legal_moves()[0]).encode())
+                await writer.drain()
+    finally:
+        writer.close()
+
+async def play_game_binary(port, context, nickname, version=protocol.VERSION):
+    # play_game over the binary protocol, version 1 gets full boards and version 2 deltas
+    start = time.perf_counter()
+    started = None
+    board = None
+    reader, writer = await asyncio.open_connection(HOST, port, ssl=context)
+    writer.write(protocol.MAGIC + bytes([version]) + protocol.encode(protocol.JOIN, protocol.join_request(nickname, version)))
+    await writer.drain()
+    conn = protocol.BinaryConnection(reader=reader, writer=writer)
+    received = len(await reader.readexactly(len(protocol.MAGIC) + 1))
+    try:
+        while True:
+            msg_type, payload = await conn.read_frame_async()
+            received += protocol.HEADER.size + len(payload)
+            if msg_type in (protocol.STATE, protocol.DELTA):
+                if started is None:
+                    started = time.perf_counter() - start
+                if msg_type == protocol.STATE:
+                    board, flags, _ = protocol.parse_state(payload, version=version)
+                else:
+                    update = protocol.apply_delta(board, payload)
+                    if update is None:
+                        conn.send(protocol.RESYNC)
+                        continue
+                    flags = update[0]
+                if flags & protocol.YOUR_TURN:
+                    conn.send(protocol.MOVE, bytes([board.legal_moves()[0]]))
+                    await conn.drain()
+            elif msg_type == protocol.RESULT:
+                return payload[0] != protocol.OPPONENT_LEFT, started, received
+    except ConnectionError:
+        return False, started, received
+    finally:
+        writer.close()
+
+async def play_game_snapshots(port, context, nickname):
+    return await play_game_binary(port, context, nickname, version=1)
+
+BOTS = {
+    'text': play_game,
+    'snapshot': play_game_snapshots,
+    'delta': play_game_binary,
+}
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+async def run_games(port, games, concurrency, stalled, bot):
+    # Play given number of games with at most concurrency games in flight.
+    # Stalled connections never start TLS handshake, they must not delay pairing of other players.
+    # Returns games per second, connect to game start latencies in seconds and bytes received per game.
+    context = client_context()
+    slots = asyncio.Semaphore(2 * concurrency)
+    idle = [socket.create_connection((HOST, port)) for _ in range(stalled)]
+
+    async def player(i):
+        async with slots:
+            return await bot(port, context, f"bot{i}")
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(player(i) for i in range(2 * games)))
+    elapsed = time.perf_counter() - start
+    for s in idle:
+        s.close()
+    finished = sum(done for done, _, _ in results) // 2
+    received = sum(received for _, _, received in results)
+    return finished / elapsed, [started for _, started, _ in results if started is not None], received / max(finished, 1)
+
+async def measure_connections(port, pid, connections, batch):
+    # Open idle connections (nickname sent, nothing played) and return server memory per connection in KiB
+    context = client_context()
+    before = rss_kib(pid)
+
+    async def connect(i):
+        reader, writer = await asyncio.open_connection(HOST, port, ssl=context)
+        writer.write(f"idle{i}".encode())
+        await writer.drain()
+        # Wait for the first reply so the server has surely read the nickname
+        await reader.read(1024)
+        return writer
+
+    opened = []
+    for start in range(0, connections, batch):
+        opened += await asyncio.gather(*(connect(i) for i in range(start, min(start + batch, connections))))
+    after = rss_kib(pid)
+    for writer in opened:
+        writer.close()
+    return (after - before) / connections
+
+def benchmark(mode, games, concurrency, connections, batch, stalled, bot):
+    port = free_port()
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as directory:
+        process = spawn_server(mode, port, directory)
+        try:
+            writes = write_syscalls(process.pid)
+            games_per_second, start_latencies, bytes_per_game = asyncio.run(run_games(port, games, concurrency, stalled, bot))
+            writes_per_game = (write_syscalls(process.pid) - writes) / games if mode == 'threaded' else float('nan')
+            kib_per_connection = asyncio.run(measure_connections(port, process.pid, connections, batch))
+        finally:
+            process.kill()
+            process.wait()
+    return games_per_second, start_latencies, bytes_per_game, writes_per_game, kib_per_connection
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark threaded and asyncio game servers")
+    parser.add_argument('--games', type=int, default=500, help="number of games played against each server")
+    parser.add_argument('--concurrency', type=int, default=50, help="games in flight at the same time")
+    parser.add_argument('--stalled', type=int, default=0, help="connections that never finish TLS handshake, held open while games are played")
+    parser.add_argument('--connections', type=int, default=2000, help="idle connections opened to measure memory")
+    parser.add_argument('--batch', type=int, default=100, help="idle connections opened at once")
+    parser.add_argument('--protocol', default='text', choices=list(BOTS), help="protocol spoken by the benchmark players")
+    parser.add_argument('--modes', nargs='+', default=list(SERVER_MODES), choices=list(SERVER_MODES))
+    args = parser.parse_args()
+    protocol.raise_open_files_limit()
+
+    print(f"{'mode':<10} {'games/s':>10} {'start p50 ms':>13} {'start p99 ms':>13} {'bytes/game':>11} {'writes/game':>12} {'KiB/conn':>10}")
+    for mode in args.modes:
+        games_per_second, start_latencies, bytes_per_game, writes_per_game, kib_per_connection = benchmark(mode, args.games, args.concurrency, args.connections, args.batch, args.stalled, BOTS[args.protocol])
+        p50 = percentile(start_latencies, 0.5) * 1000
+        p99 = percentile(start_latencies, 0.99) * 1000
+        print(f"{mode:<10} {games_per_second:>10.1f} {p50:>13.1f} {p99:>13.1f} {bytes_per_game:>11.0f} {writes_per_game:>12.1f} {kib_per_connection:>10.1f}")
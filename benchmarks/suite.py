@@ -0,0 +1,155 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import timeit
+from datetime import datetime, timedelta
+import engine
+import leaderboard
+import metrics
+import protocol
+import store
+
+# Micro-benchmark suite of the servers' hot paths: win checks, board rendering and encoding, metrics, recording results
+# with scoreboards of many players and the history log. Results are saved as JSON, a run compared with a
+# baseline fails when a benchmark got slower than the threshold allows.
+# Run from the repository root: python -m benchmarks.suite --output new.json --baseline old.json
+
+REPEAT = 5 # Runs of every benchmark, the fastest one counts
+
+def per_call_ns(function, number):
+    # Best of REPEAT runs, in nanoseconds per call
+    return min(timeit.repeat(function, number=number, repeat=REPEAT)) / number * 1e9
+
+def random_board(rules, moves, rng):
+    # Board after given number of random moves, stops early when the game is won
+    board = engine.Board(rules=rules)
+    for _ in range(moves):
+        cell = rng.choice(board.legal_moves())
+        mark = board.next_mark()
+        if board.wins_at(cell, mark):
+            break
+        board.play(cell, mark)
+    return board
+
+def engine_benchmarks(rng):
+    results = {}
+    big = engine.Rules(15, 15, 5)
+    for name, rules, moves in (('3x3', engine.STANDARD, 4), ('15x15', big, 60)):
+        board = random_board(rules, moves, rng)
+        cell = board.legal_moves()[0]
+        results[f'wins_at {name}'] = per_call_ns(lambda: board.wins_at(cell, 'X'), 100000)
+        results[f'winner {name}'] = per_call_ns(board.winner, 10000 if rules.standard else 100)
+        results[f'legal_moves {name}'] = per_call_ns(board.legal_moves, 10000)
+        results[f'render_board {name}'] = per_call_ns(lambda: engine.render_board(board), 10000 if rules.standard else 1000)
+        results[f'state_payload {name}'] = per_call_ns(lambda: protocol.state_payload(board, protocol.YOUR_TURN, cell), 100000)
+    results['delta frame'] = per_call_ns(lambda: protocol.encode(protocol.DELTA, protocol.DELTA_FORMAT.pack(5, 4, protocol.YOUR_TURN)), 100000)
+    return results
+
+def metrics_benchmarks():
+    # Costs the instrumentation adds to every move and every lock of the servers
+    results = {}
+    lock = metrics.TimedLock(metrics.ROOM_LOCK)
+
+    def hold():
+        with lock:
+            pass
+
+    results['histogram observe'] = per_call_ns(lambda: metrics.MOVE.observe(0.003), 100000)
+    results['timed lock'] = per_call_ns(hold, 100000)
+    return results
+
+def scoring_benchmarks(players, directory, rng):
+    # Results recorded for random pairs of players already on a scoreboard of given size
+    results = {}
+    nicknames = [f'player{i}' for i in range(players)]
+    entries = [{'nickname': nickname, 'score': rng.randrange(-50, 50)} for nickname in nicknames]
+    scores = store.ScoreStore(os.path.join(directory, f'scores{players}.db'))
+    db = scores.connection()
+    db.execute('BEGIN')
+    db.executemany('INSERT INTO scoreboard (nickname, score) VALUES (?, ?)', [(entry['nickname'], entry['score']) for entry in entries])
+    db.execute('COMMIT')
+    ranking = leaderboard.Leaderboard(entries)
+    pairs = [tuple(rng.sample(nicknames, 2)) for _ in range(1000)]
+    picks = itertools.cycle(pairs)
+
+    results[f'record_result store {players}'] = per_call_ns(lambda: scores.record_result(*next(picks)), 200)
+    results[f'score store {players}'] = per_call_ns(lambda: scores.score(next(picks)[0]), 5000)
+    results[f'record_result leaderboard {players}'] = per_call_ns(lambda: ranking.record_result(*next(picks)), 5000)
+    results[f'rank leaderboard {players}'] = per_call_ns(lambda: ranking.rank(next(picks)[0]), 10000)
+    results[f'top100 leaderboard {players}'] = per_call_ns(lambda: ranking.top(100), 100)
+    return results
+
+def history_benchmarks(games, directory):
+    # History log holding given number of games
+    results = {}
+    log = store.HistoryLog(os.path.join(directory, 'history'))
+    start = datetime(2024, 1, 1)
+
+    def date(i):
+        # A second per game, games appended by the benchmark come after the others like real results
+        return (start + timedelta(seconds=i)).strftime('%Y-%m-%d %H:%M:%S')
+
+    for i in range(games):
+        log.append({'nicknames': f'player{i}-player{i + 1}', 'winner': f'player{i}', 'date': date(i)})
+    middle = date(games // 2)
+    _, cursor = log.page()
+    # Dates of the games appended by every run, formatted before the timing starts
+    dates = iter([date(i) for i in range(games, games + REPEAT * 1000)])
+
+    results[f'history append {games}'] = per_call_ns(lambda: log.append({'nicknames': 'a-b', 'winner': 'a', 'date': next(dates)}), 1000)
+    results[f'history first page {games}'] = per_call_ns(lambda: log.page(), 100)
+    results[f'history next page {games}'] = per_call_ns(lambda: log.page(cursor), 100)
+    results[f'history page before date {games}'] = per_call_ns(lambda: log.page(before=middle), 100)
+    return results
+
+def run(players, games, seed=0):
+    # Every group gets its own generator, so a group sees the same data whatever else runs
+    results = engine_benchmarks(random.Random(seed))
+    results.update(metrics_benchmarks())
+    with tempfile.TemporaryDirectory() as directory:
+        for count in players:
+            results.update(scoring_benchmarks(count, directory, random.Random(seed)))
+        results.update(history_benchmarks(games, directory))
+    return results
+
+def compare(results, baseline, threshold):
+    # Names of benchmarks slower than baseline by more than threshold (0.2 is 20 %)
+    return [name for name, ns in results.items() if name in baseline and ns > baseline[name] * (1 + threshold)]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Micro-benchmark suite of the servers' hot paths")
+    parser.add_argument('--players', type=int, nargs='+', default=[1000, 10000, 100000, 1000000], help="scoreboard sizes")
+    parser.add_argument('--games', type=int, default=100000, help="games in the history log")
+    parser.add_argument('--output', help="save results to this JSON file")
+    parser.add_argument('--baseline', help="JSON results of an earlier run to compare with")
+    parser.add_argument('--threshold', type=float, default=0.2, help="allowed slowdown against the baseline, 0.2 is 20 %%")
+    parser.add_argument('--repeat', type=int, default=REPEAT, help="runs of every benchmark, more runs give steadier results on a busy machine")
+    args = parser.parse_args()
+    REPEAT = args.repeat
+
+    results = run(args.players, args.games)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)['results']
+
+    print(f"{'benchmark':<40} {'ns/call':>12} {'baseline':>12} {'change':>8}")
+    for name, ns in results.items():
+        if name in baseline:
+            print(f"{name:<40} {ns:>12.1f} {baseline[name]:>12.1f} {(ns / baseline[name] - 1) * 100:>7.1f}%")
+        else:
+            print(f"{name:<40} {ns:>12.1f}")
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({'python': platform.python_version(), 'date': datetime.today().strftime('%Y-%m-%d %H:%M:%S'), 'results': results}, file, indent=4)
+
+    slower = compare(results, baseline, args.threshold)
+    if slower:
+        print(f"Slower than baseline by more than {args.threshold:.0%}: {', '.join(slower)}")
+        sys.exit(1)
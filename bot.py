@@ -0,0 +1,207 @@
+import argparse
+import asyncio
+import random
+import ssl
+import time
+from engine import Rules, STANDARD
+import protocol
+import solver
+
+# Headless bot players and load generator. Bots speak the binary protocol, so they play against both
+# concurrent_server and server, need no terminal and skip discovery: host and port are given.
+# Example: python bot.py --port 5050 --sessions 1000 --games 5 --strategy random --think-time 0.2
+# A bot plays all its games over one connection, --again reconnect opens a new one for every game instead.
+# --spectators N adds N spectators watching one game while the bots play, --slow-spectators stop reading it.
+# Servers record the games of bots like any others. Start the server of a load run in an empty directory, e.g.
+# cd $(mktemp -d) && python /path/to/concurrent_server.py, so the store, history and game log it writes are its own.
+
+AGAIN = {
+    'requeue': protocol.REQUEUE, # Back into matchmaking after every game
+    'rematch': protocol.REMATCH, # Same opponent again, matchmaking if the opponent leaves
+    'reconnect': None, # New connection and handshake for every game
+}
+
+STRATEGIES = {
+    'first': lambda board: board.legal_moves()[0], # First free cell
+    'random': lambda board: random.choice(board.legal_moves()),
+    'solver': solver.best_move, # Perfect play on 3x3, heuristic on bigger boards
+}
+
+class Stats:
+    # Latencies in seconds and counters of all bot sessions
+    def __init__(self):
+        self.handshake = [] # TCP and TLS handshake and protocol negotiation
+        self.matchmaking = [] # Negotiation done until the game starts
+        self.moves = [] # Move sent until the server's answer
+        self.finished = 0 # Games played to the end, counted once per player
+        self.failed = 0 # Games that ended with an error, timeout or opponent that left
+        self.spectator_frames = 0 # Frames received by spectators
+        self.spectator_closes = 0 # Spectator connections closed by the server, at the end of a session or when dropped
+
+def client_context():
+    # Servers use a self-signed cert, like the game clients bots skip its verification
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+async def open_session(host, port, context, nickname, stats, rules=STANDARD, vs_server=False):
+    # Connect and join the first game, returns the bot's connection
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(host, port, ssl=context)
+    try:
+        writer.write(protocol.MAGIC + bytes([protocol.VERSION]) + protocol.encode(protocol.JOIN, protocol.join_request(nickname, protocol.VERSION, vs_server, rules)))
+        conn = protocol.BinaryConnection(reader=reader, writer=writer)
+        hello = await reader.readexactly(len(protocol.MAGIC) + 1)
+    except BaseException:
+        writer.close()
+        raise
+    conn.version = hello[-1]
+    stats.handshake.append(time.perf_counter() - start)
+    return conn
+
+async def play_bot(conn, strategy, stats, think_time=0.0):
+    # Play one game as a bot on an open connection, from its JOIN or AGAIN until the result.
+    # Returns whether the game was played to the end.
+    joined = time.perf_counter()
+    board = None
+    sent = None # When the last move was sent
+    while True:
+        msg_type, payload = await conn.read_frame_async()
+        if sent is not None:
+            stats.moves.append(time.perf_counter() - sent)
+            sent = None
+        if msg_type == protocol.JOIN:
+            mark, conn.rules, _ = protocol.parse_join(payload, conn.version)
+            if mark is not None:
+                stats.matchmaking.append(time.perf_counter() - joined)
+            continue
+        if msg_type == protocol.RESULT:
+            return payload[0] != protocol.OPPONENT_LEFT
+        if msg_type == protocol.ERROR:
+            return False
+        if msg_type == protocol.STATE:
+            board, flags, _ = protocol.parse_state(payload, conn.rules, conn.version)
+        elif msg_type == protocol.DELTA:
+            update = protocol.apply_delta(board, payload)
+            if update is None:
+                conn.send(protocol.RESYNC)
+                continue
+            flags = update[0]
+        else:
+            continue
+        if flags & protocol.YOUR_TURN:
+            if think_time:
+                await asyncio.sleep(random.uniform(0, 2 * think_time))
+            conn.send(protocol.MOVE, bytes([strategy(board)]))
+            await conn.drain()
+            sent = time.perf_counter()
+
+async def watch_bot(host, port, context, target, stats, done, slow=False):
+    # Spectator of the session of target (the most watched one if empty) until done is set, watches again
+    # when the session ends. A slow spectator stops reading after the first frame.
+    while not done.is_set():
+        try:
+            reader, writer = await asyncio.open_connection(host, port, ssl=context)
+        except OSError:
+            await asyncio.sleep(0.1)
+            continue
+        try:
+            writer.write(protocol.MAGIC + bytes([protocol.VERSION]) + protocol.encode(protocol.JOIN, protocol.join_request(target, protocol.VERSION, spectate=True)))
+            conn = protocol.BinaryConnection(reader=reader, writer=writer)
+            await reader.readexactly(len(protocol.MAGIC) + 1)
+            while not done.is_set():
+                msg_type, _ = await conn.read_frame_async()
+                if msg_type == protocol.ERROR:
+                    # Nobody to watch yet
+                    await asyncio.sleep(0.1)
+                    break
+                stats.spectator_frames += 1
+                if slow:
+                    await done.wait()
+        except (OSError, EOFError, asyncio.IncompleteReadError):
+            stats.spectator_closes += not done.is_set()
+        finally:
+            writer.close()
+
+async def run_load(host, port, sessions, games, strategy, think_time=0.0, rules=STANDARD, vs_server=False, timeout=60.0, nickname='bot', again=protocol.REQUEUE, spectators=0, slow_spectators=False, watch=''):
+    # Keep sessions bots playing games games each, one after another. Returns stats and elapsed seconds.
+    # again is the choice sent after a game, None closes the connection and opens a new one.
+    # spectators watch the session of the bot named watch meanwhile, the most watched session if it is empty.
+    context = client_context()
+    stats = Stats()
+    done = asyncio.Event()
+
+    async def session(i):
+        conn = None
+        for game in range(games):
+            try:
+                if conn is None:
+                    conn = await asyncio.wait_for(open_session(host, port, context, f"{nickname}{i}", stats, rules, vs_server), timeout)
+                finished = await asyncio.wait_for(play_bot(conn, strategy, stats, think_time), timeout)
+            except (OSError, EOFError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+                finished = False
+            if finished:
+                stats.finished += 1
+            else:
+                stats.failed += 1
+            if finished and again is not None and conn.version >= protocol.SESSION_VERSION and game + 1 < games:
+                conn.send_again(again)
+            elif conn is not None:
+                conn.close()
+                conn = None
+        if conn is not None:
+            conn.close()
+
+    watchers = [asyncio.ensure_future(watch_bot(host, port, context, watch, stats, done, slow_spectators)) for _ in range(spectators)]
+    start = time.perf_counter()
+    await asyncio.gather(*(session(i) for i in range(sessions)))
+    elapsed = time.perf_counter() - start
+    done.set()
+    for watcher in watchers:
+        watcher.cancel()
+    await asyncio.gather(*watchers, return_exceptions=True)
+    return stats, elapsed
+
+def report(stats, elapsed, players):
+    games = stats.finished / players
+    print(f"{stats.finished + stats.failed} player games in {elapsed:.1f} s, {stats.failed} failed")
+    print(f"{games / elapsed:.1f} games/s")
+    print(f"{'latency':<12} {'p50 ms':>9} {'p99 ms':>9} {'samples':>8}")
+    for name, values in (('handshake', stats.handshake), ('matchmaking', stats.matchmaking), ('move', stats.moves)):
+        print(f"{name:<12} {percentile(values, 0.5) * 1000:>9.1f} {percentile(values, 0.99) * 1000:>9.1f} {len(values):>8}")
+    if stats.spectator_frames:
+        print(f"spectators received {stats.spectator_frames} frames, {stats.spectator_closes} connections closed by the server")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Headless bots and load generator for the game servers")
+    parser.add_argument('--host', default='127.0.0.1', help="server address")
+    parser.add_argument('--port', type=int, default=5050, help="server game port")
+    parser.add_argument('--sessions', type=int, default=100, help="bots playing at the same time")
+    parser.add_argument('--games', type=int, default=1, help="games played by every bot, one after another")
+    parser.add_argument('--strategy', default='random', choices=list(STRATEGIES), help="how bots pick their moves")
+    parser.add_argument('--think-time', type=float, default=0.0, help="mean seconds a bot waits before moving")
+    parser.add_argument('--vs-server', action='store_true', help="bots play against the server instead of each other")
+    parser.add_argument('--rows', type=int, default=3, help="board rows")
+    parser.add_argument('--cols', type=int, default=3, help="board columns")
+    parser.add_argument('--k', type=int, default=3, help="marks in a row that win")
+    parser.add_argument('--timeout', type=float, default=60.0, help="seconds after which a game counts as failed")
+    parser.add_argument('--nickname', default='bot', help="nickname prefix of the bots")
+    parser.add_argument('--again', default='requeue', choices=list(AGAIN), help="what a bot does after a game")
+    parser.add_argument('--spectators', type=int, default=0, help="spectators watching one game while the bots play")
+    parser.add_argument('--slow-spectators', action='store_true', help="spectators stop reading after their first frame")
+    parser.add_argument('--watch', default='', metavar='NICKNAME', help="bot the spectators watch, the most watched game by default")
+    args = parser.parse_args()
+    rules = Rules(args.rows, args.cols, args.k)
+    if not rules.is_valid():
+        parser.error(f"invalid rules {rules}, sides go up to 15 and k up to the longer side")
+    protocol.raise_open_files_limit()
+
+    stats, elapsed = asyncio.run(run_load(args.host, args.port, args.sessions, args.games, STRATEGIES[args.strategy], args.think_time, rules, args.vs_server, args.timeout, args.nickname, AGAIN[args.again], args.spectators, args.slow_spectators, args.watch))
+    report(stats, elapsed, 1 if args.vs_server else 2)
@@ -2,58 +2,57 @@ import socket
 import threading
 import os
 import ssl
+import argparse
+from engine import Board, Rules, STANDARD, render_board
+import protocol
+import discovery
 import socket
 import threading
 import os
 
-FORMAT = 'utf-8' # Format of message
-DISCOVERY_PORT = 5051 # Discovery port that is searched for a listening server
-MULTICAST_GROUP = '224.0.0.1' # Multicast group that is searched for a listening server
-MAX_DISCOVERY_ATTEMPTS = 3  # Maximum number of discovery attempts
-
-def discover_server():
-    # Multicast UDP service discovery handler. Allows client to find a listening server
-    discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    discovery_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
-    discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-
-    message = "DISCOVER_SERVER".encode(FORMAT)
-    attempts = 0
-    while attempts < MAX_DISCOVERY_ATTEMPTS:
-        try:
-            discovery_socket.sendto(message, (MULTICAST_GROUP, DISCOVERY_PORT))
-            discovery_socket.settimeout(2)
-            data, server_address = discovery_socket.recvfrom(1024)
-            server_ip, server_port = data.decode(FORMAT).split(':')
-            print(f"Discovered server {server_ip}:{int(server_port)}. Connecting to it.")
-            return server_ip, int(server_port)
-        except socket.timeout:
-            attempts += 1
-            print("Server discovery timed out. Retrying...")
-    print("Server discovery failed after {} attempts.".format(MAX_DISCOVERY_ATTEMPTS))
-    return None, None
-
-# Set found server info into variables
-SERVER, PORT = discover_server()
-
 class TicTacToeClient:
-    def __init__(self, host=SERVER, port=PORT):
+    def __init__(self, host=None, port=None, text=False, rules=STANDARD):
+        # Without host the server is searched for while the player types the nickname
+        search = discovery.Search() if host is None else None
         # Add securing TCP connection with TLS, but skip server authentication because of self-signed cert
         self.context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
         self.context.check_hostname = False
         self.context.verify_mode = ssl.CERT_NONE
-        self.client_socket = self.context.wrap_socket(socket.socket(socket.AF_INET), server_hostname=host)
-        self.client_socket.connect((host, port))
+        self.text = text
+        self.rules = rules
+        self.session = None # TLS session of the last connection, a reconnect resumes it instead of a full handshake
         self.nickname = input("Enter your nickname: ")
-        self.client_socket.sendall(self.nickname.encode())
-        self.board = [' ' for _ in range(9)]
+        if search is not None:
+            host, port = search.result()
+        self.host = host
+        self.port = port
+        if host is not None:
+            self.connect()
+            discovery.remember(host, port)
+
+    def connect(self):
+        # Open a connection and join a game
+        self.client_socket = self.context.wrap_socket(socket.socket(socket.AF_INET), server_hostname=self.host, session=self.session)
+        self.client_socket.connect((self.host, self.port))
+        # Binary protocol is negotiated unless the text protocol is requested
+        self.conn = None
+        if self.text:
+            self.client_socket.sendall(self.nickname.encode())
+        else:
+            self.conn = protocol.connect(self.client_socket, self.nickname, rules=self.rules)
+        self.board = Board(rules=self.rules)
         self.game_active = True
+        self.choosing = False # Game is over, the next input is the choice of the next game
+        self.rematch = False # Opponent of the last game can be asked for a rematch
 
     def start(self):
         # Start game thread
-        threading.Thread(target=self.receive_messages, daemon=True).start()
+        self.receive()
         self.play_game()
 
+    def receive(self):
+        threading.Thread(target=self.receive_frames if self.conn else self.receive_messages, daemon=True).start()
+
     def receive_messages(self):
         # Reveive messages from a server
         while self.game_active:
@@ -67,29 +66,123 @@ class TicTacToeClient:
                     elif "Game over" in message:
                         os.system('clear')
                         print(message)
-                        self.game_active = False
-                        self.client_socket.close()
-                        os._exit(os.EX_OK)
+                        # Text protocol server closes the connection after every game
+                        self.end_session()
+                        break
                     elif message.endswith("has left the game. Please play another one."):
                         print(message)
-                        os._exit(os.EX_OK)
+                        self.end_session()
+                        break
                     else:
                         print(message)
                 else:
-                    self.client_socket.close()
+                    self.end_session()
                     break
             except Exception as e:
                 print("Error receiving message:", e)
-                self.client_socket.close()
+                self.end_session()
+                break
+
+    def receive_frames(self):
+        # Receive typed messages of the binary protocol from a server
+        while self.game_active:
+            try:
+                msg_type, payload = self.conn.read_frame()
+            except Exception as e:
+                if not self.choosing:
+                    print("Error receiving message:", e)
+                self.end_session()
                 break
+            if msg_type == protocol.JOIN:
+                mark, self.conn.rules, opponent = protocol.parse_join(payload, self.conn.version)
+                self.board = Board(rules=self.conn.rules)
+                if mark is None:
+                    print("Waiting for the second player...")
+                else:
+                    print(f"Game starting! Your opponent is {opponent}. You play {mark}.")
+            elif msg_type == protocol.STATE:
+                self.board, flags, last_move = protocol.parse_state(payload, self.conn.rules, self.conn.version)
+                self.show_board(flags, last_move)
+            elif msg_type == protocol.DELTA:
+                update = protocol.apply_delta(self.board, payload)
+                if update is None:
+                    # Local board missed a move, ask server for a full board
+                    self.conn.send(protocol.RESYNC)
+                elif update[1] is None:
+                    self.prompt()
+                else:
+                    self.show_board(*update)
+            elif msg_type == protocol.RESULT:
+                outcome, nickname = protocol.parse_result(payload)
+                print(protocol.describe_result(outcome, nickname))
+                if self.conn.version < protocol.SESSION_VERSION:
+                    # Older servers close the connection after every game
+                    self.end_session()
+                    break
+                self.rematch = outcome != protocol.OPPONENT_LEFT
+                self.ask()
+            elif msg_type == protocol.ERROR:
+                print(protocol.parse_error(payload)[1])
+
+    def show_board(self, flags, last_move):
+        # Print board received in binary protocol
+        os.system('clear')
+        if last_move is not None:
+            print(f"Move {last_move + 1}" + (" (timeout)" if flags & protocol.TIMEOUT_MOVE else ""))
+        print(render_board(self.board))
+        if flags & protocol.YOUR_TURN:
+            self.prompt()
+
+    def prompt(self):
+        print(f"Your turn! Enter the position (1-{self.board.rules.cells}): ")
+
+    def ask(self):
+        # Ask for the next game after a result
+        self.choosing = True
+        if self.rematch:
+            print("Play again? Enter r for a rematch, n for a new opponent or q to quit: ")
+        else:
+            print("Play again? Enter n for a new opponent or q to quit: ")
+
+    def end_session(self):
+        # Connection is closed, a new game needs a new one. The TLS session is kept to resume it.
+        self.session = self.client_socket.session
+        self.client_socket.close()
+        self.game_active = False
+        self.rematch = False
+        self.ask()
+
+    def choose(self, answer):
+        # Rematch and new opponent continue on the open connection, without one a new connection is made
+        if answer == 'q':
+            self.client_socket.close()
+            os._exit(os.EX_OK)
+        if answer == 'r' and self.rematch:
+            choice = protocol.REMATCH
+        elif answer == 'n':
+            choice = protocol.REQUEUE
+        else:
+            print("Invalid choice. Try again.")
+            return
+        self.choosing = False
+        if self.game_active:
+            self.conn.send_again(choice)
+        else:
+            self.connect()
+            self.receive()
 
     def play_game(self):
         # Main function with logic that handles game
-        while self.game_active:
+        while True:
             try:
                 move = input()
-                if move.isdigit() and 1 <= int(move) <= 9 and self.board[int(move) - 1] == ' ':
-                    self.client_socket.sendall(move.encode())
+                if self.choosing:
+                    self.choose(move.strip().lower())
+                elif move.isdigit() and self.board.is_free(int(move) - 1):
+                    if self.conn:
+                        self.conn.send(protocol.MOVE, bytes([int(move) - 1]))
+                    else:
+                        self.client_socket.sendall(move.encode())
                 else:
                     print("Invalid move. Try again.")
             except Exception as e:
@@ -99,9 +192,20 @@ class TicTacToeClient:
 
     def update_board(self, move):
         # Update current game board
-        symbol = 'X' if self.board.count('X') <= self.board.count('O') else 'O'
-        self.board[move] = symbol
+        self.board.play(move, self.board.next_mark())
 
 if __name__ == "__main__":
-    client = TicTacToeClient()
-    client.start()
+    parser = argparse.ArgumentParser(description="Tic-tac-toe client")
+    parser.add_argument('--text', action='store_true', help="use the text protocol instead of negotiating the binary one")
+    parser.add_argument('--rows', type=int, default=3, help="board rows")
+    parser.add_argument('--cols', type=int, default=3, help="board columns")
+    parser.add_argument('--k', type=int, default=3, help="marks in a row that win")
+    args = parser.parse_args()
+    rules = Rules(args.rows, args.cols, args.k)
+    if not rules.is_valid():
+        parser.error(f"invalid rules {rules}, sides go up to 15 and k up to the longer side")
+    if args.text and not rules.standard:
+        parser.error("other board sizes need the binary protocol")
+    client = TicTacToeClient(text=args.text, rules=rules)
+    if client.host is not None:
+        client.start()
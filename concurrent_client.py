@@ -1,57 +1,169 @@
 import socket
 import ssl
 import os
+import argparse
+from engine import Board, Rules, STANDARD, parse_board, render_board
+import protocol
+import discovery
 
-FORMAT = 'utf-8' # Format of message
-DISCOVERY_PORT = 5051 # Discovery port that is searched for a listening server
-MULTICAST_GROUP = '224.0.0.1' # Multicast group that is searched for a listening server
-MAX_DISCOVERY_ATTEMPTS = 3  # Maximum number of discovery attempts
-
-def discover_server():
-    # Multicast UDP service discovery handler. Allows client to find a listening server
-    discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    discovery_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
-    discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+def choose_next_game(rematch):
+    # Ask player what comes after a game: REMATCH, REQUEUE or None to quit
+    options = "[r]ematch, [n]ew opponent or [q]uit" if rematch else "[n]ew opponent or [q]uit"
+    while True:
+        answer = input(f"Play again? {options}: ").strip().lower()
+        if answer == 'r' and rematch:
+            return protocol.REMATCH
+        if answer == 'n':
+            return protocol.REQUEUE
+        if answer == 'q':
+            return None
 
-    message = "DISCOVER_SERVER".encode(FORMAT)
-    attempts = 0
-    while attempts < MAX_DISCOVERY_ATTEMPTS:
+def play_frames(conn):
+    # Game loop of the binary protocol. Games continue on the same connection, returns True when
+    # the player wants another game and the connection has to be opened again.
+    board = Board()
+    choice = None # Choice sent after the last result until the next game is found
+    while True:
         try:
-            discovery_socket.sendto(message, (MULTICAST_GROUP, DISCOVERY_PORT))
-            discovery_socket.settimeout(2)
-            data, server_address = discovery_socket.recvfrom(1024)
-            server_ip, server_port = data.decode(FORMAT).split(':')
-            print(f"Discovered server {server_ip}:{int(server_port)}. Connecting to it.")
-            return server_ip, int(server_port)
-        except socket.timeout:
-            attempts += 1
-            print("Server discovery timed out. Retrying...")
-    print(f"Server discovery failed after {MAX_DISCOVERY_ATTEMPTS} attempts.")
-    return None, None
+            msg_type, payload = conn.read_frame()
+            if msg_type == protocol.JOIN:
+                mark, conn.rules, opponent = protocol.parse_join(payload, conn.version)
+                choice = None
+                if mark is None:
+                    print("Waiting for another player...")
+                else:
+                    print(f"Your opponent is {opponent}, you play {mark}.")
+            elif msg_type in (protocol.STATE, protocol.DELTA):
+                if msg_type == protocol.STATE:
+                    board, flags, _ = protocol.parse_state(payload, conn.rules, conn.version)
+                else:
+                    update = protocol.apply_delta(board, payload)
+                    if update is None:
+                        # Local board missed a move, ask server for a full board
+                        conn.send(protocol.RESYNC)
+                        continue
+                    flags = update[0]
+                os.system('clear')
+                print(render_board(board))
+                if flags & protocol.YOUR_TURN:
+                    print(f"Your move ({board.next_mark()}): ")
+                    prompt = f"Enter your move (0-{board.rules.cells - 1}): "
+                    move = input(prompt)
+                    while not (move.isdigit() and board.is_free(int(move))):
+                        print("Invalid move. Try again.")
+                        move = input(prompt)
+                    conn.send(protocol.MOVE, bytes([int(move)]))
+            elif msg_type == protocol.RESULT:
+                outcome, nickname = protocol.parse_result(payload)
+                print(protocol.describe_result(outcome, nickname))
+                # Older servers close the connection after every game
+                session = conn.version >= protocol.SESSION_VERSION
+                choice = choose_next_game(session and outcome != protocol.OPPONENT_LEFT)
+                if choice is None or not session:
+                    return choice is not None
+                conn.send_again(choice)
+            elif msg_type == protocol.ERROR:
+                print(protocol.parse_error(payload)[1])
+        except Exception as e:
+            if choice is not None:
+                # Session ended before the next game was found
+                print("Connection closed by server, reconnecting...")
+                return True
+            print("Error receiving message:", e)
+            return False
 
-# Set found server info into variables
-SERVER, PORT = discover_server()
+def watch_frames(conn):
+    # Show the games of a watched session until the server closes the connection
+    board = Board()
+    watching = ''
+    while True:
+        try:
+            msg_type, payload = conn.read_frame()
+        except Exception:
+            print("Connection closed by server.")
+            return
+        if msg_type == protocol.WATCH:
+            conn.rules, nickname_x, nickname_o = protocol.parse_watch(payload)
+            board = Board(rules=conn.rules)
+            watching = f"Watching {nickname_x} (X) against {nickname_o} (O)."
+            print(watching)
+        elif msg_type in (protocol.STATE, protocol.DELTA):
+            if msg_type == protocol.STATE:
+                board = protocol.parse_state(payload, conn.rules, conn.version)[0]
+            elif protocol.apply_delta(board, payload) is None:
+                # Move the snapshot after a lag already showed
+                continue
+            os.system('clear')
+            print(watching)
+            print(render_board(board))
+        elif msg_type == protocol.RESULT:
+            outcome, nickname = protocol.parse_result(payload)
+            print(f"{nickname or 'A player'} has left the game." if outcome == protocol.OPPONENT_LEFT else protocol.describe_result(outcome, nickname))
+        elif msg_type == protocol.ERROR:
+            print(protocol.parse_error(payload)[1])
+            return
 
-def play():
-    if SERVER == None and PORT == None:
-        return
+def watch(nickname):
+    # Watch the games of the player with nickname, of the most watched session for an empty one
+    search = discovery.Search()
     context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
     context.check_hostname = False
     context.verify_mode = ssl.CERT_NONE
-    client = context.wrap_socket(socket.socket(socket.AF_INET), server_hostname=SERVER)
-
-    client.connect((SERVER, PORT))
+    server, port = search.result()
+    if server is None:
+        return
+    client = context.wrap_socket(socket.socket(socket.AF_INET), server_hostname=server)
+    client.connect((server, port))
+    conn = protocol.connect(client, nickname, spectate=True)
+    if conn.version < protocol.WATCH_VERSION:
+        print("Server does not support spectators.")
+    else:
+        watch_frames(conn)
+    client.close()
 
+def play(text=False, vs_server=False, rules=STANDARD):
+    # Server is searched for while the player types the nickname
+    search = discovery.Search()
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
     nickname = input("Enter your nickname: ")
+    server, port = search.result()
+    if server is None:
+        return
+    session = None # TLS session of the last connection, a reconnect resumes it instead of a full handshake
+    again = True
+    while again:
+        client = context.wrap_socket(socket.socket(socket.AF_INET), server_hostname=server, session=session)
+        client.connect((server, port))
+        if session is None:
+            discovery.remember(server, port)
+        # Binary protocol is negotiated unless the text protocol is requested
+        if text:
+            again = play_text(client, nickname)
+        else:
+            again = play_frames(protocol.connect(client, nickname, vs_server=vs_server, rules=rules))
+        session = client.session
+        client.close()
+
+def play_text(client, nickname):
+    # Game loop of the text protocol, the server closes the connection after every game.
+    # Returns True when the player wants another game.
     client.sendall(nickname.encode())
 
+    board = Board()
     while True:
         try:
             response = client.recv(4096).decode()
             if not response: break
+            board = parse_board(response) or board
             if "Your move" in response:
                 print(response)
                 move = input("Enter your move (0-8): ")
+                # Check move against the last board locally, taken cells do not cost a round trip
+                while not (move.isdigit() and board.is_free(int(move))):
+                    print("Invalid move. Try again.")
+                    move = input("Enter your move (0-8): ")
                 client.send(move.encode())
             else:
                 if "wins" not in response and "draw" not in response and "has left the game" not in response:
@@ -59,12 +171,27 @@ def play():
                     print(response)
                 else:
                     print(response)
-                    break
+                    return choose_next_game(False) is not None
         except Exception as e:
             print("Error receiving message:", e)
-            break
-
-    client.close()
+            return False
+    return False
 
 if __name__ == "__main__":
-    play()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Tic-tac-toe client")
+    parser.add_argument('--text', action='store_true', help="use the text protocol instead of negotiating the binary one")
+    parser.add_argument('--vs-server', action='store_true', help="play against the server instead of another player (binary protocol only)")
+    parser.add_argument('--rows', type=int, default=3, help="board rows")
+    parser.add_argument('--cols', type=int, default=3, help="board columns")
+    parser.add_argument('--k', type=int, default=3, help="marks in a row that win")
+    parser.add_argument('--watch', nargs='?', const='', metavar='NICKNAME', help="watch the games of a player instead of playing, the most watched game without a nickname")
+    args = parser.parse_args()
+    rules = Rules(args.rows, args.cols, args.k)
+    if not rules.is_valid():
+        parser.error(f"invalid rules {rules}, sides go up to 15 and k up to the longer side")
+    if args.text and (args.vs_server or not rules.standard):
+        parser.error("--vs-server and other board sizes need the binary protocol")
+    if args.watch is not None:
+        watch(args.watch)
+    else:
+        play(text=args.text, vs_server=args.vs_server, rules=rules)
\ No newline at end of file
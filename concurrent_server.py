@@ -1,12 +1,33 @@
 import socket
 import threading
+import os
 import ssl
 import logging
-import atexit
-import os
-import json
+import asyncio
+import asyncio.sslproto
+import concurrent.futures
+import argparse
+import bisect
+import itertools
+import tempfile
+import time
 from datetime import datetime
-from flask import Flask, render_template
+from flask import Flask
+from engine import Board, STANDARD, render_board
+import protocol
+import store
+import leaderboard
+import pagecache
+import solver
+import workers
+import discovery
+import metrics
+import spectators
+import live
+import recording
+import ratings
+import timers
+import routes
 
 def get_server_ip():
     # Get server IP address by connecting to Google DNS server. If cannot connect, return localhost address
@@ -24,221 +45,718 @@ def get_server_ip():
 SERVER = get_server_ip() # Server IP
 PORT = 5050 # Server game port
 ADDR = (SERVER, PORT) # Server game IP and port
-FORMAT = 'utf-8' # Messages format
-DISCOVERY_PORT = 5051 # Discovery port that server is listening on
-MULTICAST_GROUP = '224.0.0.1' # Discovery multicast group that server is listening on
+CERT_DIR = os.path.dirname(os.path.abspath(__file__)) # sample_cert.pem and sample_key.pem are next to the server, whatever the working directory
+ASYNC_BACKLOG = 4096 # Listen backlog of asyncio server, big enough for bursts of thousands of connections
+LISTEN_BACKLOG = 128 # Listen backlog of threaded server, accepted sockets are handed over to the lobby right away
+SERVER_NICKNAME = 'server' # Nickname of the opponent played by the server
+LOBBY_TIMEOUT = 10.0 # Seconds a new connection gets to finish TLS handshake and send its nickname
+ASYNC_SSL_READ_SIZE = 16 * 1024 # TLS read buffer per asyncio connection, one full TLS record (asyncio default is 256 KiB)
+HAND_BACK = -1 # Answer of WorkerLobby.join for a relayed player without an opponent in this worker
+REMATCH_TIMEOUT = 30.0 # Seconds a player gets after a result to ask for a rematch or a new opponent
+DASHBOARD_PORT = 5000 # Port of the web dashboard
+METRICS_PORT = 5001 # Port of /metrics when the dashboard runs in its own process on DASHBOARD_PORT
+CAPACITY = 1000 # Players one server process is sized for, discovery replies report it to clients choosing a server
+
+def discovery_load():
+    # Active games, waiting players and capacity for discovery replies, in worker mode added up over all workers
+    snapshots = list(worker_metrics.values())
+    return metrics.total(metrics.ACTIVE_GAMES, snapshots), metrics.total(metrics.WAITING_PLAYERS, snapshots), capacity
 
 def handle_discovery():
-    # Multicast UDP service discovery handler. Allows clients on the network to discover the server's address by sending a multicast message "DISCOVER_SERVER".
-    discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    discovery_socket.bind(('', DISCOVERY_PORT))
-    group = socket.inet_aton(MULTICAST_GROUP)
-    mreq = group + socket.inet_aton('0.0.0.0')
-    discovery_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-    while True:
-        data, addr = discovery_socket.recvfrom(1024)
-        if data.decode(FORMAT) == "DISCOVER_SERVER":
-            discovery_socket.sendto(f"{SERVER}:{PORT}".encode(FORMAT), addr)
+    # Multicast UDP service discovery handler. Allows clients on the network to discover the server's address and load.
+    discovery.serve(SERVER, PORT, discovery_load)
 
 # Start discovery service as a separate thread
 discovery_thread = threading.Thread(target=handle_discovery, daemon=True)
 discovery_thread.start()
 
-def load_history():
-    # Load history variable from history.json   
-    if not os.path.exists('history.json'):
-        with open('history.json', 'w') as file:
-            json.dump([], file)
-    with open('history.json', 'r') as file:
-        return json.load(file)
-
-def load_scoreboard():
-    # Load scoreboard variable from scoreboard.json
-    if not os.path.exists('scoreboard.json'):
-        with open('scoreboard.json', 'w') as file:
-            json.dump([], file)
-    with open('scoreboard.json', 'r') as file:
-        return json.load(file)
-
-def save_history(historyf):
-    # Save current history to history.json
-    with open('history.json', 'w') as file:
-        json.dump(history, file, indent=4)
-
-def save_scoreboard(scoreboard):
-    # Save current scoreboard to scoreboard.json
-    with open('scoreboard.json', 'w') as file:
-        json.dump(scoreboard, file, indent=4)
-
-# load global variables
-scoreboard = load_scoreboard()
-history = load_history()
+# load global variables, scoreboard.json and history.json are imported into the store on first start
+scores = store.open_store()
+ranking = leaderboard.Leaderboard(scores.scoreboard()) # Ranked copy of the scoreboard for the dashboard
+history = store.open_history()
+games = recording.GameLog() # Moves of every finished game
+pages = pagecache.PageCache() # Rendered dashboard pages, invalidated by every result
+updates = live.Broadcaster(ranking.query, history) # Pushes new results to open dashboard pages
+results = None # Queue to the supervisor in worker processes, which record no results themselves
+worker_metrics = {} # Latest metrics snapshot of every worker process by worker number, kept by the supervisor
+capacity = CAPACITY # Players all server processes together are sized for
+watchers = None # Sessions spectators can watch by nickname of their players, set when the server starts
+recorder = None # Thread writing the results of asyncio games in order, set when the asyncio server starts
+deadlines = timers.TimerWheel() # Lobby and rematch timeouts of threaded servers, asyncio servers use the event loop's timers
+
+class TextConnection(protocol.Connection):
+    # Text protocol spoken by concurrent_client, kept for clients that do not negotiate the binary protocol
+    def send_text(self, string):
+        self.write(string.encode())
+
+    def parse_move(self, data):
+        # Any cell number, the board checks that it is on the board and free
+        client_message = data.decode()
+        if not client_message.isdigit():
+            return None
+        return int(client_message)
+
+    def send_waiting(self):
+        self.send_text("Waiting for another player...")
+
+    def send_start(self, mark, opponent):
+        # Text clients learn that the game started from the first board
+        pass
+
+    def send_board(self, board, last_move=None, timeout=False, your_turn=False):
+        # Prompt of the player on turn goes out with the board in one write
+        if your_turn:
+            self.send_text(render_board(board) + f"Your move ({board.next_mark()}): ")
+        else:
+            self.send_text(render_board(board))
+
+    def send_prompt(self, board, mark):
+        self.send_text(f"Your move ({mark}): ")
+
+    def send_invalid(self):
+        self.send_text("Invalid move. Try again.")
+
+    def send_win(self, mark, winner):
+        self.send_text(f"{mark} ({winner}) wins!")
+
+    def send_draw(self):
+        self.send_text("It's a draw!")
+
+    def send_left(self, nickname):
+        self.send_text(f"Your opponent {nickname} has left the game. Please play another one.")
+
+class ServerPlayer(protocol.Connection):
+    # Opponent played by the server from the solver table, takes the place of the second player's connection
+    def __init__(self):
+        super().__init__()
+        self.board = Board()
+
+    def send_board(self, board, last_move=None, timeout=False, your_turn=False):
+        self.board = board
+
+    def read_move(self):
+        return solver.best_move(self.board)
+
+    async def read_move_async(self):
+        return solver.best_move(self.board)
+
+    def read_choice(self, timeout=None):
+        # Server always accepts a rematch
+        return protocol.REMATCH
+
+    async def read_choice_async(self, timeout=None):
+        return protocol.REMATCH
+
+    def ignore(self, *args):
+        pass
+
+    send_waiting = send_start = send_prompt = send_invalid = send_win = send_draw = send_left = close = ignore
+
+def record_game(game, winner=None, loser=None):
+    # Keep the moves of a finished game, a win also counts on the scoreboard unless it was against the server
+    if SERVER_NICKNAME in (winner, loser):
+        winner = loser = None
+    update_results(winner, loser, game=game)
+
+async def record_game_async(game, winner=None, loser=None):
+    # record_game() on the recorder thread, its SQLite and log writes would hold up every game of the event loop
+    await asyncio.get_running_loop().run_in_executor(recorder, record_game, game, winner, loser)
+
+def game_started(conn_1, conn_2):
+    # Matchmaking wait of players coming from the lobby, rematches start without one
+    now = time.perf_counter()
+    for conn in (conn_1, conn_2):
+        if conn.queued is not None:
+            metrics.MATCHMAKING.observe(now - conn.queued)
+            conn.queued = None
+    metrics.ACTIVE_GAMES.add(1)
 
 # Function to handle a single game session
-def handle_game(client_socket_1, nickname_1, client_socket_2, nickname_2):
-    board = [' ' for _ in range(9)]
+def handle_game(conn_1, nickname_1, conn_2, nickname_2, channel):
+    # Spectators get the game from channel, which never waits for them
+    board = Board(rules=conn_1.rules)
+    game = recording.Game(nickname_1, nickname_2, board.rules)
     player = 'X'
+    game_started(conn_1, conn_2)
+    channel.start(nickname_1, nickname_2, board)
+    try:
+        conn_1.send_start('X', nickname_2)
+        conn_2.send_start('O', nickname_1)
+    except Exception:
+        pass
 
-    def print_board():
-        board_display = ""
-        for i in range(3):
-            row = " | ".join(board[i * 3: (i + 1) * 3])
-            board_display += f"{row}\n"
-            if i < 2:
-                board_display += "--+---+--\n"
-        send_string_to_both_clients(board_display)
-
-    def check_win(player):
-        win_conditions = [(0, 1, 2), (3, 4, 5), (6, 7, 8), (0, 3, 6), (1, 4, 7), (2, 5, 8), (0, 4, 8), (2, 4, 6)]
-        return any(board[a] == board[b] == board[c] == player for a, b, c in win_conditions)
+    last_move = None
 
-    def send_string_to_both_clients(string):
-        client_socket_1.send(string.encode())
-        client_socket_2.send(string.encode())
+    def print_board(to_move=None):
+        conn_1.send_board(board, last_move, your_turn=to_move == 'X')
+        conn_2.send_board(board, last_move, your_turn=to_move == 'O')
+        channel.send_board(board, last_move)
 
     while True:
         try:
-            if hasattr(client_socket_2, 'raddr'):
-                print(client_socket_2)
-            if hasattr(client_socket_1, 'raddr'):
-                print(client_socket_1)
-            print_board()
+            print_board(player)
             if player == 'X':
-                client_socket = client_socket_1
+                conn = conn_1
             else:
-                client_socket = client_socket_2
-
-            client_socket.send(f"Your move ({player}): ".encode())
+                conn = conn_2
 
-            client_message = client_socket.recv(1024).decode()
+            prompted = time.perf_counter()
+            move = conn.read_move()
+            if not isinstance(conn, ServerPlayer):
+                metrics.MOVE.observe(time.perf_counter() - prompted)
 
-            if client_message not in ['0', '1', '2', '3', '4', '5', '6', '7', '8']:
-                client_socket.send("Invalid move. Try again.".encode())
+            if move is None or not board.is_free(move):
+                conn.send_invalid()
             else:
-                move = int(client_message)
-                if board[move] == ' ':
-                    board[move] = player
-                    if check_win(player):
-                        print_board()
-                        if player == 'X':
-                            winner, loser = nickname_1, nickname_2
-                        else:
-                            winner, loser = nickname_2, nickname_1
-                        update_results(winner, loser)    
-                        send_string_to_both_clients(f"{player} ({winner}) wins!")
-                        break
-                    elif ' ' not in board:
-                        print_board()
-                        send_string_to_both_clients("It's a draw!")
-                        break
-                    player = 'O' if player == 'X' else 'X'
-                else:
-                    client_socket.send("Invalid move. Try again.".encode())
+                board.play(move, player)
+                game.play(move)
+                last_move = move
+                if board.wins_at(move, player):
+                    print_board()
+                    if player == 'X':
+                        winner, loser = nickname_1, nickname_2
+                    else:
+                        winner, loser = nickname_2, nickname_1
+                    record_game(game.finish(recording.won_by(player)), winner, loser)
+                    channel.send_win(player, winner)
+                    conn_1.send_win(player, winner)
+                    conn_2.send_win(player, winner)
+                    break
+                elif board.is_full():
+                    print_board()
+                    record_game(game.finish(recording.DRAW))
+                    channel.send_draw()
+                    conn_1.send_draw()
+                    conn_2.send_draw()
+                    break
+                player = 'O' if player == 'X' else 'X'
 
         except Exception as e:
             logging.error(f"{e} error occurred. Connection closed by client.")
-            try:
-                print(client_socket_1.getpeername())
-                client_socket_1.send(f"Your opponent {nickname_2} has left the game. Please play another one.".encode())
-            except:
-                pass
-            
-            try:
-                print(client_socket_2.getpeername())
-                client_socket_2.send(f"Your opponent {nickname_1} has left the game. Please play another one.".encode())
-            except:
-                pass                
-            
+            if game.result is None:
+                # Sending the result of a recorded game can fail too
+                record_game(game.finish(recording.left_by(player)))
+            channel.send_left()
+            for conn, opponent in ((conn_1, nickname_2), (conn_2, nickname_1)):
+                try:
+                    conn.send_left(opponent)
+                except:
+                    pass
             break
+    metrics.ACTIVE_GAMES.add(-1)
+
+# Asyncio counterpart of handle_game, runs the same rules and protocols without a thread per game
+async def handle_game_async(conn_1, nickname_1, conn_2, nickname_2, channel):
+    board = Board(rules=conn_1.rules)
+    game = recording.Game(nickname_1, nickname_2, board.rules)
+    player = 'X'
+    game_started(conn_1, conn_2)
+    channel.start(nickname_1, nickname_2, board)
+    conn_1.send_start('X', nickname_2)
+    conn_2.send_start('O', nickname_1)
+
+    async def drain():
+        await asyncio.gather(conn_1.drain(), conn_2.drain())
+
+    last_move = None
+
+    async def print_board(to_move=None):
+        conn_1.send_board(board, last_move, your_turn=to_move == 'X')
+        conn_2.send_board(board, last_move, your_turn=to_move == 'O')
+        channel.send_board(board, last_move)
+        await drain()
 
-    client_socket_1.close()
-    client_socket_2.close()
-    
-def update_results(winner, loser):
-    # Update current results available on flask app
-    found = False
-    # Add point for a winner
-    for entry in scoreboard:
-        if entry['nickname'] == winner:
-            logging.info(f"+1 point for {winner}.")
-            entry['score'] += 1
-            found = True
+    while True:
+        try:
+            await print_board(player)
+            if player == 'X':
+                conn = conn_1
+            else:
+                conn = conn_2
+
+            prompted = time.perf_counter()
+            move = await conn.read_move_async()
+            if not isinstance(conn, ServerPlayer):
+                metrics.MOVE.observe(time.perf_counter() - prompted)
+
+            if move is None or not board.is_free(move):
+                conn.send_invalid()
+            else:
+                board.play(move, player)
+                game.play(move)
+                last_move = move
+                if board.wins_at(move, player):
+                    await print_board()
+                    if player == 'X':
+                        winner, loser = nickname_1, nickname_2
+                    else:
+                        winner, loser = nickname_2, nickname_1
+                    await record_game_async(game.finish(recording.won_by(player)), winner, loser)
+                    channel.send_win(player, winner)
+                    conn_1.send_win(player, winner)
+                    conn_2.send_win(player, winner)
+                    await drain()
+                    break
+                elif board.is_full():
+                    await print_board()
+                    await record_game_async(game.finish(recording.DRAW))
+                    channel.send_draw()
+                    conn_1.send_draw()
+                    conn_2.send_draw()
+                    await drain()
+                    break
+                player = 'O' if player == 'X' else 'X'
+
+        except Exception as e:
+            logging.error(f"{e} error occurred. Connection closed by client.")
+            if game.result is None:
+                # Sending the result of a recorded game can fail too
+                await record_game_async(game.finish(recording.left_by(player)))
+            channel.send_left()
+            for conn, opponent in ((conn_1, nickname_2), (conn_2, nickname_1)):
+                try:
+                    conn.send_left(opponent)
+                    await conn.drain()
+                except Exception:
+                    pass
             break
-    if not found:
-        logging.info(f"Adding new player: {winner}.")
-        scoreboard.append({'nickname': winner, 'score': 1})
-    
-    # Remove point for a loser
-    for entry in scoreboard:
-        if entry['nickname'] == loser:
-            logging.info(f"-1 point for {loser}.")
-            entry['score'] -= 1
+    metrics.ACTIVE_GAMES.add(-1)
+
+def update_results(winner, loser, date=None, game=None):
+    # Update current results available on flask app, the moves of game are recorded first. Only the moves
+    # are kept of games without a winner.
+    date = date or datetime.today().strftime('%Y-%m-%d %H:%M:%S')
+    if results is not None:
+        # Worker process, the supervisor records results of all workers
+        results.put((winner, loser, date, game))
+        return
+    game_id = None
+    if game is not None:
+        game_id = metrics.timed(metrics.GAMES_WRITE, games.append, game)
+        if ratings.rated(game):
+            # Wins and draws change the ratings of both players
+            metrics.timed(metrics.RATINGS_WRITE, scores.record_rating, game.x, game.o, ratings.SCORES[game.result], ratings.update)
+            if winner is None:
+                pages.bump()
+    if winner is None:
+        return
+    # Points of both players are committed at once, a crash right after the game keeps them
+    metrics.timed(metrics.SCORES_WRITE, scores.record_result, winner, loser)
+    ranking.record_result(winner, loser)
 
     # Update history
     game_result = {
         'nicknames': f"{winner}-{loser}",
         'winner': winner,
-        'date': datetime.today().strftime('%Y-%m-%d %H:%M:%S')
+        'date': date
     }
-    history.append(game_result)
+    if game_id is not None:
+        game_result['game'] = game_id
+    position = metrics.timed(metrics.HISTORY_WRITE, history.append, game_result)
+    pages.bump()
+    updates.record(game_result, position)
+
+def get_score(nickname):
+    # Current score of a player, 0 for players without results. Workers read the store the supervisor writes.
+    if results is not None:
+        return scores.score(nickname)
+    return ranking.score(nickname)
+
+class Lobby:
+    # Matchmaking queue of players that finished handshake and sent their nickname.
+    # A joining player is paired right away with a waiting one, with the closest score if by_score is set.
+    def __init__(self, by_score=False):
+        self.by_score = by_score
+        self.lock = metrics.TimedLock(metrics.LOBBY_LOCK)
+        self.waiting = {} # Rules to (score, arrival, player) list sorted by score when by_score, by arrival otherwise
+        self.arrivals = itertools.count()
+
+    def join(self, player, nickname, rules=STANDARD):
+        # Return waiting opponent paired with player, or None if player has to wait.
+        # Players are only paired with players asking for the same rules.
+        entry = (get_score(nickname) if self.by_score else 0, next(self.arrivals), player)
+        opponent = self.pair(player, entry, rules)
+        if opponent is not None:
+            return opponent
+        # Told before the player is queued, so it never races the start of the game, and without the lock,
+        # so a client that does not read never holds up matchmaking
+        try:
+            player[0].send_waiting()
+        except Exception:
+            pass
+        return self.pair(player, entry, rules, queue=True)
+
+    def pair(self, player, entry, rules, queue=False):
+        # Take the opponent waiting for player out of the queue. Without one, player is queued if queue is set
+        # and None is returned.
+        with self.lock:
+            waiting = self.waiting.setdefault(rules, [])
+            if not waiting:
+                if queue:
+                    waiting.append(entry)
+                return None
+            index = 0
+            if self.by_score:
+                index = bisect.bisect_left(waiting, entry[:2])
+                if index == len(waiting) or (index > 0 and entry[0] - waiting[index - 1][0] <= waiting[index][0] - entry[0]):
+                    index -= 1
+            return waiting.pop(index)[2]
+
+    def waiting_players(self):
+        # Players waiting for an opponent with any rules
+        return sum(len(waiting) for waiting in list(self.waiting.values()))
+
+class Rematch:
+    # Choices of both players after a game. A player asking for a rematch waits for the opponent's choice,
+    # when the opponent goes back to matchmaking or leaves, the player goes back to matchmaking too.
+    def __init__(self, players):
+        self.players = players # (connection, nickname) of X and O of the finished game
+        self.choices = {} # Choice by player index, None for a player that left
+        self.lock = threading.Lock()
+
+    def choose(self, index, choice):
+        # Record choice of a player. Returns players of the rematch with swapped marks (or None)
+        # and players that go back to matchmaking now.
+        with self.lock:
+            self.choices[index] = choice
+            other = 1 - index
+            if other not in self.choices:
+                return None, [self.players[index]] if choice == protocol.REQUEUE else []
+            if choice == self.choices[other] == protocol.REMATCH:
+                return (self.players[1], self.players[0]), []
+            requeued = [self.players[index]] if choice is not None else []
+            if self.choices[other] == protocol.REMATCH:
+                requeued.append(self.players[other])
+            return None, requeued
+
+def enter_lobby(conn, nickname, lobby):
+    # Matchmaking of a player with an open connection. Returns players of the game to start, X first,
+    # or None when the player waits for an opponent.
+    if isinstance(conn, ServerPlayer):
+        # Server player only plays rematches, every new game gets its own
+        return None
+    if conn.vs_server:
+        return (conn, nickname), (ServerPlayer(), SERVER_NICKNAME)
+    conn.queued = time.perf_counter()
+    opponent = lobby.join((conn, nickname), nickname, conn.rules)
+    if opponent == HAND_BACK:
+        conn.close()
+        return None
+    if isinstance(opponent, int):
+        # Opponent waits in another worker process
+        if conn.sock is not None:
+            threading.Thread(target=relay_player, args=(conn, nickname, lobby, opponent), daemon=True).start()
+        else:
+            keep_task(asyncio.create_task(relay_player_async(conn, nickname, lobby, opponent)))
+        return None
+    if opponent is None:
+        return None
+    return opponent, (conn, nickname)
+
+def relay_player(conn, nickname, lobby, worker):
+    # Player plays in another worker, a player handed back joins the lobby here again
+    if workers.relay(conn, nickname, lobby.worker.relay_path(worker)):
+        start_session(enter_lobby(conn, nickname, lobby), lobby)
+
+async def relay_player_async(conn, nickname, lobby, worker):
+    if await workers.relay_async(conn, nickname, lobby.worker.relay_path(worker)):
+        start_session_async(enter_lobby(conn, nickname, lobby), lobby)
+
+def start_session(players, lobby):
+    # Start a new thread for each game session
+    if players is not None:
+        threading.Thread(target=handle_session, args=(*players[0], *players[1], lobby)).start()
+
+def await_choice(rematch, index, lobby):
+    # Read choice of one player after a game, returns players of the rematch if this choice decided it
+    conn, nickname = rematch.players[index]
+    if conn.sock is None:
+        # Server player chooses right away
+        choice = conn.read_choice()
+    else:
+        # A player that does not choose within REMATCH_TIMEOUT is cut off by the timer wheel
+        deadline = deadlines.schedule(REMATCH_TIMEOUT, timers.interrupt, conn.sock)
+        choice = conn.read_choice()
+        if not deadline.cancel():
+            choice = None
+    if choice is None:
+        conn.close()
+    players, requeued = rematch.choose(index, choice)
+    for player in requeued:
+        start_session(enter_lobby(*player, lobby), lobby)
+    return players
+
+def handle_session(conn_1, nickname_1, conn_2, nickname_2, lobby):
+    # Games of two players over connections that stay open: a rematch starts right away with swapped marks,
+    # a player going back to matchmaking keeps the connection too, so repeat games need no new handshake
+    players = ((conn_1, nickname_1), (conn_2, nickname_2))
+    channel = watchers.open(nickname_1, nickname_2)
+    while players is not None:
+        handle_game(*players[0], *players[1], channel)
+        rematch = Rematch(players)
+        found = [None, None]
+        def choose(index):
+            found[index] = await_choice(rematch, index, lobby)
+        # Both players choose at the same time
+        other = threading.Thread(target=choose, args=(1,), daemon=True)
+        other.start()
+        choose(0)
+        other.join()
+        players = found[0] or found[1]
+    watchers.close(channel)
+
+session_tasks = set() # Asyncio sessions of requeued players and relays, referenced until they finish
+
+def keep_task(task):
+    session_tasks.add(task)
+    task.add_done_callback(session_tasks.discard)
+
+def start_session_async(players, lobby):
+    if players is not None:
+        keep_task(asyncio.create_task(handle_session_async(*players[0], *players[1], lobby)))
+
+async def await_choice_async(rematch, index, lobby):
+    conn, nickname = rematch.players[index]
+    choice = await conn.read_choice_async(REMATCH_TIMEOUT)
+    if choice is None:
+        conn.close()
+        try:
+            await conn.writer.wait_closed()
+        except Exception:
+            pass
+    players, requeued = rematch.choose(index, choice)
+    for player in requeued:
+        start_session_async(enter_lobby(*player, lobby), lobby)
+    return players
+
+async def handle_session_async(conn_1, nickname_1, conn_2, nickname_2, lobby):
+    # Asyncio counterpart of handle_session
+    players = ((conn_1, nickname_1), (conn_2, nickname_2))
+    channel = watchers.open(nickname_1, nickname_2)
+    while players is not None:
+        await handle_game_async(*players[0], *players[1], channel)
+        rematch = Rematch(players)
+        found = await asyncio.gather(await_choice_async(rematch, 0, lobby), await_choice_async(rematch, 1, lobby))
+        players = found[0] or found[1]
+    watchers.close(channel)
 
-def on_exit(scoreboard, history):
-    save_scoreboard(scoreboard)
-    save_history(history)
+class WorkerLobby(Lobby):
+    # Lobby of one worker process. At most one player per rules waits in all workers together, the shared
+    # registry tells which worker holds that player.
+    def __init__(self, worker, by_score=False):
+        super().__init__(by_score)
+        self.worker = worker
 
-def start_server():
+    def pair(self, player, entry, rules, queue=False):
+        # Like Lobby.pair, or the number of the worker to relay player to when the opponent waits there.
+        # Relayed players only meet a waiting opponent, otherwise HAND_BACK sends them back to their worker.
+        registry = self.worker.registry
+        with registry.lock:
+            owner = registry.owner(rules)
+            if not self.waiting.get(rules):
+                if player[0].relayed:
+                    return HAND_BACK
+                if owner not in (None, self.worker.number):
+                    registry.release(rules)
+                    return owner
+            opponent = super().pair(player, entry, rules, queue)
+            if opponent is None and queue and owner is None:
+                registry.claim(rules, self.worker.number)
+            elif opponent is not None and owner == self.worker.number:
+                registry.release(rules)
+            return opponent
+
+def admit_player(client_socket, addr, context, lobby):
+    # TLS handshake and nickname read of one connection, runs in its own thread so slow clients never stall pairing.
+    # Players relayed by another worker come without context, their TLS handshake was done there. A client that
+    # is not admitted within LOBBY_TIMEOUT is cut off by the timer wheel.
+    deadline = None
+    try:
+        if context is not None:
+            client_socket = context.wrap_socket(client_socket, server_side=True, do_handshake_on_connect=False)
+        deadline = deadlines.schedule(LOBBY_TIMEOUT, timers.interrupt, client_socket)
+        if context is not None:
+            metrics.timed(metrics.HANDSHAKE, client_socket.do_handshake)
+        conn, nickname = protocol.accept(client_socket, TextConnection)
+        conn.relayed = context is None
+        if not deadline.cancel():
+            raise TimeoutError("lobby timeout")
+    except Exception as e:
+        logging.error(f"{e} error occurred while admitting player from {addr}.")
+        if deadline is not None:
+            deadline.cancel()
+        client_socket.close()
+        return
+
+    if conn.spectate:
+        # Spectators never enter the lobby, their writer thread owns the connection
+        if not watchers.watch(conn, nickname):
+            conn.close()
+        return
+    players = enter_lobby(conn, nickname, lobby)
+    if conn.vs_server:
+        print(f"Player connected from {addr} ({nickname}) to play against the server")
+    elif players is None:
+        print(f"Player 1 connected from {addr} ({nickname})")
+    else:
+        print(f"Player 2 connected from {addr} ({nickname})")
+    start_session(players, lobby)
+
+def accept_relayed(relay_server, lobby):
+    # Players handed over by other workers
+    while True:
+        client_socket, addr = relay_server.accept()
+        threading.Thread(target=admit_player, args=(client_socket, addr, None, lobby), daemon=True).start()
+
+def start_server(host=SERVER, port=PORT, by_score=False, worker=None):
+    global watchers
+    watchers = spectators.Directory(spectators.ThreadHub())
     context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-    context.load_cert_chain(certfile="sample_cert.pem", keyfile="sample_key.pem")
-    
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server.bind((SERVER, PORT))
-    server.listen(5)
+    context.load_cert_chain(certfile=os.path.join(CERT_DIR, "sample_cert.pem"), keyfile=os.path.join(CERT_DIR, "sample_key.pem"))
+    if worker is None:
+        lobby = Lobby(by_score)
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host, port))
+        server.listen(LISTEN_BACKLOG)
+    else:
+        lobby = WorkerLobby(worker, by_score)
+        server = workers.reuse_port_socket(host, port, LISTEN_BACKLOG)
+        threading.Thread(target=accept_relayed, args=(worker.relay_socket(), lobby), daemon=True).start()
+    metrics.WAITING_PLAYERS.function = lobby.waiting_players
+    metrics.TIMERS.function = deadlines.pending
     print("Server started, waiting for connections...")
 
     while True:
-        client_socket_1, addr1 = server.accept()
-        client_socket_1 = context.wrap_socket(client_socket_1, server_side=True)
-        nickname_1 = client_socket_1.recv(1024).decode().strip()
-        print(f"Player 1 connected from {addr1} ({nickname_1})")
-        client_socket_1.send("Waiting for another player...".encode())
-
-        client_socket_2, addr2 = server.accept()
-        client_socket_2 = context.wrap_socket(client_socket_2, server_side=True)
-        nickname_2 = client_socket_2.recv(1024).decode().strip()
-        print(f"Player 2 connected from {addr2} ({nickname_2})")
-
-        # Start a new thread for each game session
-        game_thread = threading.Thread(target=handle_game, args=(client_socket_1, nickname_1, client_socket_2, nickname_2))
-        
-        game_thread.start()
+        client_socket, addr = server.accept()
+        threading.Thread(target=admit_player, args=(client_socket, addr, context, lobby), daemon=True).start()
+
+async def start_async_server(host=SERVER, port=PORT, by_score=False, worker=None):
+    # Asyncio server, TLS handshakes and games of all players run in one thread on one event loop
+    global watchers, recorder
+    watchers = spectators.Directory(spectators.LoopHub(asyncio.get_running_loop()))
+    recorder = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='recorder')
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certfile=os.path.join(CERT_DIR, "sample_cert.pem"), keyfile=os.path.join(CERT_DIR, "sample_key.pem"))
+    protocol.raise_open_files_limit()
+    if getattr(asyncio.sslproto.SSLProtocol, 'max_size', None) == 256 * 1024:
+        # asyncio allocates a read buffer of max_size for every TLS connection up front. The class attribute is the
+        # only way to change it, which is fine as the only TLS connections of a server process are its players'.
+        # Checked with CPython 3.11.7: SSLProtocol allocates bytearray(max_size) in __init__ and reads at most
+        # max_size bytes at once. Versions with another default or none keep it.
+        asyncio.sslproto.SSLProtocol.max_size = ASYNC_SSL_READ_SIZE
+    # Python 3.11 and later upgrade a stream to TLS in the handler, where the handshake is timed. Older versions
+    # do the handshake in start_server() and the handshake time is not recorded.
+    tls_in_handler = hasattr(asyncio.StreamWriter, 'start_tls')
+    lobby = Lobby(by_score) if worker is None else WorkerLobby(worker, by_score)
+    metrics.WAITING_PLAYERS.function = lobby.waiting_players
+
+    async def handle_connection(reader, writer, relayed=False):
+        try:
+            conn, nickname = await asyncio.wait_for(protocol.accept_async(reader, writer, TextConnection), LOBBY_TIMEOUT)
+        except Exception as e:
+            logging.error(f"{e} error occurred while reading nickname.")
+            writer.close()
+            return
+        conn.relayed = relayed
+        if conn.spectate:
+            if not watchers.watch(conn, nickname):
+                try:
+                    await conn.drain()
+                except OSError:
+                    pass
+                conn.close()
+            return
+        addr = writer.get_extra_info('peername')
+        players = enter_lobby(conn, nickname, lobby)
+        if conn.vs_server:
+            print(f"Player connected from {addr} ({nickname}) to play against the server")
+        elif players is None:
+            print(f"Player 1 connected from {addr} ({nickname})")
+            return
+        else:
+            print(f"Player 2 connected from {addr} ({nickname})")
+        await handle_session_async(*players[0], *players[1], lobby)
+
+    async def handle_client(reader, writer):
+        # TLS handshake of a new connection, asyncio itself only logs its time in debug mode
+        start = time.perf_counter()
+        try:
+            await writer.start_tls(context, ssl_handshake_timeout=LOBBY_TIMEOUT)
+        except Exception as e:
+            logging.error(f"{e} error occurred during TLS handshake.")
+            writer.close()
+            return
+        metrics.HANDSHAKE.observe(time.perf_counter() - start)
+        await handle_connection(reader, writer)
+
+    async def handle_relayed(reader, writer):
+        # Player handed over by another worker, its TLS handshake was done there
+        await handle_connection(reader, writer, relayed=True)
+
+    if tls_in_handler:
+        server = await asyncio.start_server(handle_client, host, port, backlog=ASYNC_BACKLOG, reuse_port=worker is not None)
+    else:
+        server = await asyncio.start_server(handle_connection, host, port, ssl=context, backlog=ASYNC_BACKLOG, ssl_handshake_timeout=LOBBY_TIMEOUT, reuse_port=worker is not None)
+    if worker is not None:
+        await asyncio.start_unix_server(handle_relayed, sock=worker.relay_socket())
+    print("Asyncio server started, waiting for connections...")
+    async with server:
+        await server.serve_forever()
+
+def run_worker(worker, use_asyncio=False, host=SERVER, port=PORT, by_score=False):
+    # Game server of one worker process, forked by the supervisor
+    global scores, results
+    # Connections of the supervisor cannot be used after fork
+    scores = store.ScoreStore(store.DATABASE)
+    results = worker.results
+    metrics.reset()
+    threading.Thread(target=worker.send_metrics, daemon=True).start()
+    if use_asyncio:
+        asyncio.run(start_async_server(host, port, by_score, worker))
+    else:
+        start_server(host, port, by_score, worker)
+
+def start_workers(count, use_asyncio=False, host=SERVER, port=PORT, by_score=False):
+    # Pre-fork server: count worker processes share the game port, this process records their results
+    # and starts crashed workers again
+    global capacity
+    capacity = CAPACITY * count
+    supervisor = workers.Supervisor(lambda worker: run_worker(worker, use_asyncio, host, port, by_score), count, tempfile.mkdtemp(prefix='tictactoe-'))
+    threading.Thread(target=supervisor.results_loop, args=(update_results,), daemon=True).start()
+    threading.Thread(target=supervisor.metrics_loop, args=(worker_metrics,), daemon=True).start()
+    print(f"Supervisor started {count} workers")
+    supervisor.supervise()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tic-tac-toe game server")
+    parser.add_argument('--asyncio', action='store_true', help="run games on an asyncio event loop instead of a thread per game")
+    parser.add_argument('--pair-by-score', action='store_true', help="pair waiting players with the closest scoreboard score")
+    parser.add_argument('--workers', type=int, default=1, help="worker processes sharing the game port, e.g. one per CPU core")
+    parser.add_argument('--separate-dashboard', action='store_true', help=f"leave the dashboard to dashboard.py, only /metrics is served here on port {METRICS_PORT}")
+    args = parser.parse_args()
+    if not 1 <= args.workers <= workers.MAX_WORKERS:
+        parser.error(f"--workers goes from 1 to {workers.MAX_WORKERS}")
+
     logging.basicConfig(filename='server.log', level=logging.INFO)
-    atexit.register(on_exit,scoreboard,history)
-    app = Flask(__name__)    
-    # Main game page
-    @app.route('/')
-    def indexMain():
-        return render_template('main.html')
-
-    # Scoreboard route
-    @app.route('/scoreboard')
-    def indexScoreboard():
-        scoreboard.sort(key=lambda x: x['score'], reverse=True)
-        return render_template('scoreboard.html', scoreboard=scoreboard)
-
-    # History route
-    @app.route('/history')
-    def indexHistory():
-        history.sort(key=lambda x: x['date'], reverse=True)
-        return render_template('history.html', history=history)
+    app = Flask(__name__)
+    if not args.separate_dashboard:
+        routes.register(app, scores, ranking, history, games, pages, updates)
+
+    # Prometheus metrics, in worker mode added up over all workers
+    @app.route('/metrics')
+    def indexMetrics():
+        return metrics.respond(list(worker_metrics.values()))
 
     def run_flask():
-        app.run(debug=True, host=SERVER, use_reloader=False)
+        app.run(debug=True, host=SERVER, port=METRICS_PORT if args.separate_dashboard else DASHBOARD_PORT, use_reloader=False)
 
     # Run Flask app in separate thread
     flask_thread = threading.Thread(target=run_flask)
     flask_thread.start()
-    start_server()
\ No newline at end of file
+    if args.workers > 1:
+        start_workers(args.workers, args.asyncio, by_score=args.pair_by_score)
+    elif args.asyncio:
+        asyncio.run(start_async_server(by_score=args.pair_by_score))
+    else:
+        start_server(by_score=args.pair_by_score)
\ No newline at end of file
@@ -0,0 +1,65 @@
+import argparse
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+from flask import Flask
+from werkzeug.serving import make_server
+import live
+import pagecache
+import recording
+import routes
+import store
+
+# Web dashboard as a process of its own, so page views take no time from the game server's threads.
+# It reads the scoreboard and ratings from the store and games from the logs the game server writes, pages
+# are cached until the end of the history log or the game log moves. Start the game server with
+# --separate-dashboard, then python dashboard.py --processes 4, or run it under any threaded WSGI server,
+# e.g. gunicorn -w 4 --threads 32 dashboard:app, as every open page keeps a stream of live updates.
+
+HOST = '0.0.0.0' # Address the dashboard listens on
+PORT = 5000 # Dashboard port, the one the game servers used for their own dashboard
+PROCESSES = 4 # Worker processes of the built-in server
+LISTEN_BACKLOG = 128
+NICENESS = 10 # Worker processes yield the CPU to the game server when a core is shared
+
+def create_app(database=store.DATABASE, history_dir=store.HISTORY_DIR, games_dir=recording.GAMES_DIR):
+    app = Flask(__name__)
+    scores = store.ScoreStore(database)
+    history = store.HistoryLog(history_dir)
+    games = recording.GameLog(games_dir)
+    # Draws change ratings without a history entry
+    pages = pagecache.PageCache(version=lambda: f"{history.version()}/{games.version()}")
+    updates = live.Broadcaster(scores.query, history, follow=True) # Pushes games the game server adds to the log
+    # The store answers scoreboard queries, the game servers keep a ranked copy in memory instead
+    routes.register(app, scores, scores, history, games, pages, updates)
+    return app
+
+app = create_app()
+
+def serve(listener, host, port):
+    # Werkzeug's threaded server on a socket shared with the other worker processes
+    os.nice(NICENESS)
+    make_server(host, port, app, threaded=True, fd=listener.fileno()).serve_forever()
+
+def run(host=HOST, port=PORT, processes=PROCESSES):
+    # Pre-fork server: worker processes accept connections from one listening socket
+    listener = socket.create_server((host, port), backlog=LISTEN_BACKLOG)
+    context = multiprocessing.get_context('fork')
+    children = [context.Process(target=serve, args=(listener, host, port), daemon=True) for _ in range(processes)]
+    for child in children:
+        child.start()
+    # Workers are stopped with the dashboard
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    print(f"Dashboard on http://{host}:{port} with {processes} worker processes")
+    for child in children:
+        child.join()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tic-tac-toe web dashboard reading the game server's store")
+    parser.add_argument('--host', default=HOST, help="address to listen on")
+    parser.add_argument('--port', type=int, default=PORT, help="port to listen on")
+    parser.add_argument('--processes', type=int, default=PROCESSES, help="worker processes")
+    args = parser.parse_args()
+    run(args.host, args.port, max(args.processes, 1))
@@ -0,0 +1,182 @@
+import socket
+import time
+import os
+import queue
+import threading
+
+# Multicast UDP discovery of game servers on the LAN. Clients asking with DISCOVER_LOAD get the load of every
+# server with its address, collect replies for a short window and connect to the least loaded server.
+# Clients asking with DISCOVER get the bare address as before. Servers take at most REPLY_RATE requests per
+# second, a storm of datagrams is left to the kernel to drop instead of keeping the game threads from running.
+# Clients search in the background while the player types the nickname: the server of the last game, kept in
+# CACHE_FILE, is asked directly while multicast discovery runs, the first answer wins.
+
+FORMAT = 'utf-8' # Format of discovery messages
+DISCOVERY_PORT = 5051 # Discovery port that servers listen on
+MULTICAST_GROUP = '224.0.0.1' # Discovery multicast group that servers listen on
+DISCOVER = b"DISCOVER_SERVER" # Request of clients taking the first server, answered with "address:port"
+DISCOVER_LOAD = b"DISCOVER_SERVER LOAD" # Request of clients comparing servers, answered with "address:port games waiting capacity"
+REPLY_RATE = 50.0 # Requests a server takes per second
+REPLY_BURST = 20 # Requests a server takes at once after being idle
+MAX_DISCOVERY_ATTEMPTS = 3 # Maximum number of discovery attempts
+DISCOVERY_TIMEOUT = 2.0 # Seconds a client waits for the first reply
+COLLECT_WINDOW = 0.2 # Seconds a client waits for replies of other servers after the first one
+PROBE_TIMEOUT = 0.5 # Seconds a client waits for the answer of the cached server
+CACHE_FILE = os.path.join(os.path.expanduser('~'), '.tictactoe_server') # Last server a client connected to, as address:port
+
+class RateLimit:
+    # Token bucket refilled with rate tokens per second up to burst tokens
+    def __init__(self, rate=REPLY_RATE, burst=REPLY_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+
+    def wait(self):
+        # Take a token, sleeps until there is one
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens < 1:
+            time.sleep((1 - self.tokens) / self.rate)
+            self.tokens = 0
+            self.last = time.monotonic()
+        else:
+            self.tokens -= 1
+
+def serve(host, port, load):
+    # Answer discovery requests forever. load() returns active games, waiting players and the number of
+    # players the server is sized for.
+    discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    discovery_socket.bind(('', DISCOVERY_PORT))
+    group = socket.inet_aton(MULTICAST_GROUP)
+    mreq = group + socket.inet_aton('0.0.0.0')
+    discovery_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+    limit = RateLimit()
+    while True:
+        data, addr = discovery_socket.recvfrom(1024)
+        limit.wait()
+        if data == DISCOVER:
+            reply = f"{host}:{port}"
+        elif data == DISCOVER_LOAD:
+            games, waiting, capacity = load()
+            reply = f"{host}:{port} {games} {waiting} {capacity}"
+        else:
+            continue
+        try:
+            discovery_socket.sendto(reply.encode(FORMAT), addr)
+        except OSError:
+            pass
+
+def parse_reply(data):
+    # Address, port and load of a server from its reply, load is the share of its capacity in use.
+    # Servers not sending their load come after all others. Returns None for a malformed reply.
+    try:
+        fields = data.decode(FORMAT).split()
+        host, port = fields[0].rsplit(':', 1)
+        load = float('inf')
+        if len(fields) == 4:
+            games, waiting, capacity = (int(field) for field in fields[1:])
+            load = (2 * games + waiting) / max(capacity, 1)
+        return host, int(port), load
+    except (UnicodeDecodeError, ValueError, IndexError):
+        return None
+
+def collect(discovery_socket):
+    # Replies to one request: the first one within DISCOVERY_TIMEOUT, other servers within COLLECT_WINDOW after it
+    servers = {} # Load by address and port, a server answering twice counts once
+    deadline = time.monotonic() + DISCOVERY_TIMEOUT
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return servers
+        discovery_socket.settimeout(remaining)
+        try:
+            data, _ = discovery_socket.recvfrom(1024)
+        except socket.timeout:
+            return servers
+        server = parse_reply(data)
+        if server is None:
+            continue
+        if not servers:
+            deadline = min(deadline, time.monotonic() + COLLECT_WINDOW)
+        servers[server[:2]] = server[2]
+
+def discover_server(stop=None):
+    # Multicast UDP service discovery. Returns address and port of the least loaded server answering, the one
+    # answering first among equally loaded ones, or None, None when no server answers or stop is set.
+    discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    discovery_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 2)
+    discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        for attempt in range(MAX_DISCOVERY_ATTEMPTS):
+            if stop is not None and stop.is_set():
+                break
+            discovery_socket.sendto(DISCOVER_LOAD, (MULTICAST_GROUP, DISCOVERY_PORT))
+            servers = collect(discovery_socket)
+            if servers:
+                return min(servers, key=servers.get)
+        return None, None
+    except OSError:
+        # No network to send the request to
+        return None, None
+    finally:
+        discovery_socket.close()
+
+def probe(host):
+    # Ask the server at host directly, returns its address and port or None, None when it does not answer in time
+    probe_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    try:
+        probe_socket.settimeout(PROBE_TIMEOUT)
+        probe_socket.sendto(DISCOVER_LOAD, (host, DISCOVERY_PORT))
+        server = parse_reply(probe_socket.recvfrom(1024)[0])
+        return server[:2] if server is not None else (None, None)
+    except OSError:
+        return None, None
+    finally:
+        probe_socket.close()
+
+def cached_server():
+    # Address and port of the last server, None, None without one
+    try:
+        with open(CACHE_FILE, 'r') as file:
+            host, port = file.read().strip().rsplit(':', 1)
+        return host, int(port)
+    except (OSError, ValueError):
+        return None, None
+
+def remember(host, port):
+    # Keep the server a client connected to for its next start
+    try:
+        with open(CACHE_FILE, 'w') as file:
+            file.write(f"{host}:{port}")
+    except OSError:
+        pass
+
+class Search:
+    # Server search started right away in background threads, result() waits for its outcome
+    def __init__(self):
+        self.answers = queue.Queue() # Address and port from every finished search, None, None when it found nothing
+        self.stop = threading.Event() # Set once a server is found, ends the multicast discovery early
+        self.pending = 1
+        threading.Thread(target=lambda: self.answers.put(discover_server(self.stop)), daemon=True).start()
+        host, _ = cached_server()
+        if host is not None:
+            self.pending += 1
+            threading.Thread(target=lambda: self.answers.put(probe(host)), daemon=True).start()
+        self.server = None
+
+    def result(self):
+        # Address and port of the first server found, None, None when no server answers
+        while self.server is None and self.pending:
+            server = self.answers.get()
+            self.pending -= 1
+            if server[0] is not None:
+                self.server = server
+                self.stop.set()
+                print(f"Found server {server[0]}:{server[1]}. Connecting to it.")
+        if self.server is None:
+            print(f"Server discovery failed after {MAX_DISCOVERY_ATTEMPTS} attempts.")
+            return None, None
+        return self.server
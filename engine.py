@@ -0,0 +1,243 @@
+# Tic-tac-toe engine shared by servers and clients. Marks of each player are kept as an integer bit mask,
+# bit i is set when the player owns cell i (cells numbered row by row). Games follow m,n,k rules, the classic
+# 3x3 board is looked up in precomputed 9-bit tables and the batch functions only take 3x3 boards.
+# NumPy is only imported by the first batch call, clients never make one and start without paying for it.
+
+CELLS = 9 # Number of cells of the classic 3x3 board
+FULL = (1 << CELLS) - 1 # Mask with every cell taken
+MARKS = ('X', 'O') # X always moves first
+WIN_MASKS = tuple(sum(1 << cell for cell in line) for line in (
+    (0, 1, 2), (3, 4, 5), (6, 7, 8),  # Rows
+    (0, 3, 6), (1, 4, 7), (2, 5, 8),  # Columns
+    (0, 4, 8), (2, 4, 6)              # Diagonals
+))
+# Whether a 9-bit mask contains a full line, precomputed for all 512 masks so a win check is one lookup
+WINNING = tuple(any(mask & line == line for line in WIN_MASKS) for mask in range(1 << CELLS))
+POPCOUNT = tuple(bin(mask).count('1') for mask in range(1 << CELLS)) # Number of marks in a 9-bit mask
+
+np = None # NumPy once a batch function imported it, stays None when it is not installed
+numpy_tried = False # Whether the import was tried already
+
+def load_numpy():
+    # NumPy for the batch functions and its lookup tables, None when it is not installed
+    global np, numpy_tried, WINNING_ARRAY, POPCOUNT_ARRAY, CELL_BITS
+    if not numpy_tried:
+        numpy_tried = True
+        try:
+            import numpy
+        except ImportError:
+            # Batch functions fall back to plain Python loops
+            return None
+        WINNING_ARRAY = numpy.array(WINNING, dtype=bool)
+        POPCOUNT_ARRAY = numpy.array(POPCOUNT, dtype=numpy.uint8)
+        CELL_BITS = numpy.array([1 << cell for cell in range(CELLS)], dtype=numpy.int32)
+        np = numpy
+    return np
+
+def bits(mask):
+    # Indexes of set bits, lowest first
+    cells = []
+    while mask:
+        low = mask & -mask
+        cells.append(low.bit_length() - 1)
+        mask ^= low
+    return cells
+
+# Cells of every 9-bit mask, so legal moves of a position are one lookup of its free cells mask
+MASK_CELLS = tuple(tuple(bits(mask)) for mask in range(1 << CELLS))
+
+def pack(x, o):
+    # Whole board as one 18-bit integer, X marks in low bits and O marks in high bits
+    return x | o << CELLS
+
+def unpack(key):
+    return key & FULL, key >> CELLS
+
+MAX_SIDE = 15 # Longest board side, cells of every board fit the protocol's one byte moves
+
+class Rules:
+    # Board size (m rows, n columns) and number of marks in a row (k) that wins, the classic game is Rules(3, 3, 3)
+    __slots__ = ('rows', 'cols', 'k', 'cells', 'full', 'standard')
+
+    def __init__(self, rows=3, cols=3, k=3):
+        self.rows = rows
+        self.cols = cols
+        self.k = k
+        self.cells = rows * cols
+        self.full = (1 << self.cells) - 1
+        self.standard = (rows, cols, k) == (3, 3, 3) # Classic boards use the precomputed 9-bit tables
+
+    def key(self):
+        return self.rows, self.cols, self.k
+
+    def __eq__(self, other):
+        return isinstance(other, Rules) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def __repr__(self):
+        return f"Rules({self.rows}, {self.cols}, {self.k})"
+
+    def is_valid(self):
+        return 1 <= self.rows <= MAX_SIDE and 1 <= self.cols <= MAX_SIDE and 1 <= self.k <= max(self.rows, self.cols)
+
+STANDARD = Rules() # 3x3 board, three in a row wins
+DIRECTIONS = ((0, 1), (1, 0), (1, 1), (1, -1)) # Row and column steps of the four lines through a cell
+
+class Board:
+    # Board of a single game. Indexing and iterating yields ' ', 'X' or 'O' like the old list of cells.
+    __slots__ = ('x', 'o', 'rules')
+
+    def __init__(self, x=0, o=0, rules=STANDARD):
+        self.x = x
+        self.o = o
+        self.rules = rules
+
+    @classmethod
+    def from_cells(cls, cells, rules=STANDARD):
+        # Build board from sequence of ' '/'X'/'O' cells
+        x = o = 0
+        for cell, mark in enumerate(cells):
+            if mark == 'X':
+                x |= 1 << cell
+            elif mark == 'O':
+                o |= 1 << cell
+        return cls(x, o, rules)
+
+    def __getitem__(self, cell):
+        if self.x >> cell & 1:
+            return 'X'
+        if self.o >> cell & 1:
+            return 'O'
+        return ' '
+
+    def __iter__(self):
+        return (self[cell] for cell in range(self.rules.cells))
+
+    def key(self):
+        return self.x | self.o << self.rules.cells
+
+    def taken(self):
+        return self.x | self.o
+
+    def count(self):
+        # Number of marks on the board
+        if self.rules.standard:
+            return POPCOUNT[self.x] + POPCOUNT[self.o]
+        return bin(self.x | self.o).count('1')
+
+    def is_free(self, cell):
+        return 0 <= cell < self.rules.cells and not (self.x | self.o) >> cell & 1
+
+    def is_full(self):
+        return self.x | self.o == self.rules.full
+
+    def play(self, cell, mark):
+        # Put mark on a cell, the caller checks that the cell is free
+        if mark == 'X':
+            self.x |= 1 << cell
+        else:
+            self.o |= 1 << cell
+
+    def wins_at(self, cell, mark):
+        # Whether mark on cell makes k in a row on a board without a winner yet. Only the four lines through
+        # cell are walked, at most k - 1 cells in each direction, so a move is checked in O(k) whatever the size.
+        marks = (self.x if mark == 'X' else self.o) | 1 << cell
+        if self.rules.standard:
+            return WINNING[marks]
+        rows, cols, k = self.rules.rows, self.rules.cols, self.rules.k
+        row, col = divmod(cell, cols)
+        for row_step, col_step in DIRECTIONS:
+            count = 1
+            for sign in (1, -1):
+                r, c = row + sign * row_step, col + sign * col_step
+                while count < k and 0 <= r < rows and 0 <= c < cols and marks >> (r * cols + c) & 1:
+                    count += 1
+                    r, c = r + sign * row_step, c + sign * col_step
+            if count >= k:
+                return True
+        return False
+
+    def wins(self, mark):
+        # Whether mark has k in a row anywhere, checks every mark of the player
+        marks = self.x if mark == 'X' else self.o
+        if self.rules.standard:
+            return WINNING[marks]
+        for cell in bits(marks):
+            if self.wins_at(cell, mark):
+                return True
+        return False
+
+    def winner(self):
+        # 'X', 'O' or None
+        if self.rules.standard:
+            return 'X' if WINNING[self.x] else 'O' if WINNING[self.o] else None
+        if self.wins('X'):
+            return 'X'
+        if self.wins('O'):
+            return 'O'
+        return None
+
+    def legal_moves(self):
+        # Free cells as a tuple, lowest first
+        if self.rules.standard:
+            return MASK_CELLS[FULL & ~(self.x | self.o)]
+        return tuple(bits(self.rules.full & ~(self.x | self.o)))
+
+    def next_mark(self):
+        # Mark of player to move, X moves first
+        if self.rules.standard:
+            return 'X' if POPCOUNT[self.x] <= POPCOUNT[self.o] else 'O'
+        return 'X' if bin(self.x).count('1') <= bin(self.o).count('1') else 'O'
+
+def render_board(board):
+    # Build ASCII representation of the game board
+    cells = list(board)
+    rows, cols = board.rules.rows, board.rules.cols
+    separator = "+".join("-" * (3 if 0 < col < cols - 1 else 2) for col in range(cols))
+    board_display = ""
+    for i in range(rows):
+        row = " | ".join(cells[i * cols: (i + 1) * cols])
+        board_display += f"{row}\n"
+        if i < rows - 1:
+            board_display += f"{separator}\n"
+    return board_display
+
+def parse_board(text):
+    # Read the last ASCII board rendered by render_board in text, None if there is none
+    rows = [line for line in text.split('\n') if line.count(' | ') == 2][-3:]
+    if len(rows) < 3:
+        return None
+    cells = []
+    for row in rows:
+        cells.extend(mark.strip() or ' ' for mark in row.split(' | '))
+    return Board.from_cells(cells)
+
+def pack_cells(cells):
+    # Packed keys of many boards given as (n, 9) array of cells, 0 empty, 1 X, 2 O
+    np = load_numpy()
+    if np is None:
+        return [sum(1 << (cell + (CELLS if mark == 2 else 0)) for cell, mark in enumerate(row) if mark) for row in cells]
+    cells = np.asarray(cells)
+    x = ((cells == 1) * CELL_BITS).sum(axis=1)
+    o = ((cells == 2) * CELL_BITS).sum(axis=1)
+    return x | o << CELLS
+
+def batch_winners(keys):
+    # Winner of many packed boards at once: 0 none, 1 X, 2 O
+    np = load_numpy()
+    if np is None:
+        return [1 if WINNING[key & FULL] else 2 if WINNING[key >> CELLS] else 0 for key in keys]
+    keys = np.asarray(keys, dtype=np.int32)
+    x_wins = WINNING_ARRAY[keys & FULL]
+    o_wins = WINNING_ARRAY[keys >> CELLS]
+    return np.where(x_wins, 1, np.where(o_wins, 2, 0)).astype(np.uint8)
+
+def batch_legal_move_counts(keys):
+    # Number of free cells of many packed boards at once
+    np = load_numpy()
+    if np is None:
+        return [CELLS - POPCOUNT[(key & FULL) | key >> CELLS] for key in keys]
+    keys = np.asarray(keys, dtype=np.int32)
+    return CELLS - POPCOUNT_ARRAY[(keys & FULL) | keys >> CELLS]
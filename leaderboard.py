@@ -0,0 +1,141 @@
+import threading
+from bisect import bisect_left, insort
+
+# Ranked scoreboard kept in memory next to the store, so the dashboard never sorts the whole scoreboard.
+# Players are ordered by score, best first, ties by nickname. Entries live in sorted buckets and a Fenwick tree
+# over bucket sizes maps a rank to its bucket, so updates and rank queries take logarithmic time.
+
+LOAD = 512 # Bucket size, a bucket is split when it grows to twice the size
+TOP_SIZE = 100 # Players shown on the scoreboard page by default
+MAX_TOP_SIZE = 1000 # Largest top list a client may ask for
+AROUND_RADIUS = 5 # Players shown above and below a looked up rank
+
+class Leaderboard:
+    def __init__(self, entries=()):
+        # entries are dicts with nickname and score, like ScoreStore.scoreboard() returns
+        self.scores = {entry['nickname']: entry['score'] for entry in entries}
+        keys = sorted((-score, nickname) for nickname, score in self.scores.items())
+        self.buckets = [keys[i:i + LOAD] for i in range(0, len(keys), LOAD)]
+        self.maxes = [bucket[-1] for bucket in self.buckets] # Last key of every bucket
+        self.rebuild_tree()
+        self.lock = threading.Lock() # Results of many games and page views come from different threads
+
+    def rebuild_tree(self):
+        # Fenwick tree of bucket sizes, rebuilt only when buckets are split or removed
+        tree = [0] + [len(bucket) for bucket in self.buckets]
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self.tree = tree
+
+    def add_to_tree(self, bucket, delta):
+        i = bucket + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def entries_before(self, bucket):
+        # Number of entries in buckets before given bucket
+        total = 0
+        while bucket > 0:
+            total += self.tree[bucket]
+            bucket -= bucket & -bucket
+        return total
+
+    def locate(self, position):
+        # Bucket and offset of the entry at a 0-based position
+        bucket = 0
+        step = 1 << (len(self.tree) - 1).bit_length()
+        while step:
+            i = bucket + step
+            if i < len(self.tree) and self.tree[i] <= position:
+                bucket = i
+                position -= self.tree[i]
+            step >>= 1
+        return bucket, position
+
+    def insert(self, key):
+        if not self.buckets:
+            self.buckets.append([key])
+            self.maxes.append(key)
+            self.rebuild_tree()
+            return
+        b = min(bisect_left(self.maxes, key), len(self.buckets) - 1)
+        bucket = self.buckets[b]
+        insort(bucket, key)
+        self.maxes[b] = bucket[-1]
+        if len(bucket) >= 2 * LOAD:
+            self.buckets[b:b + 1] = [bucket[:LOAD], bucket[LOAD:]]
+            self.maxes[b:b + 1] = [bucket[LOAD - 1], bucket[-1]]
+            self.rebuild_tree()
+        else:
+            self.add_to_tree(b, 1)
+
+    def remove(self, key):
+        b = bisect_left(self.maxes, key)
+        bucket = self.buckets[b]
+        del bucket[bisect_left(bucket, key)]
+        if bucket:
+            self.maxes[b] = bucket[-1]
+            self.add_to_tree(b, -1)
+        else:
+            del self.buckets[b]
+            del self.maxes[b]
+            self.rebuild_tree()
+
+    def set_score(self, nickname, score):
+        if nickname in self.scores:
+            self.remove((-self.scores[nickname], nickname))
+        self.scores[nickname] = score
+        self.insert((-score, nickname))
+
+    def record_result(self, winner, loser):
+        # Same points as ScoreStore.record_result: the winner gets an entry with the first win
+        with self.lock:
+            self.set_score(winner, self.scores.get(winner, 0) + 1)
+            if loser in self.scores:
+                self.set_score(loser, self.scores[loser] - 1)
+
+    def score(self, nickname):
+        # Current score of a player, 0 for players without results
+        return self.scores.get(nickname, 0)
+
+    def entries(self, start, count):
+        # count entries from 0-based position start as dicts with rank, nickname and score
+        found = []
+        b, offset = self.locate(start)
+        while b < len(self.buckets) and len(found) < count:
+            for score, nickname in self.buckets[b][offset:offset + count - len(found)]:
+                found.append({'rank': start + len(found) + 1, 'nickname': nickname, 'score': -score})
+            b, offset = b + 1, 0
+        return found
+
+    def top(self, k=TOP_SIZE):
+        with self.lock:
+            return self.entries(0, k)
+
+    def rank(self, nickname):
+        # 1-based rank of a player, None for players without an entry
+        with self.lock:
+            if nickname not in self.scores:
+                return None
+            key = (-self.scores[nickname], nickname)
+            b = bisect_left(self.maxes, key)
+            return self.entries_before(b) + bisect_left(self.buckets[b], key) + 1
+
+    def around(self, rank, radius=AROUND_RADIUS):
+        # Players from rank - radius to rank + radius
+        with self.lock:
+            start = max(rank - 1 - radius, 0)
+            return self.entries(start, rank + radius - start)
+
+    def query(self, player=None, rank=None, top=TOP_SIZE, radius=AROUND_RADIUS):
+        # Rows of the scoreboard page: players around a player, around a rank, or the top players
+        if player:
+            rank = self.rank(player)
+            if rank is None:
+                return []
+        if rank:
+            return self.around(rank, radius)
+        return self.top(top)
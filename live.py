@@ -0,0 +1,179 @@
+import collections
+import json
+import queue
+import threading
+import time
+from flask import Response
+import store
+
+# Live dashboard: new scoreboard rows and games are pushed to the open pages as Server-Sent Events, so browsers
+# keep one stream open instead of reloading pages. One broadcaster per process: results are handed to its
+# thread, which computes the rows of every open scoreboard view once per batch of results and sends only the
+# rows that changed, the same text to every stream of that view. Games carry the end of the history log after
+# them as event id, so a browser reconnecting, also to another dashboard process, gets the games it missed.
+
+KEEPALIVE = 15.0 # Seconds between comments on an idle stream, a closed page is noticed on the next write
+BACKLOG = 1024 # Messages kept for streams that fell behind and for reconnecting browsers
+MAX_VIEWS = 100 # Distinct scoreboard views kept up to date, streams of further views are refused
+TAIL_INTERVAL = 0.5 # Seconds between checks of a history log written by another process
+HISTORY = 'history' # Topic of new games, scoreboard views are topics of their own
+
+def position_key(position):
+    # Order of history log positions like version() returns them, '0' and malformed ones come first
+    return store.parse_cursor(position) or (0, 0)
+
+def message(event, data, id=None):
+    # One Server-Sent Event with JSON data
+    text = f"id: {id}\n" if id else ''
+    return f"{text}event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+def respond(stream):
+    # Streamed response that proxies pass on without buffering
+    return Response(stream, mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+class Broadcaster:
+    # Shared by all streams of a process, record() is called by the game threads. With follow set, games are
+    # read from a history log another process writes.
+    def __init__(self, query, history, follow=False):
+        self.query = query # query(player, rank, top) returns the rows of a scoreboard page
+        self.history = history
+        self.follow = follow
+        self.results = queue.SimpleQueue() # Games with their log position, recorded but not sent yet
+        self.changed = threading.Condition() # Notified with every batch of messages
+        self.messages = collections.deque() # Sequence number, topic, text and log position of the last messages
+        self.sequence = 0
+        self.views = {} # Rows last sent and number of streams of every open scoreboard view by player, rank and top
+        self.floor = None # Log position up to which games are no longer kept
+        self.thread = None
+
+    def start(self):
+        # The thread starts on first use, dashboard processes fork after creating the broadcaster
+        with self.changed:
+            if self.thread is None:
+                self.floor = self.history.version()
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def record(self, game, position):
+        # A game result was stored, position is the end of the history log after it
+        self.start()
+        self.results.put((game, position))
+
+    def run(self):
+        # Hand batches of games to publish(), results of the same moment are sent together
+        position = self.floor
+        while True:
+            if self.follow:
+                time.sleep(TAIL_INTERVAL)
+                if self.history.version() == position:
+                    continue
+                games = self.history.since(position)
+                if not games:
+                    continue
+                position = games[-1][1]
+            else:
+                games = [self.results.get()]
+                while not self.results.empty():
+                    games.append(self.results.get())
+            self.publish(games)
+
+    def rows(self, view):
+        return [[entry['rank'], entry['nickname'], entry['score']] for entry in self.query(*view)]
+
+    def add(self, topic, text, position=None):
+        # Keep a message for the streams, the oldest one is dropped
+        self.sequence += 1
+        self.messages.append((self.sequence, topic, text, position))
+        if len(self.messages) > BACKLOG:
+            _, topic, _, position = self.messages.popleft()
+            if topic == HISTORY:
+                self.floor = position
+
+    def publish(self, games):
+        # New games and the changed rows of every open scoreboard view
+        with self.changed:
+            for game, position in games:
+                self.add(HISTORY, message('game', game, position), position)
+            for view, state in self.views.items():
+                rows = self.rows(view)
+                changed = [[index] + row for index, row in enumerate(rows) if index >= len(state[0]) or state[0][index] != row]
+                if changed or len(rows) != len(state[0]):
+                    self.add(view, message('rows', {'size': len(rows), 'rows': changed}))
+                state[0] = rows
+            self.changed.notify_all()
+
+    def stream(self, topic, first, behind):
+        # Messages of one topic from now on after the text of first(). behind() builds the message to a stream
+        # whose messages were dropped before it took them. Both are called holding the lock.
+        with self.changed:
+            sequence = self.sequence
+            text = first()
+        while True:
+            yield text
+            texts = []
+            deadline = time.monotonic() + KEEPALIVE
+            with self.changed:
+                # Messages of other topics wake the stream too
+                while not texts and self.changed.wait_for(lambda: self.sequence != sequence, deadline - time.monotonic()):
+                    if self.messages[0][0] > sequence + 1:
+                        texts = [behind()]
+                    else:
+                        for number, name, text, _ in reversed(self.messages):
+                            if number <= sequence:
+                                break
+                            if name == topic:
+                                texts.append(text)
+                        texts.reverse()
+                    sequence = self.sequence
+            text = ''.join(texts) or ': keepalive\n\n'
+
+    def scoreboard(self, player, rank, top):
+        # Response streaming the rows of a scoreboard view: all of them first, then the ones that change
+        # The search form sends an empty player for the top players
+        view = (player or None, rank, top)
+        self.start()
+        if view not in self.views and len(self.views) >= MAX_VIEWS:
+            return Response("Too many scoreboard views are open", status=503)
+
+        def rows():
+            state = self.views[view]
+            return message('rows', {'size': len(state[0]), 'rows': [[index] + row for index, row in enumerate(state[0])]})
+
+        def stream():
+            # The view is counted once the stream runs, a generator closed before it started runs no finally
+            with self.changed:
+                state = self.views.setdefault(view, [None, 0])
+                if state[0] is None:
+                    state[0] = self.rows(view)
+                state[1] += 1
+            try:
+                yield from self.stream(view, rows, rows)
+            finally:
+                with self.changed:
+                    state[1] -= 1
+                    if not state[1]:
+                        del self.views[view]
+        return respond(stream())
+
+    def games(self, since=None):
+        # Response streaming new games. Games after since, the log position of a page, are sent first. Pages
+        # too old for that, or streams that fell behind, are told to reload.
+        self.start()
+
+        def missed():
+            if since is None:
+                return ': live\n\n'
+            texts = []
+            if position_key(since) < position_key(self.floor):
+                # Games before the ones kept are read from the log, unless the page is older than the last segment
+                if position_key(since)[0] < position_key(self.floor)[0] - 1:
+                    return message('reload', {})
+                games = [(game, position) for game, position in self.history.since(since)
+                         if position_key(position) <= position_key(self.floor)]
+                if len(games) > BACKLOG:
+                    return message('reload', {})
+                texts = [message('game', game, position) for game, position in games]
+            texts += [text for _, topic, text, position in self.messages
+                      if topic == HISTORY and position_key(position) > position_key(since)]
+            return ''.join(texts) or ': live\n\n'
+        return respond(self.stream(HISTORY, missed, lambda: message('reload', {})))
@@ -0,0 +1,184 @@
+import bisect
+import os
+import threading
+import time
+from flask import Response
+
+# Instrumentation of the game servers, served as Prometheus text on /metrics. Recording a value costs a bisect
+# and two additions under a lock nobody else waits for, gauges are only computed when /metrics is scraped.
+# Worker processes send snapshots of their values to the supervisor, which adds them up.
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0) # Upper bounds in seconds
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8' # Prometheus text format
+
+HISTOGRAMS = [] # All histograms in the order of the output, histograms of one name follow each other
+GAUGES = []
+
+class Histogram:
+    def __init__(self, name, help, labels='', buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels # Prometheus labels like 'lock="room"', the same name has several label sets
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # Observations by bucket, not cumulative, the last one is +Inf
+        self.sum = 0.0
+        self.lock = threading.Lock()
+        HISTOGRAMS.append(self)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def values(self):
+        with self.lock:
+            return self.counts[:], self.sum
+
+class Gauge:
+    # Value kept up to date with add(), or computed by function when scraped
+    def __init__(self, name, help, function=None):
+        self.name = name
+        self.help = help
+        self.function = function
+        self.value = 0
+        self.lock = threading.Lock()
+        GAUGES.append(self)
+
+    def add(self, amount):
+        with self.lock:
+            self.value += amount
+
+    def get(self):
+        return self.value if self.function is None else self.function()
+
+class TimedLock:
+    # threading.Lock recording how long it is held
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.lock = threading.Lock()
+        self.acquired = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not self.lock.acquire(blocking, timeout):
+            return False
+        self.acquired = time.perf_counter()
+        return True
+
+    def release(self):
+        held = time.perf_counter() - self.acquired
+        self.lock.release()
+        self.histogram.observe(held)
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self.release()
+
+def timed(histogram, function, *args, **kwargs):
+    # Call function and record how long it took, failed calls are not recorded
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    histogram.observe(time.perf_counter() - start)
+    return result
+
+def open_sockets():
+    # Sockets among the open descriptors of this process, None where /proc is missing
+    try:
+        descriptors = os.listdir('/proc/self/fd')
+    except OSError:
+        return None
+    count = 0
+    for descriptor in descriptors:
+        try:
+            count += os.readlink(f'/proc/self/fd/{descriptor}').startswith('socket:')
+        except OSError:
+            # Closed since the listing
+            pass
+    return count
+
+HANDSHAKE = Histogram('tictactoe_tls_handshake_seconds', "TLS handshake of new connections")
+MATCHMAKING = Histogram('tictactoe_matchmaking_wait_seconds', "Time from joining matchmaking until the game starts")
+MOVE = Histogram('tictactoe_move_seconds', "Time from asking a player for a move until the move arrives")
+LOBBY_LOCK = Histogram('tictactoe_lock_hold_seconds', "Time a lock is held", 'lock="lobby"')
+ROOM_LOCK = Histogram('tictactoe_lock_hold_seconds', "Time a lock is held", 'lock="room"')
+SCORES_WRITE = Histogram('tictactoe_persistence_write_seconds', "Time to persist a game result", 'store="scores"')
+HISTORY_WRITE = Histogram('tictactoe_persistence_write_seconds', "Time to persist a game result", 'store="history"')
+GAMES_WRITE = Histogram('tictactoe_persistence_write_seconds', "Time to persist a game result", 'store="games"')
+RATINGS_WRITE = Histogram('tictactoe_persistence_write_seconds', "Time to persist a game result", 'store="ratings"')
+
+ACTIVE_GAMES = Gauge('tictactoe_active_games', "Games being played")
+WAITING_PLAYERS = Gauge('tictactoe_waiting_players', "Players waiting in matchmaking for an opponent")
+OPEN_SOCKETS = Gauge('tictactoe_open_sockets', "Open sockets of the server processes", open_sockets)
+THREADS = Gauge('tictactoe_threads', "Threads of the server processes", threading.active_count)
+SPECTATORS = Gauge('tictactoe_spectators', "Spectators watching live games")
+TIMERS = Gauge('tictactoe_timers', "Move deadlines and lobby timeouts pending on the timer wheel")
+
+def reset():
+    # Forked worker processes count from zero, values and locks of the supervisor stay there
+    for histogram in HISTOGRAMS:
+        histogram.counts = [0] * len(histogram.counts)
+        histogram.sum = 0.0
+        histogram.lock = threading.Lock()
+    for gauge in GAUGES:
+        gauge.value = 0
+        gauge.lock = threading.Lock()
+
+def total(gauge, snapshots=()):
+    # Value of a gauge added up over this process and snapshots of worker processes
+    value = gauge.get() or 0
+    for snapshot in snapshots:
+        value += snapshot['gauges'].get(gauge.name) or 0
+    return value
+
+def snapshot():
+    # Current values of this process, picklable so workers can send them to the supervisor
+    return {
+        'histograms': {(histogram.name, histogram.labels): histogram.values() for histogram in HISTOGRAMS},
+        'gauges': {gauge.name: gauge.get() for gauge in GAUGES},
+    }
+
+def merge(snapshots):
+    # Sum of snapshots of several processes, gauges nobody could compute stay None
+    total = snapshot()
+    for other in snapshots:
+        for key, (counts, seconds) in other['histograms'].items():
+            own = total['histograms'].get(key)
+            if own is not None:
+                total['histograms'][key] = ([a + b for a, b in zip(own[0], counts)], own[1] + seconds)
+        for name, value in other['gauges'].items():
+            if value is not None:
+                total['gauges'][name] = value + (total['gauges'].get(name) or 0)
+    return total
+
+def render(values):
+    # Prometheus text format of a snapshot
+    lines = []
+    name = None
+    for histogram in HISTOGRAMS:
+        if histogram.name != name:
+            name = histogram.name
+            lines.append(f"# HELP {name} {histogram.help}")
+            lines.append(f"# TYPE {name} histogram")
+        counts, seconds = values['histograms'][(name, histogram.labels)]
+        labels = histogram.labels + ',' if histogram.labels else ''
+        total = 0
+        for bound, count in zip(histogram.buckets, counts):
+            total += count
+            lines.append(f'{name}_bucket{{{labels}le="{bound}"}} {total}')
+        total += counts[-1]
+        lines.append(f'{name}_bucket{{{labels}le="+Inf"}} {total}')
+        labels = f"{{{histogram.labels}}}" if histogram.labels else ''
+        lines.append(f"{name}_sum{labels} {seconds}")
+        lines.append(f"{name}_count{labels} {total}")
+    for gauge in GAUGES:
+        value = values['gauges'].get(gauge.name)
+        if value is not None:
+            lines.append(f"# HELP {gauge.name} {gauge.help}")
+            lines.append(f"# TYPE {gauge.name} gauge")
+            lines.append(f"{gauge.name} {value}")
+    return '\n'.join(lines) + '\n'
+
+def respond(snapshots=()):
+    # /metrics response, snapshots of worker processes are added to the values of this process
+    return Response(render(merge(snapshots)), content_type=CONTENT_TYPE)
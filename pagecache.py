@@ -0,0 +1,56 @@
+import gzip
+import threading
+import time
+from flask import request, make_response
+
+# Rendered dashboard pages, kept until the next game result. Servers bump the version on every result,
+# pages are rendered and compressed at most once per version and browsers revalidate them with ETags.
+# A process that does not record results itself, like the dashboard process, gets the version from a function.
+
+CACHE_PAGES = 256 # Rendered pages kept, e.g. one per history cursor
+COMPRESS_LEVEL = 6 # gzip level of cached bodies, pages are compressed once per version
+
+class PageCache:
+    def __init__(self, size=CACHE_PAGES, version=None):
+        self.size = size
+        self.boot = int(time.time()) # Part of every ETag, so a restarted server never matches an old one
+        self.version = 0 # Bumped on every result
+        self.current = version # Function returning the version, its value is the same in all processes and goes into the ETag alone
+        self.pages = {} # (version, body, gzipped body) by path with query string
+        self.lock = threading.Lock()
+
+    def bump(self):
+        # Results changed, every cached page is stale
+        with self.lock:
+            self.version += 1
+
+    def respond(self, render):
+        # Response to the current request, render() builds the page only if results changed since it was cached
+        if self.current is None:
+            version = self.version
+            etag = f"{self.boot}-{version}"
+        else:
+            version = etag = self.current()
+        if request.if_none_match.contains_weak(etag):
+            response = make_response('', 304)
+        else:
+            key = request.full_path
+            page = self.pages.get(key)
+            if page is None or page[0] != version:
+                body = render().encode()
+                page = (version, body, gzip.compress(body, COMPRESS_LEVEL))
+                with self.lock:
+                    if key not in self.pages and len(self.pages) >= self.size:
+                        # Drop the oldest page
+                        del self.pages[next(iter(self.pages))]
+                    self.pages[key] = page
+            if 'gzip' in request.accept_encodings:
+                response = make_response(page[2])
+                response.headers['Content-Encoding'] = 'gzip'
+            else:
+                response = make_response(page[1])
+        # Same ETag for plain and gzipped body, so it is weak
+        response.set_etag(etag, weak=True)
+        response.headers['Vary'] = 'Accept-Encoding'
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
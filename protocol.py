@@ -0,0 +1,441 @@
+import socket
+import struct
+from engine import Board, MARKS, STANDARD, Rules
+
+# Binary wire protocol shared by servers and clients. A binary client opens with MAGIC and the highest
+# version it speaks, the server answers with MAGIC and the version both sides use. After that every
+# message is a frame: 2-byte payload length, 1-byte message type, payload.
+# Clients that open with anything else are text protocol clients sending their nickname.
+# From version 2 the server sends a full board (STATE) only when a game starts or a client asks to resync,
+# every move after that is a DELTA numbered by the count of marks on the board.
+# From version 3 the client's JOIN starts with a flags byte, VS_SERVER asks for a game against the server.
+# From version 4 both JOINs carry the m,n,k rules of the game and STATE carries boards of any size.
+# From version 5 the connection stays open after a RESULT, the client answers with AGAIN to play a rematch
+# or to go back into matchmaking, or closes the connection to quit.
+# From version 6 a JOIN with the SPECTATE flag watches the game of the player it names (the most watched game
+# for an empty name): the server answers with WATCH and sends the game's STATE, DELTAs and RESULT, but never
+# YOUR_TURN, until the players' session ends and the server closes the connection.
+
+FORMAT = 'utf-8' # Format of text inside payloads
+MAGIC = b'TTT' # Opening bytes of binary protocol clients and of the server's answer
+VERSION = 6 # Highest binary protocol version supported
+DELTA_VERSION = 2 # First version with DELTA board updates
+JOIN_FLAGS_VERSION = 3 # First version with flags in the client's JOIN
+RULES_VERSION = 4 # First version with rules in JOIN and boards of any size in STATE
+SESSION_VERSION = 5 # First version keeping the connection open for more games after a RESULT
+WATCH_VERSION = 6 # First version with spectators
+RECV_SIZE = 4096 # Bytes read from a connection at once
+HEADER = struct.Struct('!HB') # Payload length and message type
+STATE_FORMAT = struct.Struct('!HHBB') # X marks, O marks, flags, last move (before version 4)
+STATE_HEAD = struct.Struct('!BB') # Flags and last move, followed by X marks and O marks of the board's size
+RULES_FORMAT = struct.Struct('!BBB') # Rows, columns, marks in a row that win
+DELTA_FORMAT = struct.Struct('!HBB') # Sequence number (marks on board after the move), cell, flags
+
+# Message types
+JOIN = 1 # Client: flags (version 3), rules (version 4) and nickname. Server: own mark (or WAITING), rules (version 4) and opponent nickname
+MOVE = 2 # Client: cell 0-8
+STATE = 3 # Server: board, flags and last move
+RESULT = 4 # Server: outcome and nickname of winner or of player who left
+ERROR = 5 # Server: error code and description
+DELTA = 6 # Server: sequence number, cell of the move (NO_MOVE for a turn notice) and flags
+RESYNC = 7 # Client: board is out of sync, server answers with STATE
+AGAIN = 8 # Client: choice after a RESULT (version 5), server answers with JOIN when the next game is found
+WATCH = 9 # Server: rules and nicknames of X and O of the game a spectator watches (version 6)
+
+WAITING = 255 # Mark of JOIN answer sent while waiting for an opponent
+NO_MOVE = 255 # Last move of STATE sent before any move, cell of DELTA that only hands over the turn
+# JOIN flags
+VS_SERVER = 1
+SPECTATE = 2 # Watch the game of the player named in the JOIN (version 6)
+# STATE flags
+YOUR_TURN = 1
+TIMEOUT_MOVE = 2
+# RESULT outcomes
+DRAW = 0
+X_WINS = 1
+O_WINS = 2
+OPPONENT_LEFT = 3
+# AGAIN choices
+REMATCH = 1 # Same opponent with swapped marks, if the opponent asks for a rematch too
+REQUEUE = 2 # Back into matchmaking
+# ERROR codes
+INVALID_MOVE = 1
+BAD_MESSAGE = 2
+UNSUPPORTED_VERSION = 3
+BAD_RULES = 4
+NOT_PLAYING = 5 # Player a spectator asked for is not in a game
+
+def encode(msg_type, payload=b''):
+    return HEADER.pack(len(payload), msg_type) + payload
+
+def pop_frame(buffer):
+    # Remove first complete frame from a bytearray and return (type, payload), None if it is incomplete
+    if len(buffer) < HEADER.size:
+        return None
+    length, msg_type = HEADER.unpack_from(buffer)
+    end = HEADER.size + length
+    if len(buffer) < end:
+        return None
+    payload = bytes(buffer[HEADER.size:end])
+    del buffer[:end]
+    return msg_type, payload
+
+def read_hello(data):
+    # Version requested by the first bytes of a connection and the bytes after the hello.
+    # Version is None for text protocol clients.
+    if data.startswith(MAGIC) and len(data) > len(MAGIC):
+        return min(data[len(MAGIC)], VERSION), data[len(MAGIC) + 1:]
+    return None, data
+
+def rules_payload(rules, version=VERSION):
+    return RULES_FORMAT.pack(*rules.key()) if version >= RULES_VERSION else b''
+
+def parse_rules(payload, version=VERSION):
+    # Rules at the start of a JOIN payload and the rest of the payload
+    if version < RULES_VERSION:
+        return STANDARD, payload
+    return Rules(*RULES_FORMAT.unpack_from(payload)), payload[RULES_FORMAT.size:]
+
+def join_payload(mark, nickname, rules=STANDARD, version=VERSION):
+    return bytes([WAITING if mark is None else MARKS.index(mark)]) + rules_payload(rules, version) + nickname.encode(FORMAT)
+
+def parse_join(payload, version=VERSION):
+    # Own mark ('X', 'O' or None while waiting), rules of the game and opponent nickname
+    mark = None if payload[0] == WAITING else MARKS[payload[0]]
+    rules, nickname = parse_rules(payload[1:], version)
+    return mark, rules, nickname.decode(FORMAT)
+
+def mask_size(rules):
+    # Bytes of one player's marks in STATE
+    return (rules.cells + 7) // 8
+
+def state_payload(board, flags=0, last_move=None, version=VERSION):
+    last_move = NO_MOVE if last_move is None else last_move
+    if version < RULES_VERSION:
+        return STATE_FORMAT.pack(board.x, board.o, flags, last_move)
+    size = mask_size(board.rules)
+    return STATE_HEAD.pack(flags, last_move) + board.x.to_bytes(size, 'big') + board.o.to_bytes(size, 'big')
+
+def parse_state(payload, rules=STANDARD, version=VERSION):
+    # Board, flags and last move (None before the first move)
+    if version < RULES_VERSION:
+        x, o, flags, last_move = STATE_FORMAT.unpack(payload)
+    else:
+        flags, last_move = STATE_HEAD.unpack_from(payload)
+        size = mask_size(rules)
+        x = int.from_bytes(payload[STATE_HEAD.size:STATE_HEAD.size + size], 'big')
+        o = int.from_bytes(payload[STATE_HEAD.size + size:STATE_HEAD.size + 2 * size], 'big')
+    return Board(x, o, rules), flags, None if last_move == NO_MOVE else last_move
+
+def apply_delta(board, payload):
+    # Play move of a DELTA on the client's board. Returns flags and move (None for a turn notice),
+    # or None when the board is out of sync and the client has to send RESYNC.
+    seq, cell, flags = DELTA_FORMAT.unpack(payload)
+    count = board.count()
+    if cell == NO_MOVE:
+        return (flags, None) if seq == count else None
+    if seq != count + 1 or not board.is_free(cell):
+        return None
+    board.play(cell, board.next_mark())
+    return flags, cell
+
+def watch_payload(rules, nickname_x, nickname_o):
+    return rules_payload(rules) + nickname_x.encode(FORMAT) + b'\0' + nickname_o.encode(FORMAT)
+
+def parse_watch(payload):
+    # Rules of the watched game and nicknames of X and O
+    rules, nicknames = parse_rules(payload)
+    nickname_x, nickname_o = nicknames.decode(FORMAT).split('\0', 1)
+    return rules, nickname_x, nickname_o
+
+def parse_result(payload):
+    return payload[0], payload[1:].decode(FORMAT)
+
+def parse_error(payload):
+    return payload[0], payload[1:].decode(FORMAT)
+
+def describe_result(outcome, nickname):
+    # Text shown to a player for a RESULT message
+    if outcome == DRAW:
+        return "Game over! It's a draw!"
+    if outcome == OPPONENT_LEFT:
+        return f"Your opponent {nickname} has left the game. Please play another one."
+    return f"Game over! Winner: {nickname}."
+
+class Connection:
+    # Player stream over a blocking socket or over an asyncio reader and writer pair.
+    # Subclasses turn game events into the messages of their protocol.
+    binary = False
+    vs_server = False # Player asked for a game against the server
+    spectate = False # Client asked to watch the game of the player it named instead of playing
+    relayed = False # Player was handed over by another worker process of the server
+    queued = None # perf_counter() time the player entered matchmaking, for the server's metrics
+    rules = STANDARD # Rules of games the player joins, text protocol players play the classic game
+
+    def __init__(self, sock=None, reader=None, writer=None, pending=b''):
+        self.sock = sock
+        self.reader = reader
+        self.writer = writer
+        self.buffer = bytearray(pending) # Received bytes not parsed yet
+
+    def write(self, data):
+        if self.sock is not None:
+            self.sock.sendall(data)
+        else:
+            self.writer.write(data)
+
+    def recv(self):
+        data = self.sock.recv(RECV_SIZE)
+        if not data:
+            raise ConnectionResetError("Connection closed by client")
+        return data
+
+    def peer_closed(self):
+        # True when the client closed a blocking socket, checked without reading from it. The TCP socket under
+        # TLS is peeked, so bytes the client sent stay for the next read.
+        try:
+            return socket.socket.recv(self.sock, 1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b''
+        except BlockingIOError:
+            return False
+        except OSError:
+            return True
+
+    async def recv_async(self):
+        data = await self.reader.read(RECV_SIZE)
+        if not data:
+            raise ConnectionResetError("Connection closed by client")
+        return data
+
+    async def drain(self):
+        if self.writer is not None:
+            await self.writer.drain()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+        else:
+            self.writer.close()
+
+    def shutdown(self):
+        # Disconnect right away, e.g. when the opponent has left
+        if self.sock is not None:
+            try:
+                self.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.close()
+
+    def read_move(self):
+        # Cell chosen by the player, None for an invalid message
+        return self.parse_move(self.recv())
+
+    async def read_move_async(self):
+        return self.parse_move(await self.recv_async())
+
+    def unread_move(self):
+        # Message of the last read_move() is read again by the next read, e.g. when the game ended while the
+        # move was read. Text players get no choice after a game, their message is dropped.
+        pass
+
+    def read_choice(self, timeout=None):
+        # REMATCH or REQUEUE chosen after a result, None when the player quits.
+        # Only binary sessions stay open after a game.
+        return None
+
+    async def read_choice_async(self, timeout=None):
+        return None
+
+class BinaryConnection(Connection):
+    # Connection speaking framed binary messages
+    binary = True
+    version = VERSION
+    board = None # Board the client was last sent, DELTA updates continue from it
+    seq = 0 # Marks on that board when it was sent
+    last_frame = None # Frame read by the last read_move()
+
+    def send(self, msg_type, payload=b''):
+        self.write(encode(msg_type, payload))
+
+    def read_frame(self):
+        frame = pop_frame(self.buffer)
+        while frame is None:
+            self.buffer += self.recv()
+            frame = pop_frame(self.buffer)
+        return frame
+
+    async def read_frame_async(self):
+        frame = pop_frame(self.buffer)
+        while frame is None:
+            self.buffer += await self.recv_async()
+            frame = pop_frame(self.buffer)
+        return frame
+
+    def read_move(self):
+        msg_type, payload = self.read_frame()
+        while msg_type == RESYNC:
+            self.resync()
+            msg_type, payload = self.read_frame()
+        self.last_frame = msg_type, payload
+        return self.frame_move(msg_type, payload)
+
+    async def read_move_async(self):
+        msg_type, payload = await self.read_frame_async()
+        while msg_type == RESYNC:
+            self.resync()
+            msg_type, payload = await self.read_frame_async()
+        return self.frame_move(msg_type, payload)
+
+    def unread_move(self):
+        if self.last_frame is not None:
+            self.buffer[:0] = encode(*self.last_frame)
+            self.last_frame = None
+
+    def resync(self):
+        # Moves are read only from the player on turn, so the snapshot hands the turn over too
+        if self.board is not None:
+            self.send(STATE, state_payload(self.board, YOUR_TURN, version=self.version))
+
+    def frame_move(self, msg_type, payload):
+        if msg_type == MOVE and len(payload) == 1:
+            return payload[0]
+        return None
+
+    def read_choice(self, timeout=None):
+        # None also for clients without sessions and players that do not choose within timeout seconds
+        if self.version < SESSION_VERSION:
+            return None
+        try:
+            self.sock.settimeout(timeout)
+            msg_type, payload = self.read_frame()
+            while msg_type == RESYNC:
+                # Late resync of the finished game
+                msg_type, payload = self.read_frame()
+            self.sock.settimeout(None)
+        except OSError:
+            return None
+        return self.frame_choice(msg_type, payload)
+
+    async def read_choice_async(self, timeout=None):
+        # Imported here, asyncio servers already loaded it and clients start faster without it
+        import asyncio
+        if self.version < SESSION_VERSION:
+            return None
+        try:
+            msg_type, payload = await asyncio.wait_for(self.read_frame_async(), timeout)
+            while msg_type == RESYNC:
+                msg_type, payload = await asyncio.wait_for(self.read_frame_async(), timeout)
+        except (OSError, asyncio.TimeoutError):
+            return None
+        return self.frame_choice(msg_type, payload)
+
+    def send_again(self, choice):
+        # Client's answer to a RESULT: REMATCH or REQUEUE
+        self.send(AGAIN, bytes([choice]))
+
+    def frame_choice(self, msg_type, payload):
+        if msg_type == AGAIN and len(payload) == 1 and payload[0] in (REMATCH, REQUEUE):
+            return payload[0]
+        return None
+
+    def send_waiting(self):
+        self.send(JOIN, join_payload(None, '', self.rules, self.version))
+
+    def send_start(self, mark, opponent):
+        self.send(JOIN, join_payload(mark, opponent, self.rules, self.version))
+
+    def send_board(self, board, last_move=None, timeout=False, your_turn=False):
+        flags = (YOUR_TURN if your_turn else 0) | (TIMEOUT_MOVE if timeout else 0)
+        seq = board.count()
+        if self.version < DELTA_VERSION or board is not self.board or (last_move is None and seq != self.seq) or seq > self.seq + 1:
+            self.send(STATE, state_payload(board, flags, last_move, self.version))
+        elif seq == self.seq + 1:
+            self.send(DELTA, DELTA_FORMAT.pack(seq, last_move, flags))
+        elif your_turn:
+            # Client already has this board, only the turn changes
+            self.send(DELTA, DELTA_FORMAT.pack(seq, NO_MOVE, flags))
+        self.board = board
+        self.seq = seq
+
+    def send_prompt(self, board, mark):
+        self.send_board(board, your_turn=True)
+
+    def send_invalid(self):
+        self.send(ERROR, bytes([INVALID_MOVE]) + b"Invalid move. Try again.")
+
+    def send_win(self, mark, winner):
+        self.send(RESULT, bytes([X_WINS if mark == 'X' else O_WINS]) + winner.encode(FORMAT))
+
+    def send_draw(self):
+        self.send(RESULT, bytes([DRAW]))
+
+    def send_left(self, nickname):
+        self.send(RESULT, bytes([OPPONENT_LEFT]) + nickname.encode(FORMAT))
+
+    def answer_hello(self, version):
+        self.version = version
+        self.write(MAGIC + bytes([version]))
+        if version < 1:
+            self.send(ERROR, bytes([UNSUPPORTED_VERSION]) + b"Unsupported protocol version.")
+            raise ConnectionError("Client requested unsupported protocol version")
+
+    def join_nickname(self, msg_type, payload):
+        if msg_type != JOIN:
+            self.send(ERROR, bytes([BAD_MESSAGE]) + b"Expected JOIN.")
+            raise ConnectionError("Client did not send JOIN")
+        if self.version >= JOIN_FLAGS_VERSION and payload:
+            self.vs_server = bool(payload[0] & VS_SERVER)
+            self.spectate = self.version >= WATCH_VERSION and bool(payload[0] & SPECTATE)
+            payload = payload[1:]
+        if self.version >= RULES_VERSION:
+            if len(payload) < RULES_FORMAT.size or not Rules(*RULES_FORMAT.unpack_from(payload)).is_valid():
+                self.send(ERROR, bytes([BAD_RULES]) + b"Unsupported board size or win length.")
+                raise ConnectionError("Client requested invalid rules")
+            self.rules, payload = parse_rules(payload, self.version)
+        return payload.decode(FORMAT).strip()
+
+def accept(sock, text_connection):
+    # Negotiate protocol of a new server side connection, return connection and nickname of the player.
+    # text_connection is the server's Connection class for text protocol clients.
+    data = sock.recv(RECV_SIZE)
+    version, rest = read_hello(data)
+    if version is None:
+        return text_connection(sock=sock), data.decode().strip()
+    conn = BinaryConnection(sock=sock, pending=rest)
+    conn.answer_hello(version)
+    return conn, conn.join_nickname(*conn.read_frame())
+
+async def accept_async(reader, writer, text_connection):
+    # accept for asyncio streams
+    data = await reader.read(RECV_SIZE)
+    version, rest = read_hello(data)
+    if version is None:
+        return text_connection(reader=reader, writer=writer), data.decode().strip()
+    conn = BinaryConnection(reader=reader, writer=writer, pending=rest)
+    conn.answer_hello(version)
+    return conn, conn.join_nickname(*await conn.read_frame_async())
+
+def join_request(nickname, version=VERSION, vs_server=False, rules=STANDARD, spectate=False):
+    # Client's JOIN payload, the flags byte only exists from version 3 and the rules from version 4
+    flags = bytes([(VS_SERVER if vs_server else 0) | (SPECTATE if spectate else 0)]) if version >= JOIN_FLAGS_VERSION else b''
+    return flags + rules_payload(rules, version) + nickname.encode(FORMAT)
+
+def connect(sock, nickname, version=VERSION, vs_server=False, rules=STANDARD, spectate=False):
+    # Negotiate binary protocol on a connected client socket and join a game with given rules as nickname,
+    # or watch the game of the player named nickname
+    sock.sendall(MAGIC + bytes([version]) + encode(JOIN, join_request(nickname, version, vs_server, rules, spectate)))
+    conn = BinaryConnection(sock=sock)
+    while len(conn.buffer) < len(MAGIC) + 1:
+        conn.buffer += conn.recv()
+    if not conn.buffer.startswith(MAGIC):
+        raise ConnectionError("Server does not support binary protocol, try the text protocol")
+    conn.version = conn.buffer[len(MAGIC)]
+    del conn.buffer[:len(MAGIC) + 1]
+    return conn
+
+def raise_open_files_limit():
+    # Raise soft limit of open file descriptors to the hard limit, every connection needs one. Used by the servers
+    # and the load generators. Imported here, resource is Unix only and clients on other systems never need it.
+    import resource
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
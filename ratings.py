@@ -0,0 +1,192 @@
+import argparse
+import os
+import time
+import engine
+import recording
+import store
+
+# Elo ratings of players, updated with every win and draw in the same transaction as the win, loss and draw
+# counts of both players and of the pair. A rating moves by K_FACTOR times the difference between the result
+# and the result expected from both ratings. python ratings.py recompute rates all recorded games again, e.g.
+# after changing K_FACTOR, which the restarted game servers then rate new games with: games are grouped into
+# rounds in which no player plays twice and every round is rated with a few NumPy operations, the ratings come
+# out the same as rating game by game. Counts of every player and pair come from the same pass. Stop the game
+# server first, games it records meanwhile are not rated.
+
+INITIAL_RATING = 1500.0 # Rating of a player's first game
+K_FACTOR = 32.0 # Largest change of a rating in one game
+SCALE = 400.0 # Rating difference at which the better player is expected to score 10 times as much
+UNRATED = ('server',) # Opponent played by the server, games against it are not rated
+MIN_ROUND_WIDTH = 256 # Average games per round below which rating game by game is faster than NumPy
+
+SCORES = {recording.X_WINS: 1.0, recording.O_WINS: 0.0, recording.DRAW: 0.5} # Score of X by recorded result, games a player left are not rated
+
+def rated(game):
+    # Whether a finished game changes the ratings of its players
+    return game.result in SCORES and game.x not in UNRATED and game.o not in UNRATED
+
+def update(rating_x, rating_o, score, k=K_FACTOR, initial=INITIAL_RATING):
+    # New ratings of X and O after a game, None is the rating of a player without one
+    rating_x = initial if rating_x is None else rating_x
+    rating_o = initial if rating_o is None else rating_o
+    change = k * (score - 1 / (1 + 10 ** ((rating_o - rating_x) / SCALE)))
+    return rating_x + change, rating_o - change
+
+def record_offsets(data):
+    # Offsets of the records in a segment's bytes, a record still being written at the end is left out
+    size = recording.RECORD_HEAD.size
+    offsets = []
+    position = 0
+    while position + size <= len(data):
+        end = position + size + data[position + size - 1]
+        if end > len(data):
+            break
+        offsets.append(position)
+        position = end
+    return offsets
+
+def read_games(np, log):
+    # Player numbers of X and O and the result of every recorded game, oldest first. With NumPy the head fields
+    # are gathered from all records at once.
+    xs, os_, results = [], [], []
+    unpack = recording.RECORD_HEAD.unpack_from
+    for segment in log.segments():
+        with open(log.segment_path(segment), 'rb') as file:
+            data = file.read()
+        offsets = record_offsets(data)
+        if np is None:
+            for offset in offsets:
+                _, _, x, o, _, _, result, _ = unpack(data, offset)
+                xs.append(x)
+                os_.append(o)
+                results.append(result)
+            continue
+        data = np.frombuffer(data, dtype=np.uint8)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        # Player numbers are big-endian 4 byte fields at 8 and 12, the result is the byte at 18
+        for column, field in ((xs, 8), (os_, 12)):
+            column.append(sum(data[offsets + field + byte].astype(np.int64) << (24 - 8 * byte) for byte in range(4)))
+        results.append(data[offsets + 18])
+    if np is None:
+        return xs, os_, results
+    if not results:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint8)
+    return np.concatenate(xs), np.concatenate(os_), np.concatenate(results)
+
+def rate_sequential(xs, os_, scores, players, k, initial):
+    # Ratings game by game, update() inlined
+    ratings = [float(initial)] * players
+    for x, o, score in zip(xs, os_, scores):
+        rating_x = ratings[x]
+        rating_o = ratings[o]
+        change = k * (score - 1 / (1 + 10 ** ((rating_o - rating_x) / SCALE)))
+        ratings[x] = rating_x + change
+        ratings[o] = rating_o - change
+    return ratings
+
+def rounds(xs, os_, players):
+    # Round of every game: one after the last round of both players, so a player's games keep their order
+    last = [0] * players
+    levels = []
+    for x, o in zip(xs, os_):
+        level = last[x] if last[x] > last[o] else last[o]
+        level += 1
+        last[x] = last[o] = level
+        levels.append(level)
+    return levels
+
+def rate_batch(np, xs, os_, scores, levels, players, k, initial):
+    # Ratings round by round, games of a round have no player in common and are rated at once
+    xs = np.asarray(xs, dtype=np.int64)
+    os_ = np.asarray(os_, dtype=np.int64)
+    scores = np.asarray(scores, dtype=np.float64)
+    levels = np.asarray(levels)
+    order = np.argsort(levels, kind='stable')
+    xs, os_, scores = xs[order], os_[order], scores[order]
+    bounds = np.cumsum(np.bincount(levels)).tolist()
+    ratings = np.full(players, initial, dtype=np.float64)
+    start = 0
+    for end in bounds:
+        if end == start:
+            continue
+        x, o = xs[start:end], os_[start:end]
+        rating_x, rating_o = ratings[x], ratings[o]
+        change = k * (scores[start:end] - 1 / (1 + 10 ** ((rating_o - rating_x) / SCALE)))
+        ratings[x] = rating_x + change
+        ratings[o] = rating_o - change
+        start = end
+    return ratings.tolist()
+
+def count_results(np, xs, os_, scores, players, ranks):
+    # Wins, losses and draws of every player, and columns of player, opponent, wins, losses and draws of every
+    # pair both ways round. ranks orders the players by nickname, pairs come sorted by it as the table's key.
+    if np is None:
+        totals = [[0, 0, 0] for _ in range(players)]
+        pairs = {}
+        for x, o, score in zip(xs, os_, scores):
+            column = 0 if score == 1 else 1 if score == 0 else 2
+            totals[x][column] += 1
+            totals[o][(1, 0, 2)[column]] += 1
+            pairs.setdefault((x, o), [0, 0, 0])[column] += 1
+            pairs.setdefault((o, x), [0, 0, 0])[(1, 0, 2)[column]] += 1
+        rows = sorted(pairs.items(), key=lambda item: (ranks[item[0][0]], ranks[item[0][1]]))
+        return totals, [list(column) for column in zip(*((x, o, *counts) for (x, o), counts in rows))] or [[]] * 5
+    # Column of the result from the side of X: 0 win, 1 loss, 2 draw, and from the side of O
+    column = np.where(scores == 1, 0, np.where(scores == 0, 1, 2))
+    swapped = np.array((1, 0, 2))[column]
+    totals = np.bincount(np.concatenate((xs * 3 + column, os_ * 3 + swapped)), minlength=players * 3).reshape(players, 3)
+    # Pairs are counted once from the side of the lower player number, then written both ways round
+    low = np.minimum(xs, os_)
+    high = np.maximum(xs, os_)
+    keys, inverse = np.unique(low * players + high, return_inverse=True)
+    counts = np.bincount(inverse * 3 + np.where(xs == low, column, swapped), minlength=len(keys) * 3).reshape(-1, 3)
+    low, high = keys // players, keys % players
+    pairs = np.concatenate((np.column_stack((low, high, counts)), np.column_stack((high, low, counts[:, [1, 0, 2]]))))
+    ranks = np.asarray(ranks)
+    pairs = pairs[np.lexsort((ranks[pairs[:, 1]], ranks[pairs[:, 0]]))]
+    return totals.tolist(), pairs.T.tolist()
+
+def recompute(log, scores, unrated=UNRATED):
+    # Rate all recorded games of log again and replace the ratings in scores. Returns the number of rated games.
+    # K_FACTOR and INITIAL_RATING are the ones the game servers rate new games with, so all ratings share a scale.
+    np = engine.load_numpy()
+    xs, os_, results = read_games(np, log)
+    log.load_players()
+    players = len(log.players)
+    skip = [log.numbers[nickname] for nickname in unrated if nickname in log.numbers]
+    if np is None:
+        games = [(x, o, SCORES[result]) for x, o, result in zip(xs, os_, results)
+                 if result in SCORES and x not in skip and o not in skip]
+        xs, os_, game_scores = (list(column) for column in zip(*games)) if games else ([], [], [])
+        ratings = rate_sequential(xs, os_, game_scores, players, K_FACTOR, INITIAL_RATING)
+    else:
+        keep = np.isin(results, list(SCORES)) & ~np.isin(xs, skip) & ~np.isin(os_, skip)
+        xs, os_ = xs[keep], os_[keep]
+        game_scores = np.array([SCORES.get(result, 0.0) for result in range(len(recording.RESULTS))])[results[keep]]
+        levels = rounds(xs.tolist(), os_.tolist(), players)
+        if levels and len(levels) / max(levels) >= MIN_ROUND_WIDTH:
+            ratings = rate_batch(np, xs, os_, game_scores, levels, players, K_FACTOR, INITIAL_RATING)
+        else:
+            ratings = rate_sequential(xs.tolist(), os_.tolist(), game_scores.tolist(), players, K_FACTOR, INITIAL_RATING)
+    # Rows go to the database in the order of its keys, nicknames compare like Python strings there
+    nicknames = log.players
+    ranks = [0] * players
+    for rank, player in enumerate(sorted(range(players), key=nicknames.__getitem__)):
+        ranks[player] = rank
+    totals, (pair_players, opponents, *counts) = count_results(np, xs, os_, game_scores, players, ranks)
+    scores.replace_ratings(
+        [(nicknames[player], ratings[player], *totals[player]) for player in range(players) if any(totals[player])],
+        zip(map(nicknames.__getitem__, pair_players), map(nicknames.__getitem__, opponents), *counts))
+    return len(xs)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rate all recorded games again")
+    parser.add_argument('command', choices=['recompute'])
+    parser.add_argument('--database', default=store.DATABASE, help="database file")
+    parser.add_argument('--games-dir', default=recording.GAMES_DIR, help="game log directory")
+    args = parser.parse_args()
+    if not os.path.isdir(args.games_dir):
+        parser.error(f"no game log in {args.games_dir}")
+    started = time.perf_counter()
+    count = recompute(recording.GameLog(args.games_dir), store.ScoreStore(args.database))
+    print(f"Rated {count} games in {time.perf_counter() - started:.1f} s.")
@@ -0,0 +1,257 @@
+import argparse
+import json
+import os
+import struct
+import sys
+import threading
+import time
+from flask import Response
+from engine import Rules
+import store
+
+# Moves of every finished game, also draws and games a player left, in an append-only binary log. A record is
+# a fixed head followed by one byte per move, a classic game takes 20 + 9 bytes instead of the ~100 bytes of a
+# JSON history entry. Players are numbered in players.jsonl, the records hold their numbers. A game is found
+# by its id "segment-offset", like history cursors, and the history entry of a win links to it.
+# python recording.py export --format csv > games.csv decodes all games, --format binary copies the records.
+
+GAMES_DIR = 'games' # Directory of game log segments and the player table
+SEGMENT_BYTES = 16 * 1024 * 1024 # Size after which the game log continues in a new segment
+EXPORT_CHUNK = 1024 * 1024 # Bytes of records read and written at once by exports
+RECORD_HEAD = struct.Struct('!IIIIBBBB') # Start (unix seconds), duration (ms), X and O player numbers, rows and columns (4 bits each), k, result, number of moves
+MAX_DURATION = 0xFFFFFFFF # Longest duration a record holds, in ms
+
+# Results of a game
+DRAW = 0
+X_WINS = 1
+O_WINS = 2
+X_LEFT = 3
+O_LEFT = 4
+RESULTS = ('draw', 'X wins', 'O wins', 'X left', 'O left')
+CSV_HEADER = ('game', 'start', 'duration_ms', 'x', 'o', 'rows', 'cols', 'k', 'result', 'moves')
+
+def won_by(mark):
+    return X_WINS if mark == 'X' else O_WINS
+
+def left_by(mark):
+    return X_LEFT if mark == 'X' else O_LEFT
+
+class Game:
+    # Game being played, the server hands it to GameLog.append() when it ends
+    def __init__(self, x, o, rules):
+        self.x = x
+        self.o = o
+        self.rules = rules
+        self.moves = bytearray() # Cells in the order they were played, X plays first
+        self.start = time.time()
+        self.duration = 0.0
+        self.result = None
+
+    def play(self, cell):
+        self.moves.append(cell)
+
+    def finish(self, result):
+        self.result = result
+        self.duration = time.time() - self.start
+        return self
+
+def decode(data, offset):
+    # Record at offset of a segment's bytes as head fields and moves, None for a record cut off at the end
+    end = offset + RECORD_HEAD.size
+    if end > len(data):
+        return None
+    head = RECORD_HEAD.unpack_from(data, offset)
+    if end + head[-1] > len(data):
+        return None
+    return head, data[end:end + head[-1]]
+
+def csv_field(text):
+    # Text as a CSV field, quoted like csv.writer does when needed
+    if any(char in text for char in ',"\r\n'):
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+def game_json(game_id, head, moves, players):
+    # Record as JSON for replays
+    start, duration, x, o, sides, k, result, _ = head
+    return {
+        'game': game_id,
+        'start': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start)),
+        'duration': duration / 1000,
+        'x': players[x],
+        'o': players[o],
+        'rules': [sides >> 4, sides & 15, k],
+        'result': RESULTS[result],
+        'moves': list(moves),
+    }
+
+class GameLog:
+    # Segments are written by one process, the game server or the supervisor of its workers. Other processes
+    # read them and reload the player table when it grew.
+    def __init__(self, directory=GAMES_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.players_path = os.path.join(directory, 'players.jsonl')
+        self.players = [''] # Nickname by player number, 0 is nobody
+        self.numbers = {} # Player number by nickname
+        self.players_size = 0 # Bytes of players.jsonl loaded or written by this process
+        self.lock = threading.Lock() # Games end in many game threads, pages and exports reload the player table
+        self.load_players()
+        self.file = None # Newest segment, opened on first append
+        self.players_file = None
+
+    def load_players(self):
+        # Players added to players.jsonl by another process since it was last read
+        with self.lock:
+            if not os.path.exists(self.players_path) or os.path.getsize(self.players_path) == self.players_size:
+                return
+            with open(self.players_path, 'rb') as file:
+                file.seek(self.players_size)
+                data = file.read()
+            # A line still being written is read next time
+            data = data[:data.rfind(b'\n') + 1]
+            for line in data.splitlines():
+                nickname = json.loads(line)
+                if nickname not in self.numbers:
+                    self.numbers[nickname] = len(self.players)
+                    self.players.append(nickname)
+            self.players_size += len(data)
+
+    def player(self, nickname):
+        # Number of a player, new players are added to the table. Called holding the lock.
+        number = self.numbers.get(nickname)
+        if number is None:
+            if self.players_file is None:
+                self.players_file = open(self.players_path, 'ab')
+            line = (json.dumps(nickname) + '\n').encode()
+            self.players_file.write(line)
+            self.players_file.flush()
+            # Lines this process wrote are not loaded again
+            self.players_size += len(line)
+            number = self.numbers[nickname] = len(self.players)
+            self.players.append(nickname)
+        return number
+
+    def segments(self):
+        # Segment numbers, oldest first
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith('.bin'))
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f'{segment:06d}.bin')
+
+    def version(self):
+        # End of the log, changes with every game appended by any process
+        segments = self.segments()
+        if not segments:
+            return '0'
+        return f"{segments[-1]}-{os.path.getsize(self.segment_path(segments[-1]))}"
+
+    def append(self, game):
+        # Record a finished game, returns its id
+        rules = game.rules
+        with self.lock:
+            head = RECORD_HEAD.pack(int(game.start), min(int(game.duration * 1000), MAX_DURATION), self.player(game.x),
+                                    self.player(game.o), rules.rows << 4 | rules.cols, rules.k, game.result, len(game.moves))
+            if self.file is None or self.file.tell() >= SEGMENT_BYTES:
+                segments = self.segments()
+                segment = segments[-1] if segments else 1
+                if segments and os.path.getsize(self.segment_path(segment)) >= SEGMENT_BYTES:
+                    segment += 1
+                if self.file is not None:
+                    self.file.close()
+                self.file = open(self.segment_path(segment), 'ab')
+                self.segment = segment
+            game_id = f"{self.segment}-{self.file.tell()}"
+            self.file.write(head + game.moves)
+            self.file.flush()
+        return game_id
+
+    def read(self, game_id):
+        # Game as JSON, None for an unknown id
+        position = store.parse_cursor(game_id)
+        if position is None:
+            return None
+        segment, offset = position
+        try:
+            with open(self.segment_path(segment), 'rb') as file:
+                file.seek(offset)
+                record = decode(file.read(RECORD_HEAD.size + 255), 0)
+        except (OSError, ValueError):
+            return None
+        if record is None:
+            return None
+        self.load_players()
+        head, moves = record
+        # An id that is not the start of a record reads as garbage
+        rules = Rules(head[4] >> 4, head[4] & 15, head[5])
+        if (max(head[2], head[3]) >= len(self.players) or head[6] >= len(RESULTS) or not rules.is_valid()
+                or len(set(moves)) != len(moves) or any(cell >= rules.cells for cell in moves)):
+            return None
+        return game_json(game_id, head, moves, self.players)
+
+    def export_csv(self):
+        # CSV text of all games in EXPORT_CHUNK pieces, players by nickname and moves as the hex of their cells.
+        # Nicknames are quoted for CSV once per player instead of once per game.
+        self.load_players()
+        quoted = [csv_field(nickname) for nickname in self.players]
+        unpack = RECORD_HEAD.unpack_from
+        size = RECORD_HEAD.size
+        yield ','.join(CSV_HEADER) + '\r\n'
+        for segment in self.segments():
+            with open(self.segment_path(segment), 'rb') as file:
+                base = 0 # Segment offset of data
+                data = b''
+                while True:
+                    more = file.read(EXPORT_CHUNK)
+                    if not more:
+                        break
+                    data += more
+                    lines = []
+                    position = 0
+                    while position + size <= len(data):
+                        start, duration, x, o, sides, k, result, count = unpack(data, position)
+                        end = position + size + count
+                        if end > len(data):
+                            # Rest of the record is in the next chunk
+                            break
+                        if max(x, o) >= len(quoted):
+                            # Players added since the table was read
+                            self.load_players()
+                            quoted = [csv_field(nickname) for nickname in self.players]
+                        lines.append(f"{segment}-{base + position},{start},{duration},{quoted[x]},{quoted[o]},{sides >> 4},"
+                                     f"{sides & 15},{k},{RESULTS[result]},{data[position + size:end].hex()}\r\n")
+                        position = end
+                    yield ''.join(lines)
+                    base += position
+                    data = data[position:]
+
+    def export_binary(self):
+        # Records as they are stored, RECORD_HEAD and moves one after another, players numbered as in players.jsonl
+        for segment in self.segments():
+            with open(self.segment_path(segment), 'rb') as file:
+                while True:
+                    data = file.read(EXPORT_CHUNK)
+                    if not data:
+                        break
+                    yield data
+
+def export(log, format):
+    # Streamed response with all games of log as CSV or as stored records
+    if format == 'binary':
+        return Response(log.export_binary(), mimetype='application/octet-stream',
+                        headers={'Content-Disposition': 'attachment; filename=games.bin'})
+    return Response(log.export_csv(), mimetype='text/csv', headers={'Content-Disposition': 'attachment; filename=games.csv'})
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export recorded games")
+    parser.add_argument('command', choices=['export'])
+    parser.add_argument('--format', choices=['csv', 'binary'], default='csv', help="decoded CSV or the stored records")
+    parser.add_argument('--games-dir', default=GAMES_DIR, help="game log directory")
+    args = parser.parse_args()
+    log = GameLog(args.games_dir)
+    if args.format == 'csv':
+        for text in log.export_csv():
+            sys.stdout.write(text)
+    else:
+        for data in log.export_binary():
+            sys.stdout.buffer.write(data)
@@ -0,0 +1,91 @@
+from flask import render_template, request
+import leaderboard
+import recording
+import store
+
+# Pages of the web dashboard, served by the game servers themselves or by dashboard.py. The game servers rank
+# players in memory, the separate dashboard reads the ranking from the store.
+
+def page_size(name, default, largest):
+    # Rows a client asks for with parameter name, from 1 to largest. SQLite reads a negative LIMIT as no limit.
+    return max(1, min(request.args.get(name, default, type=int), largest))
+
+def rank_asked():
+    # Rank a client looks around, ranks start at 1. None shows the top players.
+    rank = request.args.get('rank', type=int)
+    return None if rank is None else max(rank, 1)
+
+def register(app, scores, ranking, history, games, pages, updates):
+    # Add the dashboard routes to app. ranking answers scoreboard queries, scores holds the ratings, pages
+    # caches rendered pages and updates streams new results to open pages.
+
+    # Main game page
+    @app.route('/')
+    def indexMain():
+        return render_template('main.html')
+
+    # Scoreboard route
+    @app.route('/scoreboard')
+    def indexScoreboard():
+        # Top players by default, ?player= or ?rank= show the players around a rank
+        def render():
+            top = page_size('top', leaderboard.TOP_SIZE, leaderboard.MAX_TOP_SIZE)
+            player = request.args.get('player')
+            entries = ranking.query(player, rank_asked(), top)
+            return render_template('scoreboard.html', scoreboard=entries, player=player)
+        return pages.respond(render)
+
+    # Ratings route
+    @app.route('/ratings')
+    def indexRatings():
+        # Top rated players by default, ?player= shows the players around a player and their results against others
+        def render():
+            top = page_size('top', leaderboard.TOP_SIZE, leaderboard.MAX_TOP_SIZE)
+            player = request.args.get('player')
+            opponents = scores.head_to_head(player) if player else []
+            return render_template('ratings.html', ratings=scores.ratings(player, top), opponents=opponents, player=player)
+        return pages.respond(render)
+
+    # History route
+    @app.route('/history')
+    def indexHistory():
+        # One page read backwards from the log, older pages follow the cursor
+        def render():
+            limit = page_size('limit', store.PAGE_SIZE, store.MAX_PAGE_SIZE)
+            # The newest page is kept up to date by /history/events from the end of the log it shows
+            since = history.version()
+            page, cursor = history.page(request.args.get('cursor'), request.args.get('before'), limit)
+            newest = request.args.get('cursor') is None and request.args.get('before') is None
+            return render_template('history.html', history=page, cursor=cursor, limit=limit, live=newest, since=since)
+        return pages.respond(render)
+
+    # Live updates of the dashboard pages as Server-Sent Events
+    @app.route('/scoreboard/events')
+    def eventsScoreboard():
+        top = page_size('top', leaderboard.TOP_SIZE, leaderboard.MAX_TOP_SIZE)
+        return updates.scoreboard(request.args.get('player'), rank_asked(), top)
+
+    @app.route('/history/events')
+    def eventsHistory():
+        # Browsers reconnecting send the id of the last game they got
+        return updates.games(request.headers.get('Last-Event-ID') or request.args.get('since'))
+
+    # Moves of a recorded game, as a page stepping through them or as JSON
+    @app.route('/replay/<game_id>')
+    def indexReplay(game_id):
+        game = games.read(game_id)
+        if game is None:
+            return "Unknown game", 404
+        return render_template('replay.html', game=game)
+
+    @app.route('/games/<game_id>')
+    def gameMoves(game_id):
+        game = games.read(game_id)
+        if game is None:
+            return "Unknown game", 404
+        return game
+
+    # All recorded games, ?format=binary streams the records as stored
+    @app.route('/games/export')
+    def gamesExport():
+        return recording.export(games, request.args.get('format', 'csv'))
@@ -1,14 +1,27 @@
-from flask import Flask, render_template
+from flask import Flask
 import socket
+import os
 import logging
 import threading
-import atexit
-import random
+import argparse
+import itertools
 import time
-import json
-import os
 from datetime import datetime
 import ssl
+from engine import Board, MARKS, STANDARD, render_board
+import protocol
+import store
+import leaderboard
+import pagecache
+import solver
+import metrics
+import discovery
+import spectators
+import live
+import recording
+import ratings
+import timers
+import routes
 
 def get_server_ip():
     # Get server IP address by connecting to Google DNS server. If cannot connect, return localhost address
@@ -26,299 +39,520 @@ def get_server_ip():
 SERVER = get_server_ip() # Server IP
 PORT = 5050 # Server game port
 ADDR = (SERVER, PORT) # Server game IP and port
-FORMAT = 'utf-8' # Messages format
-DISCOVERY_PORT = 5051 # Discovery port that server is listening on
-MULTICAST_GROUP = '224.0.0.1' # Discovery multicast group that server is listening on
+CERT_DIR = os.path.dirname(os.path.abspath(__file__)) # sample_cert.pem and sample_key.pem are next to the server, whatever the working directory
+LISTEN_BACKLOG = 128 # Listen backlog of game socket, every connection is handed to its own thread right away
+LOBBY_TIMEOUT = 10.0 # Seconds a new connection gets to finish TLS handshake and send its nickname
+MOVE_TIMEOUT = 10.0 # Seconds a player gets for a turn, the best move is played for a player that did not move
+REMATCH_TIMEOUT = 30.0 # Seconds a player gets after a result to ask for a rematch or a new opponent
+DASHBOARD_PORT = 5000 # Port of the web dashboard
+METRICS_PORT = 5001 # Port of /metrics when the dashboard runs in its own process on DASHBOARD_PORT
+CAPACITY = 200 # Players the server is sized for, discovery replies report it to clients choosing a server
+
+def discovery_load():
+    # Active games, waiting players and capacity for discovery replies
+    return metrics.ACTIVE_GAMES.get(), metrics.WAITING_PLAYERS.get(), CAPACITY
 
 def handle_discovery():
-    # Multicast UDP service discovery handler. Allows clients on the network to discover the server's address by sending a multicast message "DISCOVER_SERVER".
-    discovery_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-    discovery_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    discovery_socket.bind(('', DISCOVERY_PORT))
-    group = socket.inet_aton(MULTICAST_GROUP)
-    mreq = group + socket.inet_aton('0.0.0.0')
-    discovery_socket.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
-    while True:
-        data, addr = discovery_socket.recvfrom(1024)
-        if data.decode(FORMAT) == "DISCOVER_SERVER":
-            discovery_socket.sendto(f"{SERVER}:{PORT}".encode(FORMAT), addr)
+    # Multicast UDP service discovery handler. Allows clients on the network to discover the server's address and load.
+    discovery.serve(SERVER, PORT, discovery_load)
 
 # Start discovery service as a separate thread
 discovery_thread = threading.Thread(target=handle_discovery, daemon=True)
 discovery_thread.start()
 
+class TextConnection(protocol.Connection):
+    # Text protocol spoken by client.py, kept for clients that do not negotiate the binary protocol
+    def send_text(self, string):
+        self.write(string.encode())
+
+    def parse_move(self, data):
+        move = data.decode().strip()
+        return int(move) - 1 if move.isdigit() else None
+
+    def send_waiting(self):
+        self.send_text("Waiting for the second player...\n")
+
+    def send_start(self, mark, opponent):
+        self.send_text(f"Game starting! Your opponent is {opponent}\n")
+        self.send_text("The game has started!\n")
+
+    def send_board(self, board, last_move=None, timeout=False, your_turn=False):
+        if last_move is not None:
+            self.send_text(f"Move {last_move + 1} (timeout)\n" if timeout else f"Move {last_move + 1}\n")
+        self.send_text(render_board(board))
+        if your_turn:
+            self.send_prompt(board, board.next_mark())
+
+    def send_prompt(self, board, mark):
+        self.send_text("Your turn! Enter the position (1-9): ")
+
+    def send_invalid(self):
+        # Text clients validate moves themselves, invalid input gets no answer
+        pass
+
+    def send_win(self, mark, winner):
+        self.send_text(f"Game over! Winner: {winner}.\nScoreboard and history of games can be seen under: http://{SERVER}:5000")
+
+    def send_draw(self):
+        self.send_text("Game over! It's a draw!\n")
+
+    def send_left(self, nickname):
+        self.send_text(f"Your opponent {nickname} has left the game. Please play another one.")
+
 class TicTacToeServer:
     def __init__(self, host=SERVER, port=PORT):
         # Add securing TCP connection with TLS and server's cert and key
         self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        self.context.load_cert_chain(certfile="sample_cert.pem", keyfile="sample_key.pem")
+        self.context.load_cert_chain(certfile=os.path.join(CERT_DIR, "sample_cert.pem"), keyfile=os.path.join(CERT_DIR, "sample_key.pem"))
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.server_socket.bind((host, port))
-        self.server_socket.listen(2)
-        self.players = []
-        self.board = [' ' for _ in range(9)]
-        self.current_turn = 0
-        self.scoreboard = self.load_scoreboard()
-        self.history = self.load_history()
-        self.lock = threading.Lock()
-        self.game_active = False
+        self.server_socket.listen(LISTEN_BACKLOG)
+        self.rooms = {} # Rooms with a game in progress or a player waiting, by room id
+        self.open_rooms = {} # Room waiting for its second player by rules
+        self.room_ids = itertools.count(1)
+        self.rooms_lock = threading.Lock()
+        self.scores = store.open_store() # Scoreboard, scoreboard.json is imported on first start
+        self.ranking = leaderboard.Leaderboard(self.scores.scoreboard()) # Ranked copy of the scoreboard for the dashboard
+        self.history = store.open_history() # Append-only log, history.json is imported on first start
+        self.games = recording.GameLog() # Moves of every finished game
+        self.pages = pagecache.PageCache() # Rendered dashboard pages, invalidated by every result
+        self.updates = live.Broadcaster(self.ranking.query, self.history) # Pushes new results to open dashboard pages
+        self.watchers = spectators.Directory(spectators.ThreadHub()) # Rooms spectators can watch by nickname of their players
+        self.deadlines = timers.TimerWheel() # Move deadlines and lobby timeouts of all rooms
+        metrics.ACTIVE_GAMES.function = self.active_games
+        metrics.WAITING_PLAYERS.function = self.waiting_players
+        metrics.TIMERS.function = self.deadlines.pending
         logging.info("Server started, waiting for players...")
 
-    def load_history(self):
-        # Load history variable from history.json   
-        if not os.path.exists('history.json'):
-            with open('history.json', 'w') as file:
-                json.dump([], file)
-        with open('history.json', 'r') as file:
-            return json.load(file)
-
-    def save_history(self):
-        # Save current history to history.json
-        with open('history.json', 'w') as file:
-            json.dump(self.history, file, indent=4)
-
-    def load_scoreboard(self):
-        # Load scoreboard variable from scoreboard.json
-        if not os.path.exists('scoreboard.json'):
-            with open('scoreboard.json', 'w') as file:
-                json.dump([], file)
-        with open('scoreboard.json', 'r') as file:
-            return json.load(file)
-
-    def save_scoreboard(self):
-        # Save current scoreboard to scoreboard.json
-        with open('scoreboard.json', 'w') as file:
-            json.dump(self.scoreboard, file, indent=4)
-
-    def update_flask(self, winner, loser):
-        # Update current results available on flask app
-        found = False
-        # Add point for a winner
-        for entry in self.scoreboard:
-            if entry['nickname'] == winner:
-                logging.info(f"+1 point for {winner}.")
-                entry['score'] += 1
-                found = True
-                break
-        if not found:
-            logging.info(f"Adding new player: {winner}.")
-            self.scoreboard.append({'nickname': winner, 'score': 1})
-        
-        # Remove point for a loser
-        for entry in self.scoreboard:
-            if entry['nickname'] == loser:
-                logging.info(f"-1 point for {loser}.")
-                entry['score'] -= 1
-
-        # Update history
+    def update_flask(self, winner, loser, game=None):
+        # Update current results available on flask app, rooms finish their games concurrently. The moves of
+        # game are recorded first, only the moves are kept of games without a winner.
+        game_id = None
+        if game is not None:
+            game_id = metrics.timed(metrics.GAMES_WRITE, self.games.append, game)
+            if ratings.rated(game):
+                # Wins and draws change the ratings of both players
+                metrics.timed(metrics.RATINGS_WRITE, self.scores.record_rating, game.x, game.o, ratings.SCORES[game.result], ratings.update)
+                if winner is None:
+                    self.pages.bump()
+        if winner is None:
+            return
+        # Points of both players are committed in one transaction of the store
+        metrics.timed(metrics.SCORES_WRITE, self.scores.record_result, winner, loser)
+        self.ranking.record_result(winner, loser)
+        # Update history, the log takes appends from many rooms
         game_result = {
             'nicknames': f"{winner}-{loser}",
             'winner': winner,
             'date': datetime.today().strftime('%Y-%m-%d %H:%M:%S')
         }
-        self.history.append(game_result)
+        if game_id is not None:
+            game_result['game'] = game_id
+        position = metrics.timed(metrics.HISTORY_WRITE, self.history.append, game_result)
+        self.pages.bump()
+        self.updates.record(game_result, position)
+
+    def active_games(self):
+        return sum(room.game_active for room in list(self.rooms.values()))
+
+    def waiting_players(self):
+        # Every open room has one player waiting for the second one
+        return len(self.open_rooms)
 
     def start(self):
         # Start game thread
         threading.Thread(target=self.accept_clients, daemon=True).start()
 
     def accept_clients(self):
-        # Accept client connection and create their own socket and thread that handle them
+        # Accept client connections and create thread that handles each of them
         while True:
-            if len(self.players) < 1:
-                client_socket, addr = self.server_socket.accept()
-                logging.info(f"Player connected from {addr}")
-                # Use secure TLS connection
-                client_socket = self.context.wrap_socket(client_socket, server_side=True)
-                threading.Thread(target=self.handle_client, args=(client_socket,)).start()
+            client_socket, addr = self.server_socket.accept()
+            logging.info(f"Player connected from {addr}")
+            threading.Thread(target=self.handle_client, args=(client_socket,), daemon=True).start()
+
+    def join_room(self, conn, nickname, open_room=False):
+        # Put player into the room with the player's rules waiting for a second player. Without one a new room is
+        # opened if open_room is set, otherwise None is returned.
+        with self.rooms_lock:
+            room = self.open_rooms.get(conn.rules)
+            if room is None:
+                if not open_room:
+                    return None, False
+                room = GameRoom(self, next(self.room_ids), conn.rules)
+                self.rooms[room.room_id] = room
+                self.open_rooms[conn.rules] = room
+                logging.info(f"Room {room.room_id} opened for {conn.rules}.")
+            with room.lock:
+                room.players.append((conn, nickname))
+                full = len(room.players) == 2
+                if full:
+                    room.game_active = True
+                    room.changed.notify_all()
+                    del self.open_rooms[conn.rules]
+        return room, full
+
+    def close_room(self, room):
+        # Tear down room after its game ends
+        with self.rooms_lock:
+            self.rooms.pop(room.room_id, None)
+            if self.open_rooms.get(room.board.rules) is room:
+                del self.open_rooms[room.board.rules]
+        if room.channel is not None:
+            self.watchers.close(room.channel)
+        logging.info(f"Room {room.room_id} closed.")
 
     def handle_client(self, client_socket):
         # Main function that handles client connection
-        nickname = client_socket.recv(1024).decode().strip()
-        self.lock.acquire()
-        self.players.append((client_socket, nickname))
-        if len(self.players) == 2:
-            self.game_active = True
-            self.lock.release()
-            self.start_game()
-        else:
-            self.lock.release()
-            client_socket.sendall("Waiting for the second player...\n".encode())
+        deadline = None
+        try:
+            # Use secure TLS connection, a client that does not finish the handshake and send its nickname
+            # within LOBBY_TIMEOUT is cut off by the timer wheel
+            client_socket = self.context.wrap_socket(client_socket, server_side=True, do_handshake_on_connect=False)
+            deadline = self.deadlines.schedule(LOBBY_TIMEOUT, timers.interrupt, client_socket)
+            metrics.timed(metrics.HANDSHAKE, client_socket.do_handshake)
+            conn, nickname = protocol.accept(client_socket, TextConnection)
+            if not deadline.cancel():
+                raise TimeoutError("lobby timeout")
+        except Exception as e:
+            logging.error(f"Could not admit player: {e}.")
+            if deadline is not None:
+                deadline.cancel()
+            client_socket.close()
+            return
+        if conn.spectate:
+            # Spectators never join a room, their writer thread owns the connection
+            if not self.watchers.watch(conn, nickname):
+                conn.close()
+            return
+        # Binary clients keep the connection after a game and choose a rematch or a new opponent
+        room = self.find_game(conn, nickname)
+        while room is not None:
+            room.play_game(conn, nickname)
+            if room.called_off:
+                # Rematch could not start as the opponent's connection broke, the player looks for a new opponent
+                room = self.find_game(conn, nickname) if room.leave(conn) else None
+                continue
+            choice = room.read_choice(conn)
+            if room.rematch(conn, choice):
+                continue
+            room.leave(conn)
+            if choice is None:
+                conn.close()
+                return
+            room = self.find_game(conn, nickname)
 
-        while not self.game_active:
-            time.sleep(1)
+    def find_game(self, conn, nickname):
+        # Matchmaking, returns the room once its game started, or None when the player's connection broke
+        queued = time.perf_counter()
+        while True:
+            room, full = self.join_room(conn, nickname)
+            if room is None:
+                # Told before the player can be paired, so the message never races the start of the game on the socket
+                try:
+                    conn.send_waiting()
+                except OSError as e:
+                    logging.error(f"{e} error occurred. Connection closed by client.")
+                    conn.close()
+                    return None
+                room, full = self.join_room(conn, nickname, open_room=True)
+            if full:
+                room.start_game()
+            with room.lock:
+                room.changed.wait_for(lambda: room.started or room.called_off)
+            if not room.called_off:
+                metrics.MATCHMAKING.observe(time.perf_counter() - queued)
+                return room
+            # A player whose connection broke while waiting is dropped, the other one looks for a new opponent
+            if not room.leave(conn):
+                return None
 
-        self.play_game(client_socket, nickname)
+class GameRoom:
+    # Single game session between two players with its own board, turn and lock, so rooms never block each other
+    def __init__(self, server, room_id, rules=STANDARD):
+        self.server = server
+        self.room_id = room_id
+        self.players = []
+        self.board = Board(rules=rules)
+        self.current_turn = 0
+        self.lock = metrics.TimedLock(metrics.ROOM_LOCK)
+        self.changed = threading.Condition(self.lock) # Notified when a game starts or ends, the turn passes or a player chooses
+        self.game_active = False
+        self.started = False # Players were sent the start of the active game
+        self.called_off = False # Game could not start as a player's connection broke, the room is left
+        self.turn = 0 # Number of the turn being played, counted over all games of the room
+        self.deadline = None # Timer of the turn being played
+        self.timed_out = None # Turn whose deadline passed, a waiting player thread plays the best move for it
+        self.waiting = 0 # Player threads waiting in play_game
+        self.prompted = 0.0 # perf_counter() time the player on turn was asked for the move
+        self.choices = {} # Choices of players after the game by connection
+        self.choice_deadlines = {} # Timers cutting off players that do not choose after the game, by connection
+        self.channel = None # Spectators of the room's games, opened when the first game starts
+        self.game = None # Moves of the current game
+        self.ended = None # Result of the game that just ended, recorded and sent by announce() without the lock
 
     def start_game(self):
-        # Both players are found and game starts
-        for player in self.players:
-            player[0].sendall(f"Game starting! Your opponent is {self.players[1 - self.players.index(player)][1]}\n".encode())
-        self.broadcast("The game has started!\n")
+        # Both players are found and game starts. A player that left while waiting is noticed here, the game is
+        # called off then.
+        dead = [conn for conn, _ in self.players if conn.peer_closed()]
+        if not dead:
+            for index, (conn, _) in enumerate(self.players):
+                try:
+                    conn.send_start(MARKS[index], self.players[1 - index][1])
+                except OSError as e:
+                    logging.error(f"{e} error occurred while starting a game.")
+                    dead.append(conn)
+        if dead:
+            self.call_off(dead)
+            return
+        nicknames = [nickname for _, nickname in self.players]
+        if self.channel is None:
+            self.channel = self.server.watchers.open(*nicknames)
+        self.channel.start(*nicknames, self.board)
+        self.game = recording.Game(*nicknames, self.board.rules)
         self.broadcast_board()
+        with self.lock:
+            self.started = True
+            self.prompt()
+            self.changed.notify_all()
 
-    def play_game(self, client_socket, nickname):
-        # Logic for tic-tac-toe game
-        while self.game_active:
-            self.lock.acquire()
+    def play_game(self, conn, nickname):
+        # Moves of one player in one game. The player's thread sleeps until the player is on turn and then reads
+        # the move without the lock, the deadline of the turn can pass meanwhile.
+        while True:
+            self.announce()
+            with self.lock:
+                self.waiting += 1
+                try:
+                    self.changed.wait_for(lambda: not self.game_active or self.timed_out == self.turn
+                                          or self.started and self.players[self.current_turn][0] is conn)
+                finally:
+                    self.waiting -= 1
+                if not self.game_active:
+                    return
+                if self.timed_out == self.turn:
+                    # Deadline of the turn passed, usually the opponent's thread plays the best move for the player
+                    self.play(self.timeout_move(), timeout=True)
+                    continue
             try:
-                if self.players[self.current_turn][1] == nickname:
-                    client_socket.sendall("Your turn! Enter the position (1-9): ".encode())
-                    # Set timeout and if the timeout is reached random move is performed
-                    client_socket.settimeout(10.0)
-                    move = client_socket.recv(1024).decode().strip()
-                    if move.isdigit() and 1 <= int(move) <= 9 and self.board[int(move) - 1] == ' ':
-                        move = int(move) - 1
-                        self.board[move] = 'X' if self.current_turn == 0 else 'O'
-                        self.broadcast(f"Move {move + 1}\n")
-                        self.broadcast_board()
-                        if self.check_winner():
-                            self.broadcast(f"Game over! Winner: {nickname}.\nScoreboard and history of games can be seen under: http://{SERVER}:5000")
-                            for _, n in self.players:
-                                if n != nickname:
-                                    loser = n
-                            self.update_flask(nickname, loser)
-                            self.game_active = False
-                        elif ' ' not in self.board:
-                            self.broadcast("Game over! It's a draw!\n")
-                            self.game_active = False
-                        self.current_turn = 1 - self.current_turn
-                    else:
-                        # Handle invalid move without sending on the SSL connection
-                        continue
-            except socket.timeout:
-                move = self.random_move()
-                self.board[move] = 'X' if self.current_turn == 0 else 'O'
-                self.broadcast(f"Move {move + 1} (timeout)\n")
-                self.broadcast_board()
-
-                if self.check_winner():
-                    self.broadcast(f"Game over! Winner: {nickname}.\nScoreboard and history of games can be seen under: http://{SERVER}:5000")
-                    for _, n in self.players:
-                        if n != nickname:
-                            loser = n
-                    self.update_flask(nickname, loser)
-                    self.game_active = False
-                elif ' ' not in self.board:
-                    self.broadcast("Game over! It's a draw!\n")
-                    self.game_active = False
-                self.current_turn = 1 - self.current_turn
-            # If any player ends the connection, the game is stopped and both clients are getting disconnected.
-            except ssl.SSLEOFError:
-                logging.error("SSL EOF error occurred. Connection closed by client.")
-                self.game_active = False
-                client_socket.close()
-                for player_socket, player_nickname in self.players:
-                    if player_socket == client_socket:
-                        disconnected_player = player_nickname
-                        break
-                for player_socket, player_nickname in self.players:
-                    if player_nickname != disconnected_player:
-                        player_socket.sendall(f"Your opponent {disconnected_player} has left the game. Please play another one.".encode())
-                        player_socket.shutdown(socket.SHUT_RDWR)
-                        player_socket.close()
-            # If any player ends the connection, the game is stopped and both clients are getting disconnected.
-            except ConnectionResetError:
-                logging.error("Connection reset by peer.")
-                self.game_active = False
-                client_socket.close()
-                for player_socket, player_nickname in self.players:
-                    if player_socket == client_socket:
-                        disconnected_player = player_nickname
-                        break
-                for player_socket, player_nickname in self.players:
-                    if player_nickname != disconnected_player:
-                        player_socket.sendall(f"Your opponent {disconnected_player} has left the game. Please play another one.".encode())
-                        player_socket.shutdown(socket.SHUT_RDWR)
-                        player_socket.close()
-            finally:
-                self.lock.release()
-                time.sleep(1)
-            
-        # Remove players after the game ends
+                move = conn.read_move()
+            except UnicodeDecodeError:
+                # Bytes of a text client that are no text are an invalid move
+                move = None
+            # If any player ends the connection, the game is stopped and the other player can look for a new game.
+            except OSError as e:
+                logging.error(f"{e} error occurred. Connection closed by client.")
+                self.player_left(conn)
+                return
+            with self.lock:
+                if not self.game_active:
+                    # The game ended while the move was read, the message is the player's choice of the next game
+                    conn.unread_move()
+                    return
+                if self.players[self.current_turn][0] is not conn:
+                    # Move came after the deadline, the best move was played instead
+                    continue
+                metrics.MOVE.observe(time.perf_counter() - self.prompted)
+                if move is not None and self.board.is_free(move):
+                    self.play(move)
+                else:
+                    # Handle invalid move, only binary clients get an answer. The turn keeps its deadline.
+                    conn.send_invalid()
+                    conn.send_prompt(self.board, MARKS[self.current_turn])
+
+    def call_off(self, dead):
+        # Drop players whose connection broke before the game started. The threads of the others wake up and
+        # leave the room for a new opponent, the last one closes it.
+        for conn in dead:
+            conn.close()
+        logging.info(f"Game in room {self.room_id} called off, a player left before the start.")
+        with self.lock:
+            self.players = [player for player in self.players if player[0] not in dead]
+            self.game_active = False
+            self.called_off = True
+            empty = not self.players
+            self.changed.notify_all()
+        if empty:
+            self.server.close_room(self)
+
+    def prompt(self):
+        # Ask the player on turn for a move, the best move is played for the player at the deadline.
+        # Called holding the lock. A player whose connection broke is noticed by the thread reading it.
+        self.prompted = time.perf_counter()
+        self.deadline = self.server.deadlines.schedule(MOVE_TIMEOUT, self.time_out, self.turn)
+        try:
+            self.players[self.current_turn][0].send_prompt(self.board, MARKS[self.current_turn])
+        except:
+            pass
+
+    def time_out(self, turn):
+        # Deadline of a turn passed. Runs on the timer wheel's thread, which must not wait for the room lock held
+        # while sending, so the turn is handed to a thread of its own.
+        threading.Thread(target=self.expire, args=(turn,), daemon=True).start()
+
+    def expire(self, turn):
+        # Mark the turn as timed out for a waiting player thread to play, or play it here when both players'
+        # threads are reading a move, which happens when both players let their turns time out
+        with self.lock:
+            if not self.game_active or self.turn != turn:
+                return
+            if self.waiting:
+                self.timed_out = turn
+                self.changed.notify_all()
+            else:
+                self.play(self.timeout_move(), timeout=True)
+        self.announce()
+
+    def play(self, move, timeout=False):
+        # Play move for the player on turn, then hand the turn over or end the game. Called holding the lock,
+        # the result of a game that ended is left to announce().
+        nickname = self.players[self.current_turn][1]
+        mark = MARKS[self.current_turn]
+        self.board.play(move, mark)
+        self.game.play(move)
+        self.broadcast_board(move, timeout)
+        if self.check_winner(move):
+            loser = self.players[1 - self.current_turn][1]
+            self.ended = (lambda c: c.send_win(mark, nickname), nickname, loser, self.game.finish(recording.won_by(mark)))
+            self.game_active = False
+        elif self.board.is_full():
+            self.ended = (lambda c: c.send_draw(), None, None, self.game.finish(recording.DRAW))
+            self.game_active = False
+        self.current_turn = 1 - self.current_turn
+        self.end_turn()
+        if self.game_active:
+            self.prompt()
+
+    def announce(self):
+        # Send the result of the game that ended and record it. Called after releasing the lock, so slow players
+        # and writes of the store never hold up the room's deadlines and the other player's thread.
+        with self.lock:
+            ended, self.ended = self.ended, None
+        if ended is None:
+            return
+        send, winner, loser, game = ended
+        self.broadcast(send)
+        self.server.update_flask(winner, loser, game)
+
+    def end_turn(self):
+        # Deadline of the turn is dropped and the threads waiting for their turn or the end of the game wake up.
+        # Called holding the lock.
+        self.turn += 1
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+        if not self.game_active:
+            # Players get REMATCH_TIMEOUT from the result to choose, also one whose thread is still reading a move
+            for conn, _ in self.players:
+                self.choice_deadlines[conn] = self.server.deadlines.schedule(REMATCH_TIMEOUT, timers.interrupt, conn.sock)
+        self.changed.notify_all()
+
+    def read_choice(self, conn):
+        # Choice of a player after the game, None for a player cut off at the deadline
+        choice = conn.read_choice()
+        with self.lock:
+            deadline = self.choice_deadlines.pop(conn, None)
+        return choice if deadline is None or deadline.cancel() else None
+
+    def player_left(self, conn):
+        # Connection of a player broke, the opponent is told unless the game was already over
+        conn.close()
+        with self.lock:
+            if not self.game_active:
+                return
+            self.game_active = False
+            for index, (player_conn, player_nickname) in enumerate(self.players):
+                if player_conn == conn:
+                    disconnected_player = player_nickname
+                    game = self.game.finish(recording.left_by(MARKS[index]))
+                    break
+            self.ended = (lambda c: c.send_left(disconnected_player), None, None, game)
+            self.end_turn()
+        self.announce()
+
+    def rematch(self, conn, choice):
+        # Record choice of a player after the game. Returns True when both players asked for a rematch,
+        # the room then starts a new game with swapped marks.
+        with self.lock:
+            self.choices[conn] = choice
+            restart = len(self.choices) == 2 and all(c == protocol.REMATCH for c in self.choices.values())
+            if restart:
+                self.players.reverse()
+                self.board = Board(rules=self.board.rules)
+                self.current_turn = 0
+                self.choices = {}
+                self.game_active = True
+                self.started = False
+            self.changed.notify_all()
+        if restart:
+            self.start_game()
+            return True
+        if choice != protocol.REMATCH:
+            return False
+        # Wait for the opponent's choice, which comes within REMATCH_TIMEOUT
+        with self.lock:
+            self.changed.wait_for(lambda: conn not in self.choices or len(self.choices) == 2)
+            return self.game_active
+
+    def leave(self, conn):
+        # Remove player after the game ends, the last one leaving tears the room down. False for a player
+        # that was dropped already.
         self.lock.acquire()
+        found = False
         for player in self.players:
-            if player[0] == client_socket:
+            if player[0] == conn:
                 self.players.remove(player)
+                found = True
                 break
-        self.board = [' ' for _ in range(9)]
+        empty = found and not self.players
         self.lock.release()
-        # Close the client socket after the game ends
-        client_socket.close()  
-
-    def random_move(self):
-        # Function taking random move after timeout for user's move
-        available_moves = [i for i, v in enumerate(self.board) if v == ' ']
-        return random.choice(available_moves)
-
-    def check_winner(self):
-        # Check if game is over
-        time.sleep(1)
-        winning_combinations = [
-            [0, 1, 2], [3, 4, 5], [6, 7, 8],  # Rows
-            [0, 3, 6], [1, 4, 7], [2, 5, 8],  # Columns
-            [0, 4, 8], [2, 4, 6]              # Diagonals
-        ]
-        for combo in winning_combinations:
-            if self.board[combo[0]] == self.board[combo[1]] == self.board[combo[2]] != ' ':
-                return True
-        return False
-
-    def broadcast(self, message):
-        # Send message to all players
-        for player in self.players:
+        if empty:
+            self.server.close_room(self)
+        return found
+
+    def timeout_move(self):
+        # Move played for a player that did not move in time, the best one for that player
+        return solver.best_move(self.board)
+
+    def check_winner(self, move):
+        # Check if the last move won the game, only lines through it can be new
+        return self.board.wins_at(move, MARKS[self.current_turn])
+
+    def broadcast(self, send):
+        # Send message to all players, send is called with connection of each player. Spectators get it through
+        # the room's channel, which only queues it, so a slow spectator never holds up the room.
+        send(self.channel)
+        for player in list(self.players):
             try:
-                player[0].sendall(message.encode())
+                send(player[0])
             except:
                 pass
 
-    def broadcast_board(self):
+    def broadcast_board(self, last_move=None, timeout=False):
         # Send current game board to players
-        board_display = ""
-        for i in range(3):
-            row = " | ".join(self.board[i * 3: (i + 1) * 3])
-            board_display += f"{row}\n"
-            if i < 2:
-                board_display += "--+---+--\n"
-        self.broadcast(board_display)
-
-def on_exit(server):
-    # Save variables to files on exit
-    server.save_scoreboard()
-    server.save_history()
+        self.broadcast(lambda conn: conn.send_board(self.board, last_move, timeout))
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Tic-tac-toe game server with a room per game")
+    parser.add_argument('--separate-dashboard', action='store_true', help=f"leave the dashboard to dashboard.py, only /metrics is served here on port {METRICS_PORT}")
+    args = parser.parse_args()
     # Add logging into server.log file
     logging.basicConfig(filename='server.log', level=logging.INFO)
     server = TicTacToeServer()
     server.start()
-    atexit.register(on_exit,server)
     app = Flask(__name__)
-        
-    # Main game page
-    @app.route('/')
-    def indexMain():
-        return render_template('main.html')
-
-    # Scoreboard route
-    @app.route('/scoreboard')
-    def indexScoreboard():
-        server.scoreboard.sort(key=lambda x: x['score'], reverse=True)
-        return render_template('scoreboard.html', scoreboard=server.scoreboard)
-
-    # History route
-    @app.route('/history')
-    def indexHistory():
-        server.history.sort(key=lambda x: x['date'], reverse=True)
-        return render_template('history.html', history=server.history)
+    if not args.separate_dashboard:
+        routes.register(app, server.scores, server.ranking, server.history, server.games, server.pages, server.updates)
+
+    # Prometheus metrics
+    @app.route('/metrics')
+    def indexMetrics():
+        return metrics.respond()
 
     def run_flask():
-        app.run(debug=True, host='0.0.0.0', use_reloader=False)
+        app.run(debug=True, host='0.0.0.0', port=METRICS_PORT if args.separate_dashboard else DASHBOARD_PORT, use_reloader=False)
 
     # Run Flask app in separate thread
     flask_thread = threading.Thread(target=run_flask)
     flask_thread.start()
-
-    while True:
-        time.sleep(1)
\ No newline at end of file
+    flask_thread.join()
\ No newline at end of file
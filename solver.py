@@ -0,0 +1,73 @@
+from engine import CELLS, FULL, WINNING, POPCOUNT, MASK_CELLS, pack
+
+# Perfect play for every legal position, solved once when the module is imported. TABLE is indexed by the
+# packed board key, each byte holds the outcome for the player to move in the high bits and the best cell
+# in the low bits, so a move of the server player costs one lookup. Only the classic 3x3 game is solved,
+# other m,n,k boards get a cheap heuristic move.
+
+NO_MOVE = 15 # Best move of finished and unreachable positions
+# Outcomes for the player to move
+LOSS = 0
+DRAW = 1
+WIN = 2
+
+TABLE = bytearray([NO_MOVE]) * (1 << 2 * CELLS)
+
+def solve(x, o, scores):
+    # Negamax score of a position for the player to move, bigger for faster wins and slower losses.
+    # Fills TABLE and remembers scores of solved positions in scores.
+    key = pack(x, o)
+    if key in scores:
+        return scores[key]
+    free = FULL & ~(x | o)
+    move = NO_MOVE
+    if WINNING[x] or WINNING[o]:
+        # Previous move won the game
+        score = -(POPCOUNT[free] + 1)
+    elif not free:
+        score = 0
+    else:
+        x_moves = POPCOUNT[x] <= POPCOUNT[o]
+        score = None
+        for cell in MASK_CELLS[free]:
+            bit = 1 << cell
+            child = -(solve(x | bit, o, scores) if x_moves else solve(x, o | bit, scores))
+            if score is None or child > score:
+                score, move = child, cell
+    outcome = WIN if score > 0 else LOSS if score < 0 else DRAW
+    TABLE[key] = outcome << 4 | move
+    scores[key] = score
+    return score
+
+def build_table():
+    # Solve the game from the empty board, returns the number of legal positions
+    scores = {}
+    solve(0, 0, scores)
+    return len(scores)
+
+def heuristic_move(board):
+    # Move for boards too big to solve: win if possible, else block the opponent's win,
+    # else the free cell closest to the centre
+    moves = board.legal_moves()
+    if not moves:
+        return None
+    mark = board.next_mark()
+    for player in (mark, 'O' if mark == 'X' else 'X'):
+        for cell in moves:
+            if board.wins_at(cell, player):
+                return cell
+    rows, cols = board.rules.rows, board.rules.cols
+    return min(moves, key=lambda cell: abs(cell // cols - (rows - 1) / 2) + abs(cell % cols - (cols - 1) / 2))
+
+def best_move(board):
+    # Best cell for the player to move, None when the game is over
+    if not board.rules.standard:
+        return heuristic_move(board)
+    move = TABLE[board.key()] & 0xF
+    return None if move == NO_MOVE else move
+
+def outcome(board):
+    # LOSS, DRAW or WIN for the player to move when both sides play perfectly, classic 3x3 boards only
+    return TABLE[board.key()] >> 4
+
+POSITIONS = build_table() # Number of legal positions
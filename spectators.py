@@ -0,0 +1,410 @@
+import asyncio
+import collections
+import os
+import selectors
+import socket
+import ssl
+import time
+import threading
+import queue
+import logging
+from engine import Board
+import protocol
+import metrics
+
+# Live games streamed to spectators over pub/sub fan-out. Every session of two players publishes its game to a
+# Channel. A game only hands events to the hub, a thread (or the asyncio event loop) that encodes every frame once
+# and offers it to the bounded queue of each subscriber. Every subscriber has its own writer, which the hub runs
+# with non-blocking writes, so a game never waits for a spectator however many watch it.
+# A subscriber whose queue is full gets a snapshot of the game instead of the frames it missed, one falling
+# behind more than MAX_SNAPSHOTS times before catching up or blocking a write for SEND_TIMEOUT is dropped.
+# Games nobody watches publish nothing.
+
+QUEUE_SIZE = 32 # Frames queued for one spectator, a game sends one per move
+MAX_SNAPSHOTS = 3 # Snapshots a spectator gets in a row before it is dropped
+SEND_TIMEOUT = 5.0 # Seconds a spectator's socket may block one write
+WRITE_BUFFER_LIMIT = 64 * 1024 # Bytes an asyncio transport of a spectator buffers before frames wait in its queue
+CLOSE = None # Queued after the last frame, the writer closes the connection
+NICENESS = 10 # Hub threads yield the CPU to the games when a core is shared
+
+def lower_priority():
+    # Linux nice value of the calling thread only, no-op elsewhere
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), NICENESS)
+    except (AttributeError, OSError):
+        pass
+
+class Subscriber:
+    # Spectator connection with a bounded queue of encoded frames, written by its own writer
+    def __init__(self, conn):
+        self.conn = conn
+        self.queue = collections.deque() # Frames not written yet, at most QUEUE_SIZE and CLOSE
+        self.snapshots = 0 # Snapshots sent since the writer last emptied the queue
+        self.closed = False # No more frames are queued
+        self.ended = False # Connection is closed
+
+    def offer(self, frame, channel):
+        # Queue frame without waiting, runs in the hub. A full queue is replaced by a snapshot of the game.
+        if self.closed:
+            return
+        if len(self.queue) >= QUEUE_SIZE:
+            self.queue.clear()
+            self.snapshots += 1
+            if self.snapshots > MAX_SNAPSHOTS:
+                logging.info("Spectator dropped, it fell behind the game.")
+                self.closed = True
+                self.drop()
+                return
+            frame = channel.snapshot()
+        self.queue.append(frame)
+        self.wake()
+
+    def close(self):
+        # Write what is queued and close the connection, runs in the hub
+        if not self.closed:
+            self.closed = True
+            self.queue.append(CLOSE)
+            self.wake()
+
+    def take(self):
+        # Queued frames joined for one write and whether the connection is to be closed after them
+        frames = []
+        while self.queue:
+            frame = self.queue.popleft()
+            if frame is CLOSE:
+                return b''.join(frames), True
+            frames.append(frame)
+        self.snapshots = 0
+        return b''.join(frames), False
+
+    def end(self):
+        if not self.ended:
+            self.ended = True
+            metrics.SPECTATORS.add(-1)
+            self.conn.close()
+
+class ThreadSubscriber(Subscriber):
+    # Subscriber written by the hub thread over a non-blocking socket. A write the socket cannot take stays
+    # pending and the hub waits for the socket to become writable, without holding up other spectators.
+    def __init__(self, conn, hub):
+        super().__init__(conn)
+        self.hub = hub
+        self.pending = b'' # Data of a write the socket did not take yet
+        self.blocked = None # monotonic() time the socket stopped taking writes
+        self.done = False # Close once pending is written
+        conn.sock.setblocking(False)
+
+    def wake(self):
+        self.hub.ready.add(self)
+
+    def flush(self):
+        # Write queued frames as far as the socket takes them, runs in the hub
+        try:
+            while True:
+                if not self.pending:
+                    if self.done or not self.queue:
+                        break
+                    self.pending, self.done = self.take()
+                    continue
+                try:
+                    sent = self.conn.sock.send(self.pending)
+                except (ssl.SSLWantWriteError, BlockingIOError):
+                    if self.blocked is None:
+                        self.blocked = time.monotonic()
+                        self.hub.selector.register(self.conn.sock, selectors.EVENT_WRITE, self)
+                    return
+                self.pending = self.pending[sent:]
+                if self.blocked is not None:
+                    self.blocked = None
+                    self.hub.selector.unregister(self.conn.sock)
+        except OSError as e:
+            logging.info(f"Spectator dropped: {e}.")
+            self.closed = True
+            self.drop()
+        if self.done and not self.pending:
+            self.end()
+
+    def expire(self, now):
+        # Drop subscriber whose socket has not taken a write for SEND_TIMEOUT
+        if self.blocked is not None and now - self.blocked > SEND_TIMEOUT:
+            logging.info("Spectator dropped: write timed out.")
+            self.closed = True
+            self.drop()
+
+    def drop(self):
+        # Disconnect without writing what is queued
+        self.done = True
+        self.pending = b''
+        self.queue.clear()
+        self.end()
+
+    def end(self):
+        if self.blocked is not None:
+            self.hub.selector.unregister(self.conn.sock)
+            self.blocked = None
+        super().end()
+
+class LoopSubscriber(Subscriber):
+    # Subscriber written straight to its asyncio transport from the hub. While the transport holds more than
+    # WRITE_BUFFER_LIMIT bytes the spectator is not reading, frames wait in the queue and a task waits for
+    # the transport to drain.
+    def __init__(self, conn, hub):
+        super().__init__(conn)
+        self.hub = hub
+        self.draining = None # Task waiting for the transport to drain
+
+    def wake(self):
+        self.hub.wake(self)
+
+    def flush(self):
+        # Write queued frames unless the transport is backed up, runs in the hub
+        if self.draining is not None or self.ended:
+            return
+        data, done = self.take()
+        if self.conn.writer.transport.is_closing():
+            self.closed = True
+            self.end()
+            return
+        if data:
+            self.conn.writer.write(data)
+        if done:
+            self.end()
+        elif self.conn.writer.transport.get_write_buffer_size() > WRITE_BUFFER_LIMIT:
+            self.draining = asyncio.ensure_future(self.drain())
+
+    async def drain(self):
+        try:
+            await asyncio.wait_for(self.conn.writer.drain(), SEND_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as e:
+            logging.info(f"Spectator dropped: {e or 'write timed out'}.")
+            self.closed = True
+            self.drop()
+            return
+        self.draining = None
+        self.flush()
+
+    def drop(self):
+        # Disconnect without writing what is queued
+        if not self.ended:
+            self.conn.writer.transport.abort()
+            self.end()
+
+class ThreadHub:
+    # Runs channel events one after another in a thread and writes to the spectators of all channels from it,
+    # a game only puts events on a queue
+    def __init__(self):
+        self.events = queue.SimpleQueue()
+        self.selector = selectors.DefaultSelector() # Spectator sockets that did not take a write
+        self.ready = set() # Subscribers with new frames
+        self.expired = time.monotonic() # Last check for subscribers blocked too long
+        self.waker, waker = socket.socketpair()
+        self.waker.setblocking(False)
+        self.selector.register(waker, selectors.EVENT_READ)
+        threading.Thread(target=self.run, args=(waker,), daemon=True).start()
+
+    def subscriber(self, conn):
+        return ThreadSubscriber(conn, self)
+
+    def post(self, function, *args):
+        self.events.put((function, args))
+        try:
+            self.waker.send(b'\0')
+        except BlockingIOError:
+            # Hub has wake-ups pending already
+            pass
+
+    def run(self, waker):
+        lower_priority()
+        while True:
+            timeout = 0 if not self.events.empty() else SEND_TIMEOUT if len(self.selector.get_map()) > 1 else None
+            for key, _ in self.selector.select(timeout):
+                if key.fileobj is waker:
+                    waker.recv(4096)
+                else:
+                    self.ready.add(key.data)
+            now = time.monotonic()
+            if now - self.expired > 1.0:
+                self.expired = now
+                for key in list(self.selector.get_map().values()):
+                    if key.data is not None:
+                        key.data.expire(now)
+            # At most QUEUE_SIZE events between writes, so spectators reading in time never overflow
+            for _ in range(QUEUE_SIZE):
+                try:
+                    function, args = self.events.get_nowait()
+                except queue.Empty:
+                    break
+                try:
+                    function(*args)
+                except Exception as e:
+                    logging.error(f"{e} error occurred while sending to spectators.")
+            ready, self.ready = self.ready, set()
+            for subscriber in ready:
+                subscriber.flush()
+
+class LoopHub:
+    # Runs channel events on the asyncio event loop of the games, after the game's own writes, and writes to
+    # the spectators once per round of the loop
+    def __init__(self, loop):
+        self.loop = loop
+        self.ready = set() # Subscribers with new frames
+
+    def subscriber(self, conn):
+        return LoopSubscriber(conn, self)
+
+    def post(self, function, *args):
+        self.loop.call_soon(function, *args)
+
+    def wake(self, subscriber):
+        if not self.ready:
+            self.loop.call_soon(self.flush)
+        self.ready.add(subscriber)
+
+    def flush(self):
+        ready, self.ready = self.ready, set()
+        for subscriber in ready:
+            subscriber.flush()
+
+class View:
+    # A game as spectators know it
+    def __init__(self, players, board, last_move=None, result=None):
+        self.players = players # Nicknames of X and O
+        self.board = board
+        self.last_move = last_move
+        self.result = result # RESULT frame once the game ended
+
+    def snapshot(self):
+        # Frames that bring a new or lagging spectator up to date: WATCH, the board and the result if any
+        frames = protocol.encode(protocol.WATCH, protocol.watch_payload(self.board.rules, *self.players))
+        frames += protocol.encode(protocol.STATE, protocol.state_payload(self.board, 0, self.last_move))
+        return frames + (self.result or b'')
+
+class Channel:
+    # Games of one session of two players. Publishing methods are called by the game and mirror those of a
+    # player's connection, they post events to the hub while somebody watches. The rest runs in the hub, which
+    # keeps its own view of the game, so snapshots always agree with the frames queued before them.
+    def __init__(self, hub, nickname_1, nickname_2):
+        self.hub = hub
+        self.players = (nickname_1, nickname_2) # X and O of the current game
+        self.board = None # Board of the current game, the game's own object
+        self.last_move = None
+        self.result = None # RESULT payload once the current game ended
+        self.view = None # Current game as the hub published it
+        self.subscribers = []
+        self.watched = False # Set in the hub before the first view is taken, games post nothing until then
+
+    def start(self, nickname_x, nickname_o, board):
+        self.result = None
+        self.last_move = None
+        self.players = (nickname_x, nickname_o)
+        self.board = board
+        if self.watched:
+            self.hub.post(self.started, self.players, board.rules)
+
+    def send_board(self, board, last_move=None, timeout=False, your_turn=False):
+        self.board = board
+        self.last_move = last_move
+        if self.watched and last_move is not None:
+            self.hub.post(self.moved, board.count(), last_move, timeout)
+
+    def send_win(self, mark, winner):
+        self.end(bytes([protocol.X_WINS if mark == 'X' else protocol.O_WINS]) + winner.encode(protocol.FORMAT))
+
+    def send_draw(self):
+        self.end(bytes([protocol.DRAW]))
+
+    def send_left(self, nickname=''):
+        self.end(bytes([protocol.OPPONENT_LEFT]) + nickname.encode(protocol.FORMAT))
+
+    def end(self, payload):
+        # Result of the current game, spectators stay for a rematch
+        if self.result is None:
+            self.result = payload
+            if self.watched:
+                self.hub.post(self.ended, payload)
+
+    def started(self, players, rules):
+        self.view = View(players, Board(rules=rules))
+        self.fan_out(self.view.snapshot())
+
+    def moved(self, seq, cell, timeout):
+        # Events posted while the first view was taken may be in it already
+        board = self.view.board
+        if seq == board.count() + 1:
+            board.play(cell, board.next_mark())
+            self.view.last_move = cell
+            self.fan_out(protocol.encode(protocol.DELTA, protocol.DELTA_FORMAT.pack(seq, cell, protocol.TIMEOUT_MOVE if timeout else 0)))
+
+    def ended(self, payload):
+        if self.view.result is None:
+            self.view.result = protocol.encode(protocol.RESULT, payload)
+            self.fan_out(self.view.result)
+
+    def snapshot(self):
+        return self.view.snapshot() if self.view is not None else b''
+
+    def fan_out(self, frame):
+        for subscriber in self.subscribers:
+            subscriber.offer(frame, self)
+        if any(subscriber.closed for subscriber in self.subscribers):
+            self.subscribers = [subscriber for subscriber in self.subscribers if not subscriber.closed]
+
+    def subscribe(self, conn):
+        # Watch from the current state of the game
+        if not self.watched:
+            # Games post their events from now on, the view starts from what they did until then
+            self.watched = True
+            board = self.board
+            if board is not None:
+                result = protocol.encode(protocol.RESULT, self.result) if self.result is not None else None
+                self.view = View(self.players, Board(board.x, board.o, board.rules), self.last_move, result)
+        subscriber = self.hub.subscriber(conn)
+        metrics.SPECTATORS.add(1)
+        self.subscribers.append(subscriber)
+        subscriber.offer(self.snapshot(), self)
+
+    def close(self):
+        # Session ended, spectators get what is queued and are disconnected
+        self.watched = False
+        for subscriber in self.subscribers:
+            subscriber.close()
+        self.subscribers = []
+
+class Directory:
+    # Channels of running sessions by nickname of their players
+    def __init__(self, hub):
+        self.hub = hub
+        self.channels = {}
+        self.lock = threading.Lock()
+
+    def open(self, nickname_1, nickname_2):
+        channel = Channel(self.hub, nickname_1, nickname_2)
+        with self.lock:
+            self.channels[nickname_1] = self.channels[nickname_2] = channel
+        return channel
+
+    def close(self, channel):
+        with self.lock:
+            for nickname in set(channel.players):
+                if self.channels.get(nickname) is channel:
+                    del self.channels[nickname]
+        self.hub.post(channel.close)
+
+    def find(self, nickname):
+        # Channel of the player, the one with the most spectators for an empty nickname
+        with self.lock:
+            if nickname:
+                return self.channels.get(nickname)
+            return max(self.channels.values(), key=lambda channel: len(channel.subscribers), default=None)
+
+    def watch(self, conn, nickname):
+        # Subscribe spectator to the session of the player, returns False after telling it there is none
+        channel = self.find(nickname)
+        if channel is None:
+            try:
+                conn.send(protocol.ERROR, bytes([protocol.NOT_PLAYING]) + f"{nickname or 'Nobody'} is not playing.".encode(protocol.FORMAT))
+            except OSError:
+                pass
+            return False
+        self.hub.post(channel.subscribe, conn)
+        return True
@@ -0,0 +1,383 @@
+import sqlite3
+import threading
+import logging
+import json
+import os
+import argparse
+import bisect
+import leaderboard
+
+# Storage shared by both servers. Every game result is committed to SQLite right away, the database runs in
+# WAL mode so the dashboard reads while game threads write. History of games is an append-only log of JSONL
+# segments that is read backwards page by page, newest game first.
+
+DATABASE = 'tictactoe.db' # Database file, next to scoreboard.json and history.json
+BUSY_TIMEOUT = 5.0 # Seconds a writer waits for another writer's transaction to finish
+HISTORY_DIR = 'history' # Directory of history log segments
+SEGMENT_BYTES = 1024 * 1024 # Size after which the history log continues in a new segment
+READ_BLOCK = 64 * 1024 # Bytes read at once when reading a segment backwards
+PAGE_SIZE = 50 # Games on one history page
+MAX_PAGE_SIZE = 500 # Largest page a client may ask for
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS scoreboard (
+    nickname TEXT PRIMARY KEY,
+    score INTEGER NOT NULL
+);
+-- Ranked order, best first and ties by nickname like the leaderboard, read by the dashboard process
+CREATE INDEX IF NOT EXISTS scoreboard_rank ON scoreboard (score DESC, nickname);
+DROP INDEX IF EXISTS scoreboard_score;
+-- Elo ratings, every rated game counts as a win, loss or draw of both players and of the pair both ways round
+CREATE TABLE IF NOT EXISTS ratings (
+    nickname TEXT PRIMARY KEY,
+    rating REAL NOT NULL,
+    wins INTEGER NOT NULL DEFAULT 0,
+    losses INTEGER NOT NULL DEFAULT 0,
+    draws INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS ratings_rank ON ratings (rating DESC, nickname);
+CREATE TABLE IF NOT EXISTS head_to_head (
+    player TEXT NOT NULL,
+    opponent TEXT NOT NULL,
+    wins INTEGER NOT NULL DEFAULT 0,
+    losses INTEGER NOT NULL DEFAULT 0,
+    draws INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (player, opponent)
+);
+'''
+
+class ScoreStore:
+    def __init__(self, path=DATABASE):
+        self.path = path
+        # SQLite connections cannot be shared between threads, every thread opens its own
+        self.local = threading.local()
+        self.connection().executescript(SCHEMA)
+
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            # In WAL mode NORMAL syncs at checkpoints only, a committed result survives a crash of the server
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+        return db
+
+    def record_result(self, winner, loser):
+        # +1 point for winner and -1 point for loser in one transaction, both are primary key lookups
+        db = self.connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('INSERT INTO scoreboard (nickname, score) VALUES (?, 1) '
+                       'ON CONFLICT (nickname) DO UPDATE SET score = score + 1', (winner,))
+            # Players get an entry with their first win, like in the old JSON scoreboard
+            db.execute('UPDATE scoreboard SET score = score - 1 WHERE nickname = ?', (loser,))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        logging.info(f"+1 point for {winner}, -1 point for {loser}.")
+
+    def record_rating(self, x, o, score, update):
+        # Rate a game of x against o in one transaction, score is 1 when x won, 0 when o won and 0.5 for a draw.
+        # update(rating_x, rating_o, score) returns the new ratings, a player without a rating has None.
+        db = self.connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            found = dict(db.execute('SELECT nickname, rating FROM ratings WHERE nickname IN (?, ?)', (x, o)))
+            rating_x, rating_o = update(found.get(x), found.get(o), score)
+            for player, opponent, rating, result in ((x, o, rating_x, score), (o, x, rating_o, 1 - score)):
+                counts = (result == 1, result == 0, result == 0.5)
+                db.execute('INSERT INTO ratings (nickname, rating, wins, losses, draws) VALUES (?, ?, ?, ?, ?) '
+                           'ON CONFLICT (nickname) DO UPDATE SET rating = excluded.rating, wins = wins + excluded.wins, '
+                           'losses = losses + excluded.losses, draws = draws + excluded.draws', (player, rating, *counts))
+                db.execute('INSERT INTO head_to_head (player, opponent, wins, losses, draws) VALUES (?, ?, ?, ?, ?) '
+                           'ON CONFLICT (player, opponent) DO UPDATE SET wins = wins + excluded.wins, '
+                           'losses = losses + excluded.losses, draws = draws + excluded.draws', (player, opponent, *counts))
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def replace_ratings(self, players, pairs):
+        # Ratings computed from all games at once: players are (nickname, rating, wins, losses, draws) and pairs
+        # are (player, opponent, wins, losses, draws), fastest to insert sorted by player and opponent
+        db = self.connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM ratings')
+            db.execute('DELETE FROM head_to_head')
+            db.executemany('INSERT INTO ratings (nickname, rating, wins, losses, draws) VALUES (?, ?, ?, ?, ?)', players)
+            db.executemany('INSERT INTO head_to_head (player, opponent, wins, losses, draws) VALUES (?, ?, ?, ?, ?)', pairs)
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+
+    def ratings(self, player=None, top=leaderboard.TOP_SIZE):
+        # Rows of the ratings page, best first: the top players, or the players around a player
+        db = self.connection()
+        start = 0
+        if player:
+            row = db.execute('SELECT rating FROM ratings WHERE nickname = ?', (player,)).fetchone()
+            if row is None:
+                return []
+            above = db.execute('SELECT COUNT(*) FROM ratings WHERE rating > ? OR (rating = ? AND nickname < ?)',
+                               (row[0], row[0], player)).fetchone()[0]
+            start = max(above - leaderboard.AROUND_RADIUS, 0)
+            top = above + leaderboard.AROUND_RADIUS + 1 - start
+        rows = db.execute('SELECT nickname, rating, wins, losses, draws FROM ratings ORDER BY rating DESC, nickname '
+                          'LIMIT ? OFFSET ?', (max(top, 0), start))
+        return [{'rank': start + i + 1, 'nickname': nickname, 'rating': round(rating), 'wins': wins, 'losses': losses,
+                 'draws': draws, 'win_rate': wins / max(wins + losses + draws, 1)}
+                for i, (nickname, rating, wins, losses, draws) in enumerate(rows)]
+
+    def head_to_head(self, player):
+        # Wins, losses and draws of a player against every opponent, most games first
+        rows = self.connection().execute('SELECT opponent, wins, losses, draws FROM head_to_head WHERE player = ? '
+                                         'ORDER BY wins + losses + draws DESC, opponent', (player,))
+        return [{'opponent': opponent, 'wins': wins, 'losses': losses, 'draws': draws} for opponent, wins, losses, draws in rows]
+
+    def score(self, nickname):
+        # Current score of a player, 0 for players without results
+        row = self.connection().execute('SELECT score FROM scoreboard WHERE nickname = ?', (nickname,)).fetchone()
+        return row[0] if row else 0
+
+    def entries(self, start, count):
+        # count players from 0-based position start in ranked order, as dicts with rank, nickname and score
+        rows = self.connection().execute('SELECT nickname, score FROM scoreboard ORDER BY score DESC, nickname '
+                                         'LIMIT ? OFFSET ?', (max(count, 0), start))
+        return [{'rank': start + i + 1, 'nickname': nickname, 'score': score} for i, (nickname, score) in enumerate(rows)]
+
+    def rank(self, nickname):
+        # 1-based rank of a player, None for players without an entry
+        db = self.connection()
+        row = db.execute('SELECT score FROM scoreboard WHERE nickname = ?', (nickname,)).fetchone()
+        if row is None:
+            return None
+        better = db.execute('SELECT COUNT(*) FROM scoreboard WHERE score > ? OR (score = ? AND nickname < ?)',
+                            (row[0], row[0], nickname)).fetchone()[0]
+        return better + 1
+
+    def query(self, player=None, rank=None, top=leaderboard.TOP_SIZE, radius=leaderboard.AROUND_RADIUS):
+        # Rows of the scoreboard page like Leaderboard.query, for processes without the ranked copy in memory
+        if player:
+            rank = self.rank(player)
+            if rank is None:
+                return []
+        if rank:
+            start = max(rank - 1 - radius, 0)
+            return self.entries(start, rank + radius - start)
+        return self.entries(0, top)
+
+    def scoreboard(self):
+        # All players, best first, in the format of scoreboard.json
+        rows = self.connection().execute('SELECT nickname, score FROM scoreboard ORDER BY score DESC')
+        return [{'nickname': nickname, 'score': score} for nickname, score in rows]
+
+    def is_empty(self):
+        return self.connection().execute('SELECT 1 FROM scoreboard LIMIT 1').fetchone() is None
+
+    def import_json(self, path='scoreboard.json'):
+        # Copy players from an old scoreboard.json, players already in the database are kept as they are
+        with open(path, 'r') as file:
+            entries = json.load(file)
+        db = self.connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.executemany('INSERT OR IGNORE INTO scoreboard (nickname, score) VALUES (?, ?)',
+                           [(entry['nickname'], entry['score']) for entry in entries])
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        logging.info(f"Imported {len(entries)} players from {path}.")
+        return len(entries)
+
+def parse_entry(line):
+    # Game of one log line, None for an empty or torn line
+    try:
+        return json.loads(line)
+    except ValueError:
+        return None
+
+def parse_cursor(cursor):
+    # Segment and byte offset of a history page cursor, None for a malformed one
+    try:
+        segment, offset = cursor.split('-')
+        return int(segment), int(offset)
+    except (AttributeError, ValueError):
+        return None
+
+class HistoryLog:
+    # Games are appended to the newest segment, a full segment is never written again.
+    # index.jsonl holds the date of the first game of every segment, so a page of games played before
+    # some date starts in the right segment without reading newer ones.
+    def __init__(self, directory=HISTORY_DIR):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, 'index.jsonl')
+        self.index_size = self.file_size(self.index_path) # Size of index.jsonl when the index was loaded
+        self.index = self.load_index() # (first date, segment number) of every segment, oldest first
+        self.file = None # Newest segment, opened on first append
+        self.lock = threading.Lock() # Appends come from many game threads
+
+    def load_index(self):
+        if not os.path.exists(self.index_path):
+            return []
+        with open(self.index_path, 'r') as file:
+            return [tuple(entry) for entry in map(parse_entry, file) if entry]
+
+    def file_size(self, path):
+        return os.path.getsize(path) if os.path.exists(path) else 0
+
+    def version(self):
+        # End of the log, changes with every game appended by any process. A process reading a log that
+        # another process writes reloads the index when a segment was started.
+        size = self.file_size(self.index_path)
+        if size != self.index_size:
+            self.index_size = size
+            self.index = self.load_index()
+        if not self.index:
+            return '0'
+        segment = self.index[-1][1]
+        return f"{segment}-{self.file_size(self.segment_path(segment))}"
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f'{segment:06d}.jsonl')
+
+    def is_empty(self):
+        return not self.index
+
+    def open_segment(self, date):
+        # Continue the newest segment, or start a new one when it is full
+        if self.file is not None:
+            self.file.close()
+        if self.index and os.path.getsize(self.segment_path(self.index[-1][1])) < SEGMENT_BYTES:
+            self.file = open(self.segment_path(self.index[-1][1]), 'ab')
+            # A crash may have left half a line, the next game starts on its own line
+            if self.file.tell() > 0:
+                with open(self.segment_path(self.index[-1][1]), 'rb') as segment:
+                    segment.seek(-1, os.SEEK_END)
+                    if segment.read(1) != b'\n':
+                        self.file.write(b'\n')
+            return
+        segment = self.index[-1][1] + 1 if self.index else 1
+        self.file = open(self.segment_path(segment), 'ab')
+        with open(self.index_path, 'a') as file:
+            file.write(json.dumps([date, segment]) + '\n')
+        self.index.append((date, segment))
+
+    def append(self, entry):
+        # Add a finished game, it reaches the file before the call returns. Returns the end of the log after
+        # the game, like version().
+        line = (json.dumps(entry) + '\n').encode()
+        with self.lock:
+            if self.file is None or self.file.tell() >= SEGMENT_BYTES:
+                self.open_segment(entry['date'])
+            self.file.write(line)
+            self.file.flush()
+            return f"{self.index[-1][1]}-{self.file.tell()}"
+
+    def since(self, position):
+        # Games appended after position (a value of version()), oldest first, each with the end of the log after it
+        segment, offset = parse_cursor(position) or (0, 0)
+        games = []
+        for _, number in list(self.index):
+            if number < segment:
+                continue
+            start = offset if number == segment else 0
+            with open(self.segment_path(number), 'rb') as file:
+                file.seek(start)
+                data = file.read()
+            # Last piece is empty or a game still being written
+            for line in data.split(b'\n')[:-1]:
+                start += len(line) + 1
+                entry = parse_entry(line)
+                if entry is not None:
+                    games.append((entry, f"{number}-{start}"))
+        return games
+
+    def read_backwards(self, segment, end=None):
+        # Games of a segment that end before byte offset end, newest first, with the offset each starts at
+        with open(self.segment_path(segment), 'rb') as file:
+            start = file.seek(0, os.SEEK_END) if end is None else end
+            rest = b''
+            while start > 0:
+                read_from = max(0, start - READ_BLOCK)
+                file.seek(read_from)
+                block = file.read(start - read_from) + rest
+                lines = block.split(b'\n')
+                # First line may begin in the previous block, it is completed by the next read
+                rest = lines.pop(0) if read_from > 0 else b''
+                position = read_from + len(block)
+                for line in reversed(lines):
+                    position -= len(line)
+                    entry = parse_entry(line)
+                    if entry is not None:
+                        yield entry, position
+                    position -= 1
+                start = read_from
+
+    def page(self, cursor=None, before=None, limit=PAGE_SIZE):
+        # Up to limit games, newest first, following cursor or starting with the newest game played before
+        # date before. Returns the games and the cursor of the next page, None once the oldest game was read.
+        index = list(self.index)
+        if not index:
+            return [], None
+        segment, end = parse_cursor(cursor) or (index[-1][1], None)
+        if segment > index[-1][1]:
+            # Cursor past the newest segment was never handed out, its page is empty like one past the oldest
+            return [], None
+        if before is not None and parse_cursor(cursor) is None:
+            # Segments hold games in date order, a segment starting at the date or later has none older
+            position = bisect.bisect_left([first for first, _ in index], before)
+            if position == 0:
+                return [], None
+            segment, end = index[position - 1][1], None
+        entries = []
+        while segment >= index[0][1]:
+            for entry, start in self.read_backwards(segment, end):
+                if before is not None and entry['date'] >= before:
+                    continue
+                entries.append(entry)
+                if len(entries) == limit:
+                    return entries, f"{segment}-{start}"
+            segment, end = segment - 1, None
+        return entries, None
+
+    def import_json(self, path='history.json'):
+        # Append games of an old history.json, oldest first
+        with open(path, 'r') as file:
+            entries = json.load(file)
+        for entry in sorted(entries, key=lambda x: x['date']):
+            self.append(entry)
+        logging.info(f"Imported {len(entries)} games from {path}.")
+        return len(entries)
+
+def open_history(directory=HISTORY_DIR, legacy_history='history.json'):
+    # Open the history log, a new empty log takes over games of the old JSON history once
+    log = HistoryLog(directory)
+    if log.is_empty() and os.path.exists(legacy_history):
+        log.import_json(legacy_history)
+    return log
+
+def open_store(path=DATABASE, legacy_scoreboard='scoreboard.json'):
+    # Open the store, a new empty store takes over players of the old JSON scoreboard once
+    store = ScoreStore(path)
+    if store.is_empty() and os.path.exists(legacy_scoreboard):
+        store.import_json(legacy_scoreboard)
+    return store
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import an old scoreboard.json or history.json into the store")
+    parser.add_argument('scoreboard', nargs='?', default='scoreboard.json', help="JSON scoreboard to import")
+    parser.add_argument('--database', default=DATABASE, help="database file")
+    parser.add_argument('--history', help="JSON history to append to the history log")
+    parser.add_argument('--history-dir', default=HISTORY_DIR, help="history log directory")
+    args = parser.parse_args()
+    count = ScoreStore(args.database).import_json(args.scoreboard)
+    print(f"Imported {count} players into {args.database}.")
+    if args.history:
+        count = HistoryLog(args.history_dir).import_json(args.history)
+        print(f"Imported {count} games into {args.history_dir}.")
@@ -0,0 +1,90 @@
+import random
+import pytest
+from engine import Board, MAX_SIDE, Rules, STANDARD, parse_board, render_board
+
+def lines(rules):
+    # Every k cells in a row, column or diagonal of a board, found by trying each cell as the start of a line
+    rows, cols, k = rules.rows, rules.cols, rules.k
+    found = []
+    for row in range(rows):
+        for col in range(cols):
+            for row_step, col_step in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                end_row, end_col = row + (k - 1) * row_step, col + (k - 1) * col_step
+                if 0 <= end_row < rows and 0 <= end_col < cols:
+                    found.append([(row + i * row_step) * cols + col + i * col_step for i in range(k)])
+    return found
+
+def has_line(marks, line):
+    # Whether every cell of line is in marks
+    return all(marks >> cell & 1 for cell in line)
+
+def random_board(rules, rng, fill):
+    # Board with about fill of its cells taken, X and O taking turns
+    board = Board(rules=rules)
+    cells = list(range(rules.cells))
+    rng.shuffle(cells)
+    for turn, cell in enumerate(cells[:int(fill * rules.cells)]):
+        board.play(cell, 'XO'[turn % 2])
+    return board
+
+@pytest.mark.parametrize('rules', [STANDARD, Rules(1, 1, 1), Rules(4, 4, 1), Rules(2, 5, 2), Rules(5, 2, 2), Rules(4, 7, 3),
+                                   Rules(7, 4, 4), Rules(6, 6, 4), Rules(1, 9, 5), Rules(9, 1, 5), Rules(MAX_SIDE, MAX_SIDE, 5),
+                                   Rules(MAX_SIDE, 3, MAX_SIDE)])
+def test_wins_at_matches_line_scan(rules):
+    # A move wins when a line of k cells through it is full, checked against every line of the board. Boards
+    # where the mark already won are skipped, wins_at is only asked before there is a winner.
+    rng = random.Random(repr(rules))
+    every_line = lines(rules)
+    checked = 0
+    for _ in range(300):
+        board = random_board(rules, rng, rng.random())
+        if not board.legal_moves():
+            continue
+        for mark in 'XO':
+            before = board.x if mark == 'X' else board.o
+            if any(has_line(before, line) for line in every_line):
+                continue
+            cell = rng.choice(board.legal_moves())
+            marks = before | 1 << cell
+            expected = any(cell in line and has_line(marks, line) for line in every_line)
+            assert board.wins_at(cell, mark) == expected, (rules, board.x, board.o, cell, mark)
+            checked += 1
+    assert checked > 50
+
+@pytest.mark.parametrize('rules', [Rules(4, 7, 3), Rules(6, 6, 4), Rules(MAX_SIDE, MAX_SIDE, 5)])
+def test_anti_diagonal_at_edges(rules):
+    # Lines going down to the left that start in the last column or end in the first one win, one cell short does not
+    rows, cols, k = rules.rows, rules.cols, rules.k
+    for row, col in ((0, cols - 1), (rows - k, k - 1)):
+        cells = [(row + i) * cols + col - i for i in range(k)]
+        board = Board(rules=rules)
+        for cell in cells[:-1]:
+            board.play(cell, 'O')
+        assert board.wins_at(cells[-1], 'O')
+        board = Board(rules=rules)
+        for cell in cells[1:-1]:
+            board.play(cell, 'O')
+        assert not board.wins_at(cells[-1], 'O') and not board.wins_at(cells[0], 'O')
+
+def test_winner_matches_line_scan():
+    # winner() finds the line anywhere on the board, not only through the last move
+    rng = random.Random(3)
+    for rules in (STANDARD, Rules(4, 7, 3), Rules(MAX_SIDE, MAX_SIDE, 5)):
+        every_line = lines(rules)
+        for _ in range(100):
+            board = random_board(rules, rng, rng.random())
+            x_wins = any(has_line(board.x, line) for line in every_line)
+            o_wins = any(has_line(board.o, line) for line in every_line)
+            assert board.wins('X') == x_wins and board.wins('O') == o_wins
+            assert board.winner() == ('X' if x_wins else 'O' if o_wins else None)
+
+def test_render_board():
+    # Rows of cells between separators, on boards of any size
+    board = Board.from_cells('XO  X   O')
+    assert render_board(board) == "X | O |  \n--+---+--\n  | X |  \n--+---+--\n  |   | O\n"
+    assert parse_board("Your turn\n" + render_board(board)).key() == board.key()
+    board = Board(rules=Rules(2, 4, 2))
+    board.play(0, 'X')
+    board.play(7, 'O')
+    assert render_board(board) == "X |   |   |  \n--+---+---+--\n  |   |   | O\n"
+    assert render_board(Board(rules=Rules(1, 1, 1))) == " \n"
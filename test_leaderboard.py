@@ -0,0 +1,63 @@
+import random
+import pytest
+import leaderboard
+import store
+
+def ranked(scores):
+    # Scoreboard sorted the slow way: best score first, ties by nickname
+    order = sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+    return [{'rank': rank, 'nickname': nickname, 'score': score} for rank, (nickname, score) in enumerate(order, 1)]
+
+@pytest.fixture
+def small_buckets(monkeypatch):
+    # Buckets of a few players, so a few hundred players split and empty buckets
+    monkeypatch.setattr(leaderboard, 'LOAD', 4)
+
+def test_matches_sorted_scoreboard(small_buckets):
+    # Ranks, top lists and pages around a rank agree with sorting after every result
+    rng = random.Random(1)
+    entries = [{'nickname': f'p{number}', 'score': rng.randrange(-5, 5)} for number in range(60)]
+    board = leaderboard.Leaderboard(entries)
+    scores = {entry['nickname']: entry['score'] for entry in entries}
+    for number in range(2000):
+        winner, loser = rng.sample([f'p{number}' for number in range(80)], 2)
+        board.record_result(winner, loser)
+        scores[winner] = scores.get(winner, 0) + 1
+        if loser in scores:
+            scores[loser] -= 1
+        if number % 50 == 0:
+            expected = ranked(scores)
+            assert board.top(len(expected) + 10) == expected
+            for row in expected:
+                assert board.rank(row['nickname']) == row['rank']
+            rank = rng.randrange(1, len(expected) + 1)
+            assert board.around(rank, 3) == expected[max(rank - 4, 0):rank + 3]
+    assert len(board.buckets) > 1
+    assert board.rank('nobody') is None and board.score('nobody') == 0
+
+def test_empty_and_single(small_buckets):
+    # A board without players answers every query, its first result adds the winner only
+    board = leaderboard.Leaderboard()
+    assert board.top() == [] and board.around(1) == [] and board.query(player='a') == []
+    board.record_result('a', 'b')
+    assert board.top() == [{'rank': 1, 'nickname': 'a', 'score': 1}]
+    assert board.rank('b') is None
+
+def test_query(small_buckets):
+    # Page rows for a player, for a rank and the top players
+    board = leaderboard.Leaderboard({'nickname': f'p{number:02d}', 'score': -number} for number in range(30))
+    assert [row['nickname'] for row in board.query(player='p10', radius=2)] == ['p08', 'p09', 'p10', 'p11', 'p12']
+    assert [row['rank'] for row in board.query(rank=1, radius=2)] == [1, 2, 3]
+    assert len(board.query(top=7)) == 7
+
+def test_same_points_as_store(tmp_path, small_buckets):
+    # Results recorded in memory and in the store give the same scoreboard
+    scores = store.ScoreStore(str(tmp_path / 'scores.db'))
+    board = leaderboard.Leaderboard()
+    rng = random.Random(2)
+    for _ in range(300):
+        winner, loser = rng.sample([f'p{number}' for number in range(20)], 2)
+        scores.record_result(winner, loser)
+        board.record_result(winner, loser)
+    assert board.top(100) == ranked({entry['nickname']: entry['score'] for entry in scores.scoreboard()})
+    assert leaderboard.Leaderboard(scores.scoreboard()).top(100) == board.top(100)
@@ -0,0 +1,162 @@
+import socket
+import pytest
+import protocol
+from engine import Board, Rules, STANDARD
+
+@pytest.fixture
+def pair():
+    # Connected client and server sockets, timed out instead of hanging when a test waits for a missing message
+    client, server = socket.socketpair()
+    client.settimeout(2.0)
+    server.settimeout(2.0)
+    yield client, server
+    client.close()
+    server.close()
+
+def test_frames_round_trip(pair):
+    # Frames sent in pieces that split headers are read back whole and in order, an incomplete frame stays buffered
+    client, server = pair
+    frames = [(protocol.MOVE, bytes([4])), (protocol.RESYNC, b''), (protocol.JOIN, b'x' * 1000)]
+    data = b''.join(protocol.encode(*frame) for frame in frames)
+    buffer = bytearray(data[:-1])
+    assert protocol.pop_frame(buffer) == frames[0] and protocol.pop_frame(buffer) == frames[1]
+    assert protocol.pop_frame(buffer) is None and len(buffer) == len(protocol.encode(*frames[2])) - 1
+    for start, end in ((0, 1), (1, 4), (4, 7), (7, 20), (20, len(data))):
+        client.sendall(data[start:end])
+    conn = protocol.BinaryConnection(sock=server)
+    assert [conn.read_frame() for _ in frames] == frames
+
+def test_read_hello():
+    # Versions above the server's are lowered to it, anything not starting with MAGIC is a text client's nickname
+    assert protocol.read_hello(protocol.MAGIC + bytes([protocol.VERSION + 10]) + b'rest') == (protocol.VERSION, b'rest')
+    assert protocol.read_hello(protocol.MAGIC + bytes([2])) == (2, b'')
+    assert protocol.read_hello(b'alice') == (None, b'alice')
+    assert protocol.read_hello(b'TTX' + bytes([protocol.VERSION])) == (None, b'TTX' + bytes([protocol.VERSION]))
+    assert protocol.read_hello(protocol.MAGIC) == (None, protocol.MAGIC)
+
+@pytest.mark.parametrize('version', range(1, protocol.VERSION + 1))
+def test_version_negotiation(pair, version):
+    # Client and server agree on the client's version, JOIN carries the nickname, flags and rules the version has
+    client, server = pair
+    rules = Rules(4, 5, 3) if version >= protocol.RULES_VERSION else STANDARD
+    client.sendall(protocol.MAGIC + bytes([version]) + protocol.encode(protocol.JOIN, protocol.join_request('alice', version, True, rules)))
+    conn, nickname = protocol.accept(server, protocol.Connection)
+    assert nickname == 'alice' and conn.binary and conn.version == version and conn.rules == rules
+    assert conn.vs_server == (version >= protocol.JOIN_FLAGS_VERSION)
+    conn.send_start('O', 'bob')
+    assert client.recv(len(protocol.MAGIC) + 1) == protocol.MAGIC + bytes([version])
+    reader = protocol.BinaryConnection(sock=client)
+    msg_type, payload = reader.read_frame()
+    assert msg_type == protocol.JOIN and protocol.parse_join(payload, version) == ('O', rules, 'bob')
+
+def test_text_client(pair):
+    # A client without MAGIC is a text client, its first message is the nickname
+    client, server = pair
+    client.sendall(b'alice\n')
+    conn, nickname = protocol.accept(server, protocol.Connection)
+    assert nickname == 'alice' and not conn.binary
+
+def test_server_without_binary_protocol(pair):
+    # A binary client talking to a server that answers without MAGIC is told to use the text protocol
+    client, server = pair
+    server.sendall(b'Welcome, enter your nickname\n')
+    with pytest.raises(ConnectionError):
+        protocol.connect(client, 'alice')
+
+def read_error(sock):
+    # Code of the ERROR a server sent after its hello
+    assert sock.recv(len(protocol.MAGIC) + 1).startswith(protocol.MAGIC)
+    msg_type, payload = protocol.BinaryConnection(sock=sock).read_frame()
+    assert msg_type == protocol.ERROR
+    return protocol.parse_error(payload)[0]
+
+def test_unsupported_version(pair):
+    # Version 0 does not exist, the client gets an error and the connection is refused
+    client, server = pair
+    client.sendall(protocol.MAGIC + bytes([0]) + protocol.encode(protocol.JOIN, b'alice'))
+    with pytest.raises(ConnectionError):
+        protocol.accept(server, protocol.Connection)
+    assert read_error(client) == protocol.UNSUPPORTED_VERSION
+
+@pytest.mark.parametrize('frame, code', [
+    ((protocol.MOVE, bytes([4])), protocol.BAD_MESSAGE),
+    ((protocol.JOIN, protocol.join_request('alice', rules=Rules(16, 3, 3))), protocol.BAD_RULES),
+    ((protocol.JOIN, protocol.join_request('alice', rules=Rules(3, 3, 4))), protocol.BAD_RULES),
+    ((protocol.JOIN, b'\0\3'), protocol.BAD_RULES),
+])
+def test_bad_join(pair, frame, code):
+    # Anything but a JOIN with valid rules after the hello is refused with an error telling why
+    client, server = pair
+    client.sendall(protocol.MAGIC + bytes([protocol.VERSION]) + protocol.encode(*frame))
+    with pytest.raises(ConnectionError):
+        protocol.accept(server, protocol.Connection)
+    assert read_error(client) == code
+
+def server_and_client(pair, version=protocol.VERSION):
+    # Server side connection of the given version and the client's reader
+    client, server = pair
+    conn = protocol.BinaryConnection(sock=server)
+    conn.version = version
+    return conn, protocol.BinaryConnection(sock=client)
+
+def test_deltas_follow_the_board(pair):
+    # A game starts with a STATE, every move after it is a DELTA the client plays on its own board
+    conn, reader = server_and_client(pair)
+    board = Board()
+    conn.send_board(board)
+    msg_type, payload = reader.read_frame()
+    assert msg_type == protocol.STATE
+    client_board, _, last_move = protocol.parse_state(payload)
+    assert last_move is None
+    for cell in (4, 0, 8, 2):
+        board.play(cell, board.next_mark())
+        conn.send_board(board, cell, timeout=cell == 8)
+        msg_type, payload = reader.read_frame()
+        assert msg_type == protocol.DELTA
+        assert protocol.apply_delta(client_board, payload) == (protocol.TIMEOUT_MOVE if cell == 8 else 0, cell)
+        assert client_board.key() == board.key()
+    # A prompt on a board the client has only hands over the turn
+    conn.send_prompt(board, 'X')
+    msg_type, payload = reader.read_frame()
+    assert msg_type == protocol.DELTA and protocol.apply_delta(client_board, payload) == (protocol.YOUR_TURN, None)
+
+def test_state_instead_of_delta(pair):
+    # Clients before version 2, a new game and moves the client missed get the whole board
+    conn, reader = server_and_client(pair)
+    board = Board()
+    conn.send_board(board)
+    board.play(4, 'X')
+    board.play(0, 'O')
+    conn.send_board(board, 0)
+    rematch = Board()
+    conn.send_board(rematch)
+    conn.version = 1
+    rematch.play(4, 'X')
+    conn.send_board(rematch, 4)
+    assert [reader.read_frame()[0] for _ in range(4)] == [protocol.STATE] * 4
+
+def test_delta_on_stale_board():
+    # A client board that missed a move, or has the cell of the move taken, is out of sync and stays as it is
+    board = Board()
+    board.play(4, 'X')
+    assert protocol.apply_delta(board, protocol.DELTA_FORMAT.pack(3, 0, 0)) is None
+    assert protocol.apply_delta(board, protocol.DELTA_FORMAT.pack(2, 4, 0)) is None
+    assert protocol.apply_delta(board, protocol.DELTA_FORMAT.pack(2, protocol.NO_MOVE, protocol.YOUR_TURN)) is None
+    assert board.key() == Board(1 << 4).key()
+    assert protocol.apply_delta(board, protocol.DELTA_FORMAT.pack(2, 0, 0)) == (0, 0)
+    assert board.key() == Board(1 << 4, 1).key()
+
+def test_resync(pair):
+    # A client out of sync sends RESYNC and gets the board it was last sent with its turn, then moves
+    conn, reader = server_and_client(pair)
+    board = Board(rules=Rules(4, 4, 3))
+    board.play(5, 'X')
+    conn.send_prompt(board, 'O')
+    reader.read_frame()
+    reader.send(protocol.RESYNC)
+    reader.send(protocol.MOVE, bytes([6]))
+    assert conn.read_move() == 6
+    msg_type, payload = reader.read_frame()
+    assert msg_type == protocol.STATE
+    client_board, flags, _ = protocol.parse_state(payload, board.rules)
+    assert client_board.key() == board.key() and flags == protocol.YOUR_TURN
@@ -0,0 +1,80 @@
+import random
+import pytest
+import engine
+import ratings
+import recording
+import store
+from engine import Rules
+
+def record(log, scores, x, o, result):
+    # Finish a game the way the game servers do: moves first, then the ratings of a rated game
+    game = recording.Game(x, o, Rules(3, 3, 3))
+    game.play(4)
+    log.append(game.finish(result))
+    if ratings.rated(game):
+        scores.record_rating(game.x, game.o, ratings.SCORES[game.result], ratings.update)
+
+def tables(scores):
+    # Rows of both rating tables in a fixed order
+    db = scores.connection()
+    return (db.execute('SELECT nickname, rating, wins, losses, draws FROM ratings ORDER BY nickname').fetchall(),
+            db.execute('SELECT * FROM head_to_head ORDER BY player, opponent').fetchall())
+
+def assert_same(expected, actual):
+    # Same players, counts and pairs, ratings up to rounding
+    assert [row[:1] + row[2:] for row in actual[0]] == [row[:1] + row[2:] for row in expected[0]]
+    assert actual[0] and all(a[1] == pytest.approx(e[1], abs=1e-9) for a, e in zip(actual[0], expected[0]))
+    assert actual[1] == expected[1]
+
+def play_games(tmp_path, count=3000, players=40):
+    # Games of random players, also against the server and left ones. The log is read in between like the
+    # replay pages of a running server do.
+    random.seed(1)
+    log = recording.GameLog(tmp_path / 'games')
+    scores = store.ScoreStore(str(tmp_path / 'live.db'))
+    nicknames = [f'p{number}' for number in range(players)] + ['server']
+    for number in range(count):
+        x, o = random.sample(nicknames, 2)
+        record(log, scores, x, o, random.randrange(len(recording.RESULTS)))
+        if number % 500 == 0:
+            log.read('1-0')
+    return log, scores
+
+@pytest.mark.parametrize('method', ['batch', 'sequential', 'python'])
+def test_recompute_matches_incremental(tmp_path, monkeypatch, method):
+    # Rating all games again gives the ratings and counts the servers recorded game by game
+    log, scores = play_games(tmp_path)
+    if method == 'batch':
+        monkeypatch.setattr(ratings, 'MIN_ROUND_WIDTH', 1)
+    elif method == 'sequential':
+        monkeypatch.setattr(ratings, 'MIN_ROUND_WIDTH', float('inf'))
+    elif method == 'python':
+        monkeypatch.setattr(engine, 'load_numpy', lambda: None)
+    recomputed = store.ScoreStore(str(tmp_path / 'recomputed.db'))
+    # Recomputed from the log the games were written to and from a log opened afresh
+    for games in (log, recording.GameLog(tmp_path / 'games')):
+        count = ratings.recompute(games, recomputed)
+        assert count == sum(row[2] + row[3] + row[4] for row in tables(scores)[0]) // 2
+        assert_same(tables(scores), tables(recomputed))
+    assert 'server' not in [row[0] for row in tables(recomputed)[0]]
+
+def test_update():
+    # Equal players move by half of K, a draw between them changes nothing
+    assert ratings.update(None, None, 1.0) == (ratings.INITIAL_RATING + ratings.K_FACTOR / 2, ratings.INITIAL_RATING - ratings.K_FACTOR / 2)
+    assert ratings.update(1600.0, 1600.0, 0.5) == (1600.0, 1600.0)
+    better, worse = ratings.update(1800.0, 1400.0, 1.0)
+    assert 1800.0 < better < 1800.0 + ratings.K_FACTOR / 10 and better - 1800.0 == pytest.approx(1400.0 - worse)
+
+def test_recompute_empty_log(tmp_path):
+    # No games leave empty tables
+    scores = store.ScoreStore(str(tmp_path / 'scores.db'))
+    assert ratings.recompute(recording.GameLog(tmp_path / 'games'), scores) == 0
+    assert tables(scores) == ([], [])
+
+def test_ratings_page_size(tmp_path):
+    # A negative page size is no size, SQLite would return every player for it
+    scores = store.ScoreStore(str(tmp_path / 'scores.db'))
+    for number in range(3):
+        scores.record_rating(f'p{number}', 'q', 1.0, ratings.update)
+    assert scores.ratings(top=-1) == []
+    assert len(scores.ratings(top=2)) == 2
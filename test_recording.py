@@ -0,0 +1,69 @@
+import recording
+from engine import Rules
+
+def play(log, x, o, moves=(4, 0, 8), result=recording.X_WINS):
+    # Append a finished game, returns its id
+    game = recording.Game(x, o, Rules(3, 3, 3))
+    for cell in moves:
+        game.play(cell)
+    return log.append(game.finish(result))
+
+def test_round_trip(tmp_path):
+    # Game read back by its id is the game appended
+    log = recording.GameLog(tmp_path)
+    game_id = play(log, 'alice', 'bob', moves=(4, 0, 8, 2), result=recording.O_LEFT)
+    game = log.read(game_id)
+    assert (game['x'], game['o'], game['moves'], game['result']) == ('alice', 'bob', [4, 0, 8, 2], 'O left')
+    assert game['rules'] == [3, 3, 3]
+
+def test_read_then_append_keeps_player_numbers(tmp_path):
+    # Reading reloads the player table, players the writer added itself must not be loaded twice
+    log = recording.GameLog(tmp_path)
+    first = play(log, 'alice', 'bob')
+    assert log.read(first)['x'] == 'alice'
+    second = play(log, 'carol', 'dave')
+    assert log.players == ['', 'alice', 'bob', 'carol', 'dave']
+    reader = recording.GameLog(tmp_path)
+    assert reader.read(second)['x'] == 'carol'
+    assert reader.read(first)['o'] == 'bob'
+
+def test_reader_follows_writer(tmp_path):
+    # Another process reading the log loads players added after it opened it
+    log = recording.GameLog(tmp_path)
+    reader = recording.GameLog(tmp_path)
+    play(log, 'alice', 'bob')
+    game_id = play(log, 'carol', 'alice')
+    assert reader.read(game_id)['x'] == 'carol'
+
+def test_unknown_and_bad_ids(tmp_path):
+    # Ids of no record read as None, also ids pointing into a record
+    log = recording.GameLog(tmp_path)
+    game_id = play(log, 'alice', 'bob')
+    segment, offset = game_id.split('-')
+    assert log.read('999-0') is None
+    assert log.read(f'{segment}-{int(offset) + 1}') is None
+    assert log.read(f'{segment}-100000') is None
+    assert log.read('x') is None
+
+def test_record_cut_off_at_end(tmp_path):
+    # A record still being written is neither read nor exported
+    log = recording.GameLog(tmp_path)
+    play(log, 'alice', 'bob')
+    game_id = play(log, 'bob', 'alice')
+    with open(log.segment_path(log.segment), 'r+b') as file:
+        file.truncate(file.seek(0, 2) - 1)
+    assert log.read(game_id) is None
+    assert len(''.join(log.export_csv()).splitlines()) == 2
+
+def test_export(tmp_path):
+    # CSV quotes nicknames and writes moves as hex, the binary export copies the records
+    log = recording.GameLog(tmp_path)
+    first = play(log, 'a,b', 'c"d', moves=(1, 2))
+    play(log, 'c"d', 'a,b', moves=(), result=recording.DRAW)
+    lines = ''.join(log.export_csv()).splitlines()
+    assert lines[0] == ','.join(recording.CSV_HEADER)
+    assert lines[1].startswith(f'{first},')
+    assert lines[1].endswith(',"a,b","c""d",3,3,3,X wins,0102')
+    assert lines[2].endswith(',draw,')
+    with open(log.segment_path(log.segment), 'rb') as file:
+        assert b''.join(log.export_binary()) == file.read()
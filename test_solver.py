@@ -0,0 +1,103 @@
+import functools
+import pytest
+import solver
+from engine import Board, Rules
+
+OTHER = {'X': 'O', 'O': 'X'} # Mark of the opponent
+
+@functools.lru_cache(maxsize=None)
+def value(x, o):
+    # Outcome for the player to move found by plain minimax over the engine's boards, independent of the table
+    board = Board(x, o)
+    if board.winner():
+        return solver.LOSS
+    if board.is_full():
+        return solver.DRAW
+    mark = board.next_mark()
+    best = solver.LOSS
+    for cell in board.legal_moves():
+        child = Board(x, o)
+        child.play(cell, mark)
+        best = max(best, 2 - value(child.x, child.o))
+    return best
+
+def reachable(board, found):
+    # Keys of every position reachable from board, the game stops at a win
+    found[board.key()] = board
+    if board.winner():
+        return found
+    for cell in board.legal_moves():
+        child = Board(board.x, board.o)
+        child.play(cell, board.next_mark())
+        if child.key() not in found:
+            reachable(child, found)
+    return found
+
+POSITIONS = reachable(Board(), {}) # Every legal position of the classic game by key
+
+def test_empty_board_is_a_draw():
+    # Perfect play from the start draws, and the table holds every legal position
+    assert solver.outcome(Board()) == solver.DRAW
+    assert solver.best_move(Board()) is not None
+    assert solver.POSITIONS == len(POSITIONS) == 5478
+
+def test_outcomes_match_minimax():
+    # Every position has the outcome plain minimax finds, and the best move keeps it
+    for board in POSITIONS.values():
+        assert solver.outcome(board) == value(board.x, board.o)
+        move = solver.best_move(board)
+        if board.winner() or board.is_full():
+            assert move is None
+            continue
+        child = Board(board.x, board.o)
+        child.play(move, board.next_mark())
+        assert 2 - value(child.x, child.o) == solver.outcome(board)
+
+def result(board, ai):
+    # Worst result for the AI playing ai against every reply of the opponent: 'loss', 'draw' or 'win'
+    winner = board.winner()
+    if winner:
+        return 'win' if winner == ai else 'loss'
+    if board.is_full():
+        return 'draw'
+    mark = board.next_mark()
+    moves = [solver.best_move(board)] if mark == ai else board.legal_moves()
+    results = []
+    for cell in moves:
+        child = Board(board.x, board.o)
+        child.play(cell, mark)
+        results.append(result(child, ai))
+    return min(results, key=('loss', 'draw', 'win').index)
+
+@pytest.mark.parametrize('cells', ['         ', 'X        ', '    X    ', '        X', 'X   O    ', ' X  O    ', 'XO       ', 'XO  X    ', 'X   O   X'])
+def test_ai_never_loses(cells):
+    # From fixed positions the AI gets what perfect play gives against every reply: it never loses unless the
+    # position is lost for it, and wins every position won for it, on turn or not
+    board = Board.from_cells(cells)
+    ai = board.next_mark()
+    names = {solver.WIN: 'win', solver.DRAW: 'draw', solver.LOSS: 'loss'}
+    assert result(board, ai) == names[solver.outcome(board)]
+    assert result(board, OTHER[ai]) == names[2 - solver.outcome(board)]
+
+def test_heuristic_move():
+    # On boards too big to solve the AI wins if it can, blocks otherwise, else plays near the centre
+    rules = Rules(5, 5, 4)
+    assert solver.best_move(Board(rules=rules)) == 12
+    board = Board(rules=rules)
+    for cell in (0, 1, 2):
+        board.play(cell, 'X')
+    for cell in (10, 16):
+        board.play(cell, 'O')
+    assert solver.best_move(board) == 3
+    board.play(5, 'O')
+    board.play(6, 'O')
+    board.play(7, 'O')
+    board.play(20, 'X')
+    board.play(24, 'X')
+    assert solver.best_move(board) == 3
+    board.play(23, 'X')
+    assert solver.best_move(board) == 8
+    full = Board(rules=Rules(1, 2, 2))
+    full.play(0, 'X')
+    full.play(1, 'O')
+    assert solver.best_move(full) is None
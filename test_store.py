@@ -0,0 +1,73 @@
+import pytest
+import store
+
+def game(number):
+    # History entry of a game played on day number of 2024, a day per game keeps dates in order
+    return {'nicknames': f'p{number}-q{number}', 'winner': f'p{number}', 'date': f'2024-{number // 28 + 1:02d}-{number % 28 + 1:02d} 12:00:00'}
+
+@pytest.fixture
+def history(tmp_path, monkeypatch):
+    # 100 games over several segments, read in blocks smaller than some lines
+    monkeypatch.setattr(store, 'SEGMENT_BYTES', 1000)
+    monkeypatch.setattr(store, 'READ_BLOCK', 64)
+    log = store.HistoryLog(str(tmp_path))
+    for number in range(100):
+        log.append(game(number))
+    return log
+
+def all_pages(log, **kwargs):
+    # Games of every page following the cursors, and the number of pages
+    entries, cursor = log.page(limit=7, **kwargs)
+    pages = 1
+    while cursor is not None:
+        page, cursor = log.page(cursor, limit=7, **kwargs)
+        entries.extend(page)
+        pages += 1
+    return entries, pages
+
+def test_pages_newest_first(history):
+    # Following the cursors reads every game once, newest first, across segments
+    assert len(history.index) > 1
+    entries, pages = all_pages(history)
+    assert entries == [game(number) for number in reversed(range(100))]
+    assert pages == 15
+
+def test_page_before_date(history):
+    # Games played before the date, starting in the segment holding them
+    entries, _ = all_pages(history, before=game(50)['date'])
+    assert entries == [game(number) for number in reversed(range(50))]
+    assert history.page(before=game(0)['date']) == ([], None)
+
+def test_cursor_of_missing_segment(history):
+    # Cursors that were never handed out give an empty last page instead of an error
+    newest = history.index[-1][1]
+    assert history.page(f'{newest + 1}-5') == ([], None)
+    assert history.page('999-5') == ([], None)
+    assert history.page('0-5') == ([], None)
+    assert history.page('bad')[0][0] == game(99)
+
+def test_empty_log(tmp_path):
+    # No games, no pages
+    log = store.HistoryLog(str(tmp_path))
+    assert log.is_empty() and log.version() == '0'
+    assert log.page() == ([], None)
+
+def test_since(history):
+    # Games after a version, each with the version after it, the last one is the end of the log
+    position = history.version()
+    history.append(game(100))
+    history.append(game(101))
+    games = history.since(position)
+    assert [entry for entry, _ in games] == [game(100), game(101)]
+    assert games[-1][1] == history.version()
+    assert [entry for entry, _ in history.since('0')] == [game(number) for number in range(102)]
+
+def test_scoreboard_page_size(tmp_path):
+    # A negative count or a rank before the first one is no row, SQLite would return every player for them
+    scores = store.ScoreStore(str(tmp_path / 'scores.db'))
+    for number in range(20):
+        scores.record_result(f'p{number:02d}', 'nobody')
+    assert scores.entries(0, -1) == []
+    assert scores.query(top=-1) == []
+    assert scores.query(rank=-100) == []
+    assert len(scores.query(rank=1)) == 6
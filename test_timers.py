@@ -0,0 +1,102 @@
+import random
+import socket
+import threading
+import time
+import pytest
+import timers
+
+def wait_for(condition, timeout=2.0):
+    # Poll until condition() holds, True unless timeout passed first
+    end = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > end:
+            return False
+        time.sleep(0.001)
+    return True
+
+@pytest.mark.parametrize('slots, end', [(4, 4 ** timers.LEVELS * 3), (timers.SLOTS, timers.SLOTS ** 2 * 3)])
+def test_timers_come_due_on_their_tick(monkeypatch, slots, end):
+    # Timers of every level up to tick end are returned by advance() on their own tick, in order, whatever steps
+    # the clock takes. With 4 slots timers reach the top level and go round it.
+    monkeypatch.setattr(timers, 'SLOTS', slots)
+    rng = random.Random(1)
+    wheel = timers.TimerWheel()
+    dues = [rng.randrange(1, end) for _ in range(2000)] + [1, slots, slots ** 2, end - 1]
+    for due in dues:
+        wheel.place(timers.Timer(wheel, due, None, ()))
+        wheel.count += 1
+    fired = []
+    while wheel.current < end:
+        before = wheel.current
+        now = before + rng.randrange(1, 3 * timers.SLOTS)
+        due = wheel.advance(now)
+        assert all(before < timer.due <= now and timer.slot is None for timer in due)
+        fired.extend(timer.due for timer in due)
+    assert sorted(fired) == sorted(dues) and wheel.count == 0
+
+def test_next_wake():
+    # The thread sleeps until the next tick with timers, or to the end of the turn of level 0
+    wheel = timers.TimerWheel()
+    assert wheel.next_wake() == timers.SLOTS
+    wheel.place(timers.Timer(wheel, 7, None, ()))
+    wheel.place(timers.Timer(wheel, timers.SLOTS * 3, None, ()))
+    assert wheel.next_wake() == 7
+
+def test_run_and_cancel():
+    # Timers run after their delay in order, a cancelled one never runs
+    wheel = timers.TimerWheel()
+    fired = []
+    start = time.monotonic()
+    wheel.schedule(0.03, lambda: fired.append(('late', time.monotonic() - start)))
+    wheel.schedule(0.01, lambda: fired.append(('early', time.monotonic() - start)))
+    cancelled = wheel.schedule(0.02, fired.append, 'cancelled')
+    assert cancelled.cancel() and not cancelled.cancel()
+    assert wait_for(lambda: len(fired) == 2)
+    assert [name for name, _ in fired] == ['early', 'late']
+    assert fired[0][1] >= 0.01 and fired[1][1] >= 0.03
+    assert wheel.pending() == 0
+
+def test_cancel_after_run():
+    # A timer that ran cannot be cancelled, which tells its owner that the deadline passed
+    wheel = timers.TimerWheel()
+    ran = threading.Event()
+    timer = wheel.schedule(0, ran.set)
+    assert ran.wait(2.0)
+    assert not timer.cancel()
+
+def test_callbacks_schedule_and_fail():
+    # A callback can add timers, and a failing callback leaves the thread running the others
+    wheel = timers.TimerWheel()
+    done = threading.Event()
+
+    def fail():
+        raise ValueError('callback failed')
+
+    wheel.schedule(0.005, fail)
+    wheel.schedule(0.01, lambda: wheel.schedule(0.01, done.set))
+    assert done.wait(2.0)
+    assert wheel.pending() == 0
+
+def test_wakes_for_sooner_timer():
+    # A timer due before the one the thread sleeps for wakes it up. With 10 ms ticks the thread would
+    # otherwise sleep for a turn of level 0, 2.56 seconds.
+    wheel = timers.TimerWheel(tick=0.01)
+    ran = threading.Event()
+    wheel.schedule(60, ran.set)
+    assert wait_for(lambda: wheel.wake is not None)
+    start = time.monotonic()
+    wheel.schedule(0.01, ran.set)
+    assert ran.wait(2.0) and time.monotonic() - start < 1.0
+    assert wheel.pending() == 1
+
+def test_interrupt():
+    # A socket shut down by the timer ends the blocking read of its thread
+    reader, writer = socket.socketpair()
+    try:
+        wheel = timers.TimerWheel()
+        wheel.schedule(0.01, timers.interrupt, reader)
+        assert reader.recv(1) == b''
+        timers.interrupt(reader)
+    finally:
+        reader.close()
+        writer.close()
@@ -0,0 +1,141 @@
+import logging
+import math
+import socket
+import threading
+import time
+
+# Hierarchical timer wheel: one thread keeps every move deadline and lobby timeout of a server, instead of a
+# socket timeout or a sleeping thread per timer. Level 0 has SLOTS slots of TICK seconds, each further level
+# SLOTS slots of a whole turn of the level below, and timers move down a level when their slot comes up, so
+# adding and cancelling a timer costs O(1) however many are pending. The thread wakes for ticks with timers
+# due and once per turn of level 0 while timers wait on higher levels, an empty wheel sleeps until used.
+
+TICK = 0.001 # Seconds per slot of level 0, timers run at most this late
+SLOTS = 256 # Slots per level
+LEVELS = 4 # Levels of the wheel, a timer further than SLOTS ** LEVELS ticks ahead goes round the top level again
+
+def interrupt(sock):
+    # Timer callback cutting off a blocking socket: the thread reading it fails as if the client closed the
+    # connection. Only the socket is shut down, TLS state stays for the reading thread, which closes it.
+    try:
+        socket.socket.shutdown(sock, socket.SHUT_RDWR)
+    except OSError:
+        pass
+
+class Timer:
+    # Callback due at a tick of its wheel
+    __slots__ = ('wheel', 'due', 'callback', 'args', 'slot')
+
+    def __init__(self, wheel, due, callback, args):
+        self.wheel = wheel
+        self.due = due
+        self.callback = callback
+        self.args = args
+        self.slot = None # Set of timers holding it, None once it ran or was cancelled
+
+    def cancel(self):
+        # True when the timer was cancelled before it ran, False when it has run or is running
+        with self.wheel.changed:
+            if self.slot is None:
+                return False
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel.count -= 1
+            return True
+
+class TimerWheel:
+    # Shared by all games of a process, callbacks run on the wheel's thread and must not block
+    def __init__(self, tick=TICK):
+        self.tick = tick
+        self.origin = time.monotonic()
+        self.current = 0 # Last tick whose timers ran
+        self.levels = [[set() for _ in range(SLOTS)] for _ in range(LEVELS)]
+        self.count = 0 # Timers pending
+        self.wake = None # Tick the thread sleeps until, None while it sleeps until a timer is added
+        self.changed = threading.Condition()
+        self.thread = None
+
+    def now(self):
+        # Tick of the present moment
+        return int((time.monotonic() - self.origin) / self.tick)
+
+    def pending(self):
+        return self.count
+
+    def schedule(self, delay, callback, *args):
+        # Run callback(*args) after delay seconds, returns the timer to cancel it
+        with self.changed:
+            # The thread starts on first use, worker processes fork after the wheel is created
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            if not self.count:
+                # Ticks of an empty wheel need no stepping through
+                self.current = max(self.current, self.now())
+            due = max(math.ceil((time.monotonic() - self.origin + delay) / self.tick), self.current + 1)
+            timer = Timer(self, due, callback, args)
+            self.place(timer)
+            self.count += 1
+            if self.wake is None or due < self.wake:
+                self.changed.notify()
+        return timer
+
+    def place(self, timer):
+        # Put timer in the slot of the lowest level whose turn reaches its tick. Called holding the lock.
+        ahead = timer.due - self.current
+        level = 0
+        while level < LEVELS - 1 and ahead >= SLOTS ** (level + 1):
+            level += 1
+        timer.slot = self.levels[level][timer.due // SLOTS ** level % SLOTS]
+        timer.slot.add(timer)
+
+    def advance(self, now):
+        # Step through the ticks up to now, returns the timers due. Called holding the lock.
+        due = []
+        while self.current < now:
+            self.current += 1
+            tick = self.current
+            # A slot of a higher level comes up when all levels below it start a new turn, its timers move down
+            level = 1
+            while level < LEVELS and tick % SLOTS ** level == 0:
+                slot = self.levels[level][tick // SLOTS ** level % SLOTS]
+                timers = list(slot)
+                slot.clear()
+                for timer in timers:
+                    self.place(timer)
+                level += 1
+            slot = self.levels[0][tick % SLOTS]
+            if slot:
+                for timer in slot:
+                    timer.slot = None
+                self.count -= len(slot)
+                due.extend(slot)
+                slot.clear()
+        return due
+
+    def next_wake(self):
+        # Next tick with timers due on level 0, or the start of the next turn of level 0, where timers of higher
+        # levels may move down. Called holding the lock.
+        end = (self.current // SLOTS + 1) * SLOTS
+        for tick in range(self.current + 1, end):
+            if self.levels[0][tick % SLOTS]:
+                return tick
+        return end
+
+    def run(self):
+        # Run the timers that are due, callbacks are called without the lock so they can add timers
+        while True:
+            with self.changed:
+                due = self.advance(self.now())
+                while not due:
+                    self.wake = self.next_wake() if self.count else None
+                    timeout = None if self.wake is None else self.origin + self.wake * self.tick - time.monotonic()
+                    if timeout is None or timeout > 0:
+                        self.changed.wait(timeout)
+                    due = self.advance(self.now())
+                self.wake = self.current
+            for timer in due:
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    logging.exception("Timer callback failed")
@@ -0,0 +1,235 @@
+import multiprocessing
+import multiprocessing.connection
+import selectors
+import socket
+import asyncio
+import logging
+import time
+import os
+import protocol
+import metrics
+
+# Pre-fork game server. The supervisor forks worker processes that all listen on the game port with SO_REUSEPORT,
+# so the kernel spreads new connections over them and every worker runs games on its own CPU core. Workers send
+# game results to the supervisor, which is the only process writing the store and the history log.
+# Each worker has its own lobby, a shared registry tells which worker holds the player waiting for given rules.
+# A player joining another worker is relayed there over a unix socket, so two players always meet. Relayed players
+# never wait in the other worker: without an opponent there they are handed back and join their own lobby again.
+
+RESTART_DELAY = 1.0 # Seconds before a crashed worker is started again, keeps a crash loop from eating the CPU
+MAX_WORKERS = 127 # Worker numbers are kept in signed bytes of the registry
+METRICS_INTERVAL = 5.0 # Seconds between metrics snapshots a worker sends to the supervisor
+
+def rules_index(rules):
+    # Registry slot of the rules, every side and k is below 16
+    rows, cols, k = rules.key()
+    return (rows * 16 + cols) * 16 + k
+
+class Registry:
+    # Worker holding the waiting player of every rules, in shared memory so all workers see it.
+    # Callers hold lock while they check and change the registry together with their lobby.
+    def __init__(self):
+        self.owners = multiprocessing.RawArray('b', 16 ** 3) # Worker number + 1 by rules, 0 when nobody waits
+        self.lock = multiprocessing.Lock()
+
+    def owner(self, rules):
+        owner = self.owners[rules_index(rules)]
+        return owner - 1 if owner else None
+
+    def claim(self, rules, worker):
+        self.owners[rules_index(rules)] = worker + 1
+
+    def release(self, rules):
+        self.owners[rules_index(rules)] = 0
+
+class Worker:
+    # What a worker process shares with the others
+    def __init__(self, number, registry, relay_dir, results, snapshots):
+        self.number = number
+        self.registry = registry
+        self.relay_dir = relay_dir # Directory of the workers' unix sockets that take relayed players
+        self.results = results # Queue of game results for the supervisor
+        self.snapshots = snapshots # Queue of metrics snapshots for the supervisor
+
+    def relay_path(self, number=None):
+        return os.path.join(self.relay_dir, f"worker{self.number if number is None else number}.sock")
+
+    def relay_socket(self):
+        # Unix socket taking players relayed by other workers, a restarted worker replaces the old file
+        path = self.relay_path()
+        if os.path.exists(path):
+            os.unlink(path)
+        relay_server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        relay_server.bind(path)
+        relay_server.listen(socket.SOMAXCONN)
+        return relay_server
+
+    def send_metrics(self):
+        # Metrics of this worker for the supervisor's /metrics, never returns
+        while True:
+            time.sleep(METRICS_INTERVAL)
+            self.snapshots.put((self.number, metrics.snapshot()))
+
+def reuse_port_socket(host, port, backlog):
+    # Listening socket sharing its port with the other workers
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    server.bind((host, port))
+    server.listen(backlog)
+    return server
+
+def handover(conn, nickname):
+    # First bytes for the other worker: the player's hello and JOIN again, then anything the player already sent
+    if not conn.binary:
+        return nickname.encode()
+    join = protocol.join_request(nickname, conn.version, conn.vs_server, conn.rules)
+    pending = bytes(conn.buffer)
+    conn.buffer.clear()
+    return protocol.MAGIC + bytes([conn.version]) + protocol.encode(protocol.JOIN, join) + pending
+
+def hello_size(conn):
+    # The other worker answers the hello again, the player already got that answer
+    return len(protocol.MAGIC) + 1 if conn.binary else 0
+
+def sent_again(conn, frames, data):
+    # Whether data the player sent completes an AGAIN, frames keeps the bytes of incomplete frames
+    if not conn.binary:
+        return False
+    frames += data
+    again = False
+    frame = protocol.pop_frame(frames)
+    while frame is not None:
+        again = again or frame[0] == protocol.AGAIN
+        frame = protocol.pop_frame(frames)
+    return again
+
+def relay(conn, nickname, path):
+    # Hand player over to the worker listening on path and copy bytes both ways until either side closes.
+    # The other worker closes without a word when it has no opponent for the player after all, then
+    # True is returned and the player is still connected to join the lobby again.
+    upstream = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    started = False # Other worker answered since the player's last AGAIN
+    frames = bytearray()
+    try:
+        upstream.connect(path)
+        upstream.sendall(handover(conn, nickname))
+        skip = hello_size(conn)
+        selector = selectors.DefaultSelector()
+        selector.register(conn.sock, selectors.EVENT_READ, upstream)
+        selector.register(upstream, selectors.EVENT_READ, conn.sock)
+        while True:
+            for key, _ in selector.select():
+                source, target = key.fileobj, key.data
+                data = source.recv(protocol.RECV_SIZE)
+                if not data:
+                    if source is upstream and not started:
+                        return True
+                    conn.close()
+                    return False
+                if source is upstream:
+                    data, skip = data[skip:], max(skip - len(data), 0)
+                    started = started or bool(data)
+                else:
+                    # TLS keeps decrypted bytes that select does not report
+                    while conn.sock.pending():
+                        data += conn.sock.recv(conn.sock.pending())
+                    if sent_again(conn, frames, data):
+                        started = False
+                target.sendall(data)
+    except OSError as e:
+        logging.error(f"{e} error occurred while relaying player {nickname}.")
+        conn.close()
+        return False
+    finally:
+        upstream.close()
+
+async def relay_async(conn, nickname, path):
+    # relay for asyncio streams
+    try:
+        reader, writer = await asyncio.open_unix_connection(path)
+    except OSError as e:
+        logging.error(f"{e} error occurred while relaying player {nickname}.")
+        conn.close()
+        return False
+    writer.write(handover(conn, nickname))
+    started = False
+
+    async def to_player():
+        nonlocal started
+        await reader.readexactly(hello_size(conn))
+        while True:
+            data = await reader.read(protocol.RECV_SIZE)
+            if not data:
+                return
+            started = True
+            conn.writer.write(data)
+            await conn.writer.drain()
+
+    async def to_worker():
+        nonlocal started
+        frames = bytearray()
+        while True:
+            data = await conn.reader.read(protocol.RECV_SIZE)
+            if not data:
+                return
+            if sent_again(conn, frames, data):
+                started = False
+            writer.write(data)
+            await writer.drain()
+
+    down = asyncio.ensure_future(to_player())
+    up = asyncio.ensure_future(to_worker())
+    done, _ = await asyncio.wait((down, up), return_when=asyncio.FIRST_COMPLETED)
+    up.cancel()
+    down.cancel()
+    writer.close()
+    if up not in done and (down.exception() is None or isinstance(down.exception(), asyncio.IncompleteReadError)) and not started:
+        return True
+    conn.close()
+    return False
+
+class Supervisor:
+    # Forks count workers running target(worker) and forks a new one whenever a worker exits
+    def __init__(self, target, count, relay_dir):
+        self.context = multiprocessing.get_context('fork')
+        self.target = target
+        self.registry = Registry()
+        self.results = self.context.SimpleQueue()
+        self.snapshots = self.context.SimpleQueue()
+        self.relay_dir = relay_dir
+        self.processes = [None] * count
+
+    def spawn(self, number):
+        worker = Worker(number, self.registry, self.relay_dir, self.results, self.snapshots)
+        process = self.context.Process(target=self.target, args=(worker,), daemon=True)
+        process.start()
+        self.processes[number] = process
+
+    def supervise(self):
+        # Start all workers and restart crashed ones, never returns
+        for number in range(len(self.processes)):
+            self.spawn(number)
+        while True:
+            multiprocessing.connection.wait([process.sentinel for process in self.processes])
+            for number, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logging.error(f"Worker {number} exited with code {process.exitcode}, starting it again.")
+                    with self.registry.lock:
+                        # Players waiting in the crashed worker are gone
+                        for index, owner in enumerate(self.registry.owners):
+                            if owner == number + 1:
+                                self.registry.owners[index] = 0
+                    time.sleep(RESTART_DELAY)
+                    self.spawn(number)
+
+    def results_loop(self, record):
+        # Record results sent by workers one after another, the supervisor is the only writer
+        while True:
+            record(*self.results.get())
+
+    def metrics_loop(self, latest):
+        # Keep the latest metrics snapshot of every worker in latest by worker number
+        while True:
+            number, snapshot = self.snapshots.get()
+            latest[number] = snapshot